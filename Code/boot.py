@@ -1,98 +1,219 @@
+import utime
+boot_started = utime.ticks_us()
+
 from machine import I2C, Pin, SoftI2C
 import urtc as uRTC
-import os
-import urequests
 import time
 import network
 import dht
 import neopixel
 import secrets
+import uploader
+import samplelog
+import eeprom
+import runtime
+import aggregate
+import sensors
+import metrics
+import timesync
+import livestream
+
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
 
-from oocsi import OOCSI
+# OOCSI is only imported once it is needed, compiling it would delay the
+# first sample
 
 led = neopixel.NeoPixel(Pin(21), 1)
 
-# Variable to check if device is uploading
-upload_in_progress = False
-
 # Values to be stored in a secrets.py file
 # api_token = "YOUR_API_TOKEN"
 # device_id = "YOUR_DEVICE_ID"
 # dataset_id = 123456
 # ssid = 'YOUR_WIFI_SSID'
 # wifipass = 'YOUR_WIFI_PASSWORD'
-
-csvfilename = "sensor_data.csv"
+# Optional, to use other servers than Data Foundry, hello.oocsi.net and
+# pool.ntp.org
+# upload_url = 'http://192.168.1.10:8080/datasets/ts/logFile/1'
+# oocsi_host = '192.168.1.10'
+# oocsi_port = 4444
+# time_host = '192.168.1.10'
+# time_port = 1123
+# Optional, the time zone of the timestamps, Dutch time when not set
+# utc_offset = 3600     # seconds ahead of UTC outside summer time
+# dst = 'EU'            # or None for no summer time
+
+# The log is kept in segments sensor_data.<n>.bin of at most one day and
+# segment_records records, listed in sensor_data.idx. An older single
+# sensor_data.bin is taken over as the first segment. Rows still waiting in
+# the CSV log of older versions are uploaded first, then that file is removed
+logname = "sensor_data"
+legacyname = "sensor_data.csv"
+segment_records = 2048
+
+# Buffer the samples in the EEPROM on the RTC board, they are moved into the
+# log on flash every drain_interval seconds and before every upload
+use_eeprom = True
+drain_interval = 3600
+
+# Samples are stored as min/max/mean per window (in seconds), a sample that
+# jumps more than the threshold from the previous one is also stored as is
+aggregate_windows = (60, 900)
+raw_threshold = {"humidity": 5, "temperature": 2}
+
+# Job intervals in seconds, samples are taken on multiples of the interval
+# in wall-clock time
+sample_interval = 5
+dht_interval = 5        # sensors are never read faster than they allow
+led_interval = 5
+wifi_interval = 30
+clock_interval = 60     # checks if a clock sync is due
+
+# Upload automatically every hour when connected, besides the boot button
+upload_interval = 3600
+
+# Uploads are plain CSV. "deflate" compresses them and "delta" sends rows as
+# changes from the previous one; both need an endpoint that understands them,
+# deflate falls back to delta rows or plain CSV when it is not possible
+upload_encoding = None
+
+# A batch that times out or gets a 5xx is sent again up to upload_retries
+# times, waiting about 1, 2, 4... seconds in between
+upload_retries = 3
+
+# The DS3231 INT/SQW pin gives the scheduler a tick at the start of every
+# second, None when it is not wired (the tick counter is used then)
+rtc_int_pin = 5
+
+# OOCSI server for the telemetry
+oocsi_host = getattr(secrets, 'oocsi_host', 'hello.oocsi.net')
+oocsi_port = getattr(secrets, 'oocsi_port', 4444)
+
+# SNTP server for the clock sync. The RTC keeps local time, the timestamps
+# of the log: UTC plus utc_offset seconds, plus an hour in summer with dst
+# 'EU'. The default is Dutch time, what the OOCSI timechannel used to give.
+# The hour after the change in autumn repeats in the log, set utc_offset = 0
+# and dst = None in secrets.py to log UTC. The RTC is synced again before
+# its measured drift adds up to clock_tolerance_ms, and right after a
+# summer time change
+time_host = getattr(secrets, 'time_host', 'pool.ntp.org')
+time_port = getattr(secrets, 'time_port', 123)
+utc_offset = getattr(secrets, 'utc_offset', 3600)
+dst = getattr(secrets, 'dst', 'EU')
+clock_tolerance_ms = 500
+
+# Set once the RTC has been synced, and when the next sync is due (RTC time)
+clock_synced = False
+next_clock_sync = 0
+
+# Publish every sample live on this OOCSI channel as well, None to only log
+# them. With live_aggregates the aggregate rows are published instead. Up to
+# live_backlog messages wait while OOCSI is not connected, they are sent in
+# order once it is back
+live_channel = None
+live_aggregates = False
+live_backlog = 120
+
+# Timings per stage, error counts and the heap low-water mark, printed and
+# published on the OOCSI telemetry channel every telemetry_interval seconds.
+# Set the channel to None to only print them
+metrics_enabled = True
+telemetry_channel = 'msos/telemetry'
+telemetry_interval = 600
 
 # Upload destination and header
-url = 'https://data.id.tue.nl/datasets/ts/logFile/{}'.format(secrets.dataset_id)
+url = getattr(secrets, 'upload_url', 'https://data.id.tue.nl/datasets/ts/logFile/{}'.format(secrets.dataset_id))
 headers = {
     "Content-Type": "text/plain",
     "api_token": secrets.api_token,
     "device_id": secrets.device_id    # Replace with your actual device ID
 }
 
+# Metrics
+#---------------------------------------------------------------------------
+
+metrics.enable(metrics_enabled)
+SAMPLE = metrics.stage('sample')
+RTC_READ = metrics.stage('rtc')
+APPEND = metrics.stage('append')
+UPLOAD = metrics.stage('upload')
+WIFI = metrics.stage('wifi')
+BUTTON = metrics.counter('button_presses')
+UPLOAD_ERRORS = metrics.counter('upload_errors')
+WIFI_ERRORS = metrics.counter('wifi_failures')
+BOOT = metrics.stage('boot')
+oocsi = None
+boot_to_sample_ms = None
+
 # Functions
 #---------------------------------------------------------------------------
 
 def button_pressed(pin):
-    # Function to start upload when boot button is pressed
-    # Ignore if upload already in progress
-    if hasattr(button_pressed, 'upload_in_progress') and button_pressed.upload_in_progress:
-        print('*** Upload already in progress, ignoring button press')
+    # Interrupt handler of the boot button, only queue an upload for the
+    # upload worker so the interrupt returns immediately
+    BUTTON.add()
+    uploads.request()
+
+def upload(manual):
+    # Runs in the upload worker thread, on a button press (manual) or on schedule
+    drain()
+    waiting = legacy.pending() + log.pending()
+    if not manual and not (wlan.isconnected() and waiting > 0):
+        # Scheduled uploads stay silent when there is nothing to do
         return
-    
+
     # Set indicator light
     led[0] = (0, 20, 20)
     led.write()
-    
-    # Set upload flag
-    upload_in_progress = True
-    
-    try:
-        if wlan.isconnected() and os.stat(csvfilename)[6] > 77:
-            # If wifi is connected and file contains at least 2 values, send values
-            try:
-                # Upload values to DF
-                print('*** Starting upload...')
-                with open(csvfilename, 'r') as csvfile:
-                    csv_content = csvfile.read()
-                
-                # Set a timeout to prevent hanging
-                response = urequests.post(url, headers=headers, data=csv_content)
 
-                print('*** DATAFOUNDRY: Status code:', response.status_code)
-                print('*** DATAFOUNDRY: Response:', response.text)
-                
-                # Only clear the file if upload was successful
-                if response.status_code in (200, 201, 202):
-                    # Remove values (except header) from CSV
-                    with open(csvfilename, "w") as resetfile:
-                        resetfile.write("ts,humidity,temperature\n")
-                    
-                    # Blink green trice
-                    blink(3, g=20)
-                else:
-                    print('*** Upload failed with status code:', response.status_code)
-                    blink(2, r=20, g=20)  # Yellow blink for HTTP error
-                    
-            # If anything goes wrong
-            except Exception as e:
-                # Print a simple error message and blink red trice
-                print('*** Error during upload:', e)
-                blink(3, r=20)
+    if wlan.isconnected() and waiting > 0:
+        # If wifi is connected and there are values not uploaded yet, send them
+        try:
+            # Upload values to DF
+            print('*** Starting upload...')
+
+            # Send the values after the last checkpoint in batches as CSV,
+            # an interrupted upload continues from there next time
+            t = UPLOAD.start()
+            if legacy.pending():
+                # The rows left in the old CSV log go first
+                response = uploader.upload_log(url, headers, legacy, encoding=upload_encoding, retries=upload_retries)
+            if not legacy.pending() and log.pending():
+                response = uploader.upload_log(url, headers, log, encoding=upload_encoding, retries=upload_retries)
+            UPLOAD.stop(t)
+            metrics.heap()
+
+            print('*** DATAFOUNDRY: Status code:', response.status_code)
+            print('*** DATAFOUNDRY: Response:', response.text)
+            print('*** DATAFOUNDRY: Sent {} bytes for {} bytes of CSV ({:.1f}x), {} connection(s), {} retries'.format(
+                response.sent_bytes, response.raw_bytes, response.raw_bytes / max(response.sent_bytes, 1),
+                response.connects, response.retries))
+            
+            if response.status_code in (200, 201, 202):
+                # Blink green trice
+                blink(3, g=20)
+            else:
+                UPLOAD_ERRORS.add()
+                print('*** Upload failed with status code:', response.status_code)
+                blink(2, r=20, g=20)  # Yellow blink for HTTP error
                 
-        elif wlan.isconnected():
-            # Blink once if wifi is connected but file is not big enough
-            print('*** Error: NOT ENOUGH DATA, PLEASE WAIT')
-            blink(1, r=20)
-        else:
-            # Blink twice if wifi is not connected
-            print('*** Error: WIFI NOT CONNECTED')
-            blink(2, r=20)
-    finally:
-        # Always clear the upload flag when done
-        upload_in_progress = False
+        # If anything goes wrong
+        except Exception as e:
+            # Print a simple error message and blink red trice
+            UPLOAD_ERRORS.add()
+            print('*** Error during upload:', e)
+            blink(3, r=20)
+            
+    elif wlan.isconnected():
+        # Blink once if wifi is connected but there is nothing to upload
+        print('*** Error: NOT ENOUGH DATA, PLEASE WAIT')
+        blink(1, r=20)
+    else:
+        # Blink twice if wifi is not connected
+        print('*** Error: WIFI NOT CONNECTED')
+        blink(2, r=20)
 
 def blink(loop,r=0,g=0,b=0):
     # Simple blink function to make the leds blink
@@ -104,20 +225,11 @@ def blink(loop,r=0,g=0,b=0):
         led.write()
         time.sleep(0.2)
 
-def receiveEvent(sender, recipient, event):
-    # Function that runs when an OOCSI message is received, update the RTC time and disconnect
-    print('from ', sender, ' -> ', event)
-    if ("datetime") in event:
-        print("found")
-        OOCSITIME = uRTC.datetime_tuple(year=event["y"], month=event["M"], day=event["d"], hour=event["h"], minute=event["m"], second=event["s"])
-        print(event["y"])
-        ds.datetime(OOCSITIME)
-        if 'timechannel' in o.receivers:
-            o.unsubscribe('timechannel')
-            o.stop()
-
-def connectWifi():
-    # Wifi Connection function
+async def connectWifi():
+    # Wifi Connection function, runs periodically and reconnects when needed
+    if wlan.isconnected():
+        return
+
     led.fill((0, 20, 0))  # Indicate trying to connect
     led.write()
     
@@ -125,6 +237,7 @@ def connectWifi():
     
     if not wlan.isconnected():
         print('*** WIFI: Connecting to network...')
+        t = WIFI.start()
         # replace these with your WIFI name and password
         wlan.connect(secrets.ssid, secrets.wifipass)
         
@@ -135,44 +248,146 @@ def connectWifi():
         while not wlan.isconnected():
             if time.time() - start_time > timeout:
                 break  # Exit the loop if the connection attempt times out
-            time.sleep(0.1)  # Small delay to prevent hogging the CPU
+            await asyncio.sleep(0.1)  # Let the other jobs run meanwhile
             
             # Optional: You can add more feedback, like blinking the LED, to show progress
+        WIFI.stop(t)
 
     if wlan.isconnected():
         print("*** WIFI: Connected")
         led.fill((0, 0, 20))  # Change LED to indicate successful connection
     else:
+        WIFI_ERRORS.add()
         print("*** WIFI: Couldnt connect in time.")
         led.fill((20, 0, 0))  # Change LED to indicate failure
     
     led.write()
 
-# WiFi
-#---------------------------------------------------------------------------
+async def syncClock():
+    # Set the RTC from the time server, once after boot and then whenever
+    # the drift measured between syncs makes it due
+    global clock_synced, next_clock_sync
+    if clock is None or not wlan.isconnected() or clock.time() < next_clock_sync:
+        return
+    if timeSync.address is None:
+        # The name lookup blocks, the upload worker does it and the sync
+        # follows on the next check
+        uploads.background(timeSync.resolve)
+        return
+    if await timeSync.sync(ds, clock):
+        clock_synced = True
+        next_clock_sync = clock.time() + timeSync.next_sync()
+        print('*** TIMESYNC: Next sync in {} s'.format(next_clock_sync - clock.time()))
 
-# Configure Wifi
-wlan = network.WLAN(network.STA_IF)
-print("MAC ADDRESS=",wlan.config('mac').hex())
+def showStatus():
+    # Turn on the LED when connected to wifi
+    if wlan.isconnected():
+        led.fill((20, 0, 0))
+    else:
+        led.fill((0, 20, 0))
+    led.write()
 
-# Connect to wifi
-connectWifi()
+def sample():
+    # Take the latest value of every sensor, each is read at its own rate
+    started = SAMPLE.start()
+    values = registry.snapshot()
+
+    # Fold the sample into the windows, store the ones that are complete
+    t = RTC_READ.start()
+    seconds = clock.time()
+    RTC_READ.stop(t)
+    for row_seconds, row in aggregator.add(seconds, values):
+        t = APPEND.start()
+        store.append(row_seconds, row)
+        APPEND.stop(t)
+        if live is not None and live_aggregates:
+            live.publish(row_seconds, row)
+    SAMPLE.stop(started)
+    metrics.heap()
+    if live is not None and not live_aggregates:
+        live.publish(seconds, values)
+    if boot_to_sample_ms is None:
+        reportBoot()
+    now = uRTC.seconds2tuple(seconds)
+    timestamp = "{}-{}-{}T{}:{}:{}".format(now.year, now.month, now.day, now.hour, now.minute, now.second)
+    readings = ", ".join("{} {}{}".format(*v) for v in zip(registry.fields, values, registry.units))
+    print("Saved data at: {}, {}".format(timestamp, readings))
+
+def drain():
+    # Move the samples buffered in the EEPROM into the log on flash
+    if store is not log:
+        try:
+            store.drain(log)
+        except Exception as e:
+            print('*** EEPROM: Drain failed:', e)
+
+def reportBoot():
+    # Time from reset and from the start of this script to the first sample
+    global boot_to_sample_ms
+    boot_to_sample_ms = utime.ticks_diff(utime.ticks_us(), boot_started) // 1000
+    BOOT.stop(boot_started)
+    print("*** BOOT: First sample {} ms after reset, {} ms after boot.py started".format(
+        utime.ticks_ms(), boot_to_sample_ms))
+
+def connectOOCSI():
+    # The OOCSI connection for telemetry and live samples, made on first use.
+    # It reconnects on its own from then on. With maxDelay its own thread
+    # does all writes, a send from a job only queues and never waits for the
+    # network; a full queue refuses it and live samples stay in the backlog
+    global oocsi
+    if oocsi is None:
+        from oocsi import OOCSI
+        oocsi = OOCSI('msos/logger_{}'.format(secrets.device_id), oocsi_host, oocsi_port, wait=False,
+                      maxDelay=100, maxQueue=4096)
+    return oocsi
+
+def startLive():
+    # Hand the OOCSI connection to the live stream once there is Wi-Fi
+    if live.oocsi is None and wlan.isconnected():
+        live.oocsi = connectOOCSI()
+
+def publishTelemetry():
+    # Print the metrics and publish them on the telemetry channel, they are
+    # reset once published
+    print(metrics.report())
+    if not telemetry_channel or not wlan.isconnected():
+        return
+    telemetry = connectOOCSI()
+    if telemetry.connected and telemetry.send(telemetry_channel, metrics.summary()):
+        metrics.reset()
 
 # Hardware
 #---------------------------------------------------------------------------
 
-# Define the upload button and setup interrupt
+# Boot order: RTC, sensors and the log come up first so the first sample
+# can be taken right away. Wi-Fi, the clock sync and uploads only start
+# after that, as background jobs with their own timeouts
+
+# Sensors register here, their fields become the columns of the log
+registry = sensors.Registry()
+
+# Define the upload button, its interrupt is set up with the upload worker
 KEY = Pin(0,Pin.IN,Pin.PULL_UP) 
-KEY.irq(trigger=Pin.IRQ_RISING, handler=button_pressed)
-time.sleep(2)
 
 # Connect to RTC, Blink pink once if not found
 sda_pin=Pin(33)
 scl_pin=Pin(34)
 i2c = I2C(scl=scl_pin, sda=sda_pin)
+ds = uRTC.DS3231(i2c)
+clock = None
 try:
-    ds = uRTC.DS3231(i2c)
-    ds.datetime()
+    # The temperature column is there even when the chip does not answer
+    # now, a transient I2C error must not change the columns of the log
+    registry.add(sensors.DS3231Temperature(ds))
+except Exception as e:
+    print('*** RTC: Temperature read failed:', e)
+try:
+    # One burst read for the time, status flags and temperature
+    rtc_now, rtc_status, rtc_temperature = ds.read()
+    if rtc_status & 0x80:
+        print("*** RTC: Lost power, time is invalid until the clock is synced")
+    # Timestamps come from the tick counter, the RTC is read once an hour
+    clock = uRTC.Clock(ds, resync=3600)
     print("*** RTC Connected")
 except Exception as e:
     print('*** RTC Error, type:',e)
@@ -180,65 +395,83 @@ except Exception as e:
 
 # Connect to DHT11 sensor, Blink pink twice if not found
 try:
-    sensor = dht.DHT11(Pin(6))
-    sensor.measure()
+    registry.add(sensors.DHT(dht.DHT11(Pin(6))), dht_interval)
     print("*** DHT: Connected")
 except Exception as e:
     print("*** DHT: Error, type:",e)
     blink(2,r=20, b=20)
 
 
-# Sync Clock with OOCSI
+# Open log
 #---------------------------------------------------------------------------
 
-if wlan.isconnected():
-    # Connect to OOCSI server to sync clock
-    o = OOCSI('msos/example/MicroPython_receiver_###', 'hello.oocsi.net')
-    o.subscribe('timechannel', receiveEvent)
-
-
-# Create CSV
-#---------------------------------------------------------------------------
-
-# Setup file, and create one if it doesnt exist yet
-file_exists = csvfilename in os.listdir()
-with open(csvfilename, "a") as file:
-    # Write header only if file is new
-    if not file_exists:
-        file.write("ts,humidity,temperature\n")
-        file.close()
+# Open the binary sample log, and create one if it doesnt exist yet. Its
+# columns are the aggregates of the registered sensors. Records are kept in
+# RAM and written together, at the latest after 10 minutes
+aggregator = aggregate.Aggregator(registry.fields, aggregate_windows, raw_threshold, registry.scales)
+log = samplelog.SegmentedLog(logname, aggregator.columns, aggregator.scales, buffer=16, max_age=600,
+                             segment_records=segment_records)
+print("*** LOG: {} values waiting for upload in {} segment(s)".format(log.pending(), len(log.sealed) + 1))
+legacy = samplelog.CSVLog(legacyname)
+if legacy.pending():
+    print("*** LOG: {} bytes of {} waiting for upload".format(legacy.pending(), legacyname))
+
+# Live samples, sent once the OOCSI connection is up. Aggregate rows have a
+# unit for every column
+live = None
+if live_channel:
+    live_fields, live_units = registry.fields, registry.units
+    if live_aggregates:
+        live_fields = aggregator.columns
+        live_units = [unit for unit in registry.units for _ in range(3)] + ["", "s"]
+    live = livestream.LiveStream(live_channel, live_fields, live_units,
+                                 'logger_{}'.format(secrets.device_id), live_backlog)
+
+# New records go to the EEPROM ring when there is one, else straight to the
+# log. The ring keeps the pointers on the chip, so what it holds survives a
+# reset and even a lost filesystem
+store = log
+if use_eeprom and ds is not None:
+    try:
+        store = eeprom.EEPROMLog(eeprom.AT24C32(i2c), aggregator.columns, aggregator.scales)
+        print("*** EEPROM: {} values buffered".format(store.pending()))
+    except Exception as e:
+        print('*** EEPROM Error, type:', e)
 
-# Loop
+# WiFi
 #---------------------------------------------------------------------------
-while True:
 
-    # Turn on the LED when connected to wifi
-    if wlan.isconnected():
-        print("*** WIFI: Connected")
-        led.fill((20, 0, 0))
-        led.write()
-        
-    elif not wlan.isconnected():
-        print("*** WIFI: Disconnected")
-        led.fill((0, 20, 0))
-        led.write()
+# Configure Wifi, connecting happens in the background
+wlan = network.WLAN(network.STA_IF)
+print("MAC ADDRESS=",wlan.config('mac').hex())
 
-    # Open CSV file
-    with open(csvfilename, "a") as file:
+# Uploads run in the background, started by the button or the schedule
+uploads = uploader.UploadWorker(upload)
+uploads.start()
+KEY.irq(trigger=Pin.IRQ_RISING, handler=button_pressed)
 
-        # Read sensor value
-        sensor.measure()
-        temperature = sensor.temperature()
-        humidity = sensor.humidity()
+# One-shot SNTP exchanges for the clock sync, no connection stays open
+timeSync = timesync.TimeSync(time_host, time_port, utc_offset=utc_offset, dst=dst, tolerance_ms=clock_tolerance_ms)
 
-        # Format and write data to CSV
-        timestamp =  "{}-{}-{}T{}:{}:{}" .format(ds.datetime()[0],ds.datetime()[1],ds.datetime()[2],ds.datetime()[4], ds.datetime()[5],ds.datetime()[6])
-        data_line = "{},{},{}\n".format(timestamp, humidity, temperature)
-        file.write(data_line)
-        print("Saved data at: {}, Humidity was {}%, Temperature was {}{}".format(timestamp, humidity, temperature,chr(176)))
-        file.close()
-        
-        # Wait a bit between readings
+# Run
+#---------------------------------------------------------------------------
 
-    # Wait another minute
-    time.sleep(60)
+# All jobs share one event loop, add new periodic jobs here. They start in
+# this order, so the first sample is taken before Wi-Fi is brought up
+ticks = None
+if clock is not None and rtc_int_pin is not None:
+    ticks = runtime.AlarmTicks(ds, Pin(rtc_int_pin, Pin.IN, Pin.PULL_UP))
+jobs = runtime.Runtime(clock, ticks)
+jobs.every(sample_interval, sample, align=True)
+registry.schedule(jobs)
+if store is not log:
+    jobs.every(drain_interval, drain, delay=drain_interval)
+jobs.every(led_interval, showStatus)
+jobs.every(wifi_interval, connectWifi)
+if live is not None:
+    jobs.every(wifi_interval, startLive, delay=wifi_interval)
+jobs.every(clock_interval, syncClock, delay=15)  # give Wi-Fi a head start
+jobs.every(upload_interval, uploads.schedule, delay=upload_interval)
+if metrics_enabled:
+    jobs.every(telemetry_interval, publishTelemetry, delay=telemetry_interval)
+jobs.run()
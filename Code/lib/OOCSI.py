@@ -2,20 +2,61 @@
 # This software is released under the MIT License.
 # http://opensource.org/licenses/mit-license.php
 
+import array
 import os
+import sys
 import _thread
 import time
 import json
+import select
 import socket
 import random
-import ubinascii
+try:
+    import ubinascii
+except ImportError:
+    import binascii as ubinascii
 
 __author__ = 'matsfunk'
 
+# CPython's poll reports file descriptors, MicroPython's the socket objects
+_POLL_BY_FD = sys.implementation.name != 'micropython'
+# errno values of a non-blocking connect or send that has to wait
+_EINPROGRESS = (11, 115, 119)
+
+try:
+    _ticks_ms = time.ticks_ms
+    _ticks_add = time.ticks_add
+    _ticks_diff = time.ticks_diff
+except AttributeError:
+    def _ticks_ms():
+        return int(time.time() * 1000)
+
+    def _ticks_add(a, b):
+        return a + b
+
+    def _ticks_diff(a, b):
+        return a - b
+
+# Time spent handling incoming data, when the logger's metrics are around
+try:
+    import metrics
+    _LOOP = metrics.stage('oocsi_loop')
+    _DISCONNECTS = metrics.counter('oocsi_disconnects')
+except ImportError:
+    _LOOP = _DISCONNECTS = None
+
+# Longest a connection thread sleeps in poll(), so that pending calls are
+# expired in time even when nothing arrives
+_SWEEP_MS = 1000
+# Seconds a connection thread waits for the server to connect or take data
+# before it gives the connection up
+_TIMEOUT = 10
+
 
 class OOCSI:
 
-    def __init__(self, handle=None, host='localhost', port=4444, callback=None):
+    def __init__(self, handle=None, host='localhost', port=4444, callback=None, wait=True, bufferSize=4096, engine=None,
+                 maxDelay=0, maxBytes=1024, maxQueue=16384):
         if handle is None or len(handle.strip()) == 0:
             handle = "OOCSIClient_####"
         while "#" in handle:
@@ -27,39 +68,63 @@ class OOCSI:
         self.services = {}
         self.reconnect = True
         self.connected = False
+        self.bufferSize = bufferSize
+        self.engine = engine
+
+        # Outgoing lines are queued and written together once maxBytes are
+        # waiting or the oldest has waited maxDelay ms. With maxDelay 0 the
+        # sender writes right away (and blocks while the socket is full),
+        # otherwise only the connection thread or the engine writes and a
+        # send never waits for the network. More than maxQueue unsent bytes
+        # are refused then, and while not connected.
+        self.maxDelay = maxDelay
+        self.maxBytes = maxBytes
+        self.maxQueue = maxQueue
+        self.outbox = bytearray()
+        self.outpos = 0
+        self.queuedAt = 0
+        # sendLock guards the queue, writeLock keeps writes in order
+        self.sendLock = _thread.allocate_lock()
+        self.writeLock = _thread.allocate_lock()
 
         # Connect the socket to the port where the server is listening
         self.server_address = (host, port)
         self.log('connecting to %s port %s' % self.server_address)
 
+        if engine is not None:
+            # the engine connects us from its own loop, which might be the
+            # caller's, so never block here
+            engine.add(self)
+            return
+
         # start the connection thread
         _thread.start_new_thread(self.runOOCSIThread, ())
 
-        # block till we are connected
-        while not self.connected:
+        # block till we are connected, unless the caller checks self.connected
+        while wait and not self.connected:
             time.sleep(0.2)
 
     def init(self):
         try:
             # Create a TCP/IP socket
             self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock.settimeout(_TIMEOUT)
             self.sock.connect(self.server_address)
+            self.reader = LineReader(self.sock, self.bufferSize)
+            self.poller = select.poll()
+            self.poller.register(self.sock, select.POLLIN)
 
             try:
-                # Send data
-                message = self.handle + '(JSON)'
-                self.internalSend(message)
-
-                data = self.sock.recv(1024).decode()
-                if data.startswith('{'):
-                    self.log('connection established')
-                    # re-subscribe for channels
-                    for channelName in self.receivers:
-                        self.internalSend('subscribe {0}'.format(channelName))
-                    self.connected = True
-                elif data.startswith('error'):
-                    self.log(data)
-                    self.reconnect = False
+                # Send the handshake first, lines queued while we were not
+                # connected go out after it, from welcome()
+                message = self.handle + '(JSON)\n'
+                self.sock.sendall(message.encode())
+
+                line = None
+                while line is None and self.reader.fill():
+                    line = self.reader.readline()
+                if line is not None:
+                    self.welcome(line)
 
                 # run loop as long as we are connected
                 while self.connected:
@@ -69,14 +134,42 @@ class OOCSI:
                 pass
         except:
             pass
-
+        self.connected = False
+        try:
+            self.sock.close()
+        except:
+            pass
+        # the connection is gone and the responses with it
+        self.dropCalls()
+
+    def welcome(self, line):
+        # Handle the server's first line after the handshake
+        data = bytes(line).decode()
+        if data.startswith('{'):
+            self.log('connection established')
+            # re-subscribe for channels, even when the queue is full
+            for channelName in self.receivers:
+                if self.engine is not None:
+                    self.internalSend('subscribe {0}'.format(channelName))
+                else:
+                    with self.sendLock:
+                        self.outbox += 'subscribe {0}\n'.format(channelName).encode()
+            self.connected = True
+            self.flush()
+        elif data.startswith('error'):
+            self.log(data)
+            self.reconnect = False
 
     def runOOCSIThread(self):
         while self.reconnect:
             self.init()
             if self.reconnect:
                 self.log('re-connecting to OOCSI')
-                time.sleep(5)
+                # calls made meanwhile still expire on time
+                for _ in range(5000 // _SWEEP_MS):
+                    time.sleep(_SWEEP_MS / 1000)
+                    if self.calls:
+                        self.sweep()
 
         self.log('closing connection to OOCSI')
         _thread.exit()
@@ -91,25 +184,105 @@ class OOCSI:
         print('[{0}]: {1}'.format(self.handle, message))
 
     def internalSend(self, msg):
+        # Queue a protocol line, returns False if it was refused because the
+        # send queue is full. Lines queued while not connected go out once
+        # the connection is (re)established. Without an engine a send while
+        # connected blocks instead until the socket takes the data.
+        data = (msg + '\n').encode()
+        if self.engine is not None:
+            return self.engine.send(self, data)
+        with self.sendLock:
+            if ((not self.connected or self.maxDelay)
+                    and len(self.outbox) + len(data) > self.maxQueue):
+                return False
+            if not self.outbox:
+                self.queuedAt = _ticks_ms()
+            self.outbox += data
+        if self.connected and self.maxDelay == 0:
+            self.flush()
+        return True
+
+    def flush(self):
+        # Write all queued lines now
+        if self.engine is not None:
+            self.engine.flush(self)
+            return
+        with self.writeLock:
+            if not self.connected:
+                return
+            # take the queue, senders only wait for that and not the socket
+            with self.sendLock:
+                data = self.outbox
+                self.outbox = bytearray()
+            rest = self._write(data)
+            if rest:
+                with self.sendLock:
+                    self.outbox = rest + self.outbox
+                    self.queuedAt = _ticks_ms()
+
+    def _write(self, data):
+        # Write data, returns what the socket did not take (to send on the
+        # next connection), less a line it took only part of
+        sent = 0
         try:
-            self.sock.sendall((msg + '\n').encode())
-        except:
+            while sent < len(data):
+                sent += self.sock.send(memoryview(data)[sent:])
+        except OSError as e:
             self.connected = False
+            if sent and data[sent - 1] != 10:
+                while sent < len(data) and data[sent] != 10:
+                    sent += 1
+                sent += 1
+            self.log('send failed, {0} bytes kept for the next connection: {1}'.format(
+                max(0, len(data) - sent), e))
+        return data[sent:]
 
     def loop(self):
+        # wake up in time to write out queued lines and to expire calls
+        if self.outbox and (len(self.outbox) >= self.maxBytes
+                            or _ticks_diff(_ticks_ms(), self.queuedAt) >= self.maxDelay):
+            self.flush()
+        if self.calls:
+            self.sweep()
+        if not self.poller.poll(self.maxDelay or _SWEEP_MS):
+            return
+        t = _LOOP.start() if _LOOP else 0
         try:
-            data = self.sock.recv(2 * 1024).decode()
-            lines = data.split("\n")
-            for line in lines:
-                if len(data) == 0:
-                    self.sock.close()
-                    self.connected = False
-                elif line.startswith('ping') or line.startswith('.'):
-                    self.internalSend('.')
-                elif line.startswith('{'):
-                    self.receive(json.loads(line))
-        except:
-            pass
+            if self.reader.fill() == 0:
+                self.sock.close()
+                self.connected = False
+        except OSError:
+            self.connected = False
+        if self.connected:
+            self.processLines()
+        elif _DISCONNECTS:
+            _DISCONNECTS.add()
+        if _LOOP:
+            _LOOP.stop(t)
+
+    def processLines(self):
+        # Handle all complete lines waiting in the reader
+        while True:
+            line = self.reader.readline()
+            if line is None:
+                break
+            if len(line) == 0:
+                continue
+            c = line[0]
+            if c == 46 or (c == 112 and bytes(line[:4]) == b'ping'):
+                # '.' or 'ping'
+                self.internalSend('.')
+            elif c == 123:
+                # '{', a JSON message
+                try:
+                    event = json.loads(bytes(line))
+                except ValueError:
+                    self.log('dropped malformed message')
+                    continue
+                try:
+                    self.receive(event)
+                except Exception as e:
+                    self.log('error handling message: {0}'.format(e))
 
     def receive(self, event):
         sender = event['sender']
@@ -131,15 +304,10 @@ class OOCSI:
 
         else:
             if '_MESSAGE_ID' in event:
-                myCall = self.calls[event['_MESSAGE_ID']]
-                if myCall['expiration'] > time.time():
-                    response = self.calls[event['_MESSAGE_ID']]
-                    response['response'] = event
-                    del response['expiration']
-                    del response['_MESSAGE_ID']
-                    del response['response']['_MESSAGE_ID']
-                else:
-                    del self.calls[event['_MESSAGE_ID']]
+                call = self.calls.pop(event['_MESSAGE_ID'], None)
+                if call is not None:
+                    del event['_MESSAGE_ID']
+                    call.complete(event if not call.expired() else None)
 
             else:
                 self.receiveChannelEvent(sender, recipient, event)
@@ -150,24 +318,44 @@ class OOCSI:
                 x(sender, recipient, event)
 
     def send(self, channelName, data):
-        self.internalSend('sendraw {0} {1}'.format(channelName, json.dumps(data)))
+        return self.internalSend('sendraw {0} {1}'.format(channelName, json.dumps(data)))
 
     def call(self, channelName, callName, data, timeout=1):
+        # Returns an OOCSICall that is completed as soon as the response
+        # arrives, or with no response once the timeout has passed
+        call = OOCSICall(self, callName, timeout)
         data['_MESSAGE_HANDLE'] = callName
-        data['_MESSAGE_ID'] = self.uuid4()
-        self.calls[data['_MESSAGE_ID']] = {'_MESSAGE_HANDLE': callName, '_MESSAGE_ID': data['_MESSAGE_ID'], 'expiration': time.time() + timeout}
+        data['_MESSAGE_ID'] = call.uuid
+        self.calls[call.uuid] = call
         self.send(channelName, data)
-        return self.calls[data['_MESSAGE_ID']]
+        return call
 
     def callAndWait(self, channelName, callName, data, timeout=1):
+        # Blocks the calling thread; not from inside a callback or the
+        # engine's own loop, which are what deliver the response
         call = self.call(channelName, callName, data, timeout)
-        expiration = time.time() + timeout
-        while time.time() < expiration:
-            time.sleep(0.1)
-    if 'response' in call:
-        break
+        call.wait(timeout)
+        return call
 
-    return call
+    async def callAndWaitAsync(self, channelName, callName, data, timeout=1):
+        call = self.call(channelName, callName, data, timeout)
+        await call.result()
+        return call
+
+    def sweep(self):
+        # Expire calls whose response did not arrive in time
+        for uuid, call in list(self.calls.items()):
+            if call.expired():
+                self.calls.pop(uuid, None)
+                call.complete(None)
+
+    def dropCalls(self):
+        # Complete the pending calls without a response, for when the
+        # connection they were sent over is lost
+        calls = self.calls
+        self.calls = {}
+        for call in calls.values():
+            call.complete(None)
 
     def register(self, channelName, callName, callback):
         self.services[callName] = callback
@@ -193,7 +381,13 @@ class OOCSI:
     def stop(self):
         self.reconnect = False
         self.internalSend('quit')
-        self.sock.close()
+        if self.engine is not None:
+            self.engine.remove(self)
+            return
+        if self.connected:
+            self.flush()
+        if getattr(self, 'sock', None) is not None:
+            self.sock.close()
         self.connected = False
 
     def handleEvent(self, sender, receiver, message):
@@ -217,92 +411,481 @@ class OOCSI:
             return (OOCSIDevice(self, custom_name))
 
 
+class OOCSIEngine:
+    # Drives any number of OOCSI connections from one loop with select.poll
+    # and non-blocking sockets, instead of a thread per connection. Create
+    # clients with OOCSI(..., engine=engine), then call run(), or poll() from
+    # a loop of your own. Works on MicroPython and CPython. The engine is not
+    # thread safe, send through its clients from the thread that polls it.
+    # stop() is the exception: it only sets a flag, run() then stops all
+    # clients from its own thread after the current poll.
+
+    def __init__(self, reconnectDelay=5):
+        self.poller = select.poll()
+        self.clients = {}
+        self.retries = []
+        self.delayed = []
+        self.reconnectDelay = reconnectDelay
+        self.stopping = False
+
+    def _key(self, sock):
+        return sock.fileno() if _POLL_BY_FD else sock
+
+    def add(self, client):
+        client.connected = False
+        client.handshaking = True
+        if len(client.outbox) > client.outpos:
+            client.log('dropped {0} unsent bytes'.format(len(client.outbox) - client.outpos))
+        client.outbox = bytearray((client.handle + '(JSON)\n').encode())
+        client.outpos = 0
+        client.writing = True
+        if client in self.delayed:
+            self.delayed.remove(client)
+        try:
+            addr = socket.getaddrinfo(client.server_address[0], client.server_address[1])[0][-1]
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        except OSError as e:
+            client.log('connection failed: {0}'.format(e))
+            self._retry(client)
+            return
+        sock.setblocking(False)
+        client.sock = sock
+        client.reader = LineReader(sock, client.bufferSize)
+        self.clients[self._key(sock)] = client
+        self.poller.register(sock, select.POLLIN | select.POLLOUT)
+        try:
+            sock.connect(addr)
+        except OSError as e:
+            if e.args[0] not in _EINPROGRESS:
+                self._close(client)
+
+    def remove(self, client):
+        client.reconnect = False
+        if client in self.retries:
+            self.retries.remove(client)
+        if client in self.delayed:
+            self.delayed.remove(client)
+        if getattr(client, 'sock', None) is None:
+            return
+        # push out what is still queued (the 'quit') if the socket takes it
+        self._write(client)
+        if client.sock is not None:
+            self._close(client)
+
+    def send(self, client, data):
+        waiting = len(client.outbox) - client.outpos
+        if waiting + len(data) > client.maxQueue:
+            # the socket does not keep up, push back on the sender
+            return False
+        if waiting == 0:
+            client.queuedAt = _ticks_ms()
+        client.outbox += data
+        if client.writing or client.handshaking:
+            return True
+        if client.maxDelay == 0 or waiting + len(data) >= client.maxBytes:
+            self._wantWrite(client)
+        elif client not in self.delayed:
+            self.delayed.append(client)
+        return True
+
+    def flush(self, client):
+        if client.sock is not None and not client.handshaking:
+            self._wantWrite(client)
+            self._write(client)
+
+    def _wantWrite(self, client):
+        if client in self.delayed:
+            self.delayed.remove(client)
+        if not client.writing and client.sock is not None:
+            client.writing = True
+            self.poller.modify(client.sock, select.POLLIN | select.POLLOUT)
+
+    def _write(self, client):
+        if client.sock is None:
+            return
+        if client.outpos < len(client.outbox):
+            try:
+                client.outpos += client.sock.send(memoryview(client.outbox)[client.outpos:])
+            except OSError as e:
+                if e.args[0] not in _EINPROGRESS:
+                    self._close(client)
+                return
+        if client.outpos == len(client.outbox):
+            client.outbox = bytearray()
+            client.outpos = 0
+            client.writing = False
+            self.poller.modify(client.sock, select.POLLIN)
+
+    def _read(self, client):
+        try:
+            n = client.reader.fill()
+        except OSError as e:
+            if e.args[0] not in _EINPROGRESS:
+                self._close(client)
+            return
+        if n == 0:
+            self._close(client)
+            return
+        if client.handshaking:
+            line = client.reader.readline()
+            if line is None:
+                return
+            client.handshaking = False
+            client.welcome(line)
+            if not client.connected:
+                self._close(client)
+                return
+        client.processLines()
+
+    def _close(self, client):
+        if client in self.delayed:
+            self.delayed.remove(client)
+        sock = client.sock
+        client.sock = None
+        client.connected = False
+        key = self._key(sock)
+        if key in self.clients:
+            del self.clients[key]
+            self.poller.unregister(sock)
+        sock.close()
+        client.dropCalls()
+        self._retry(client)
+
+    def _retry(self, client):
+        if client.reconnect:
+            client.retryAt = time.time() + self.reconnectDelay
+            self.retries.append(client)
+
+    def poll(self, timeout=1000):
+        # Handle whatever is ready within timeout milliseconds
+        if self.delayed:
+            now = _ticks_ms()
+            for client in self.delayed:
+                wait = max(0, client.maxDelay - _ticks_diff(now, client.queuedAt))
+                if timeout < 0 or wait < timeout:
+                    timeout = wait
+        for event in self.poller.poll(timeout):
+            client = self.clients.get(event[0])
+            if client is None:
+                continue
+            flags = event[1]
+            if flags & select.POLLOUT:
+                self._write(client)
+            if flags & select.POLLIN and client.sock is not None:
+                self._read(client)
+            elif flags & (select.POLLERR | select.POLLHUP) and client.sock is not None:
+                self._close(client)
+
+        for client in self.clients.values():
+            if client.calls:
+                client.sweep()
+        for client in self.retries:
+            # not connected, but calls made meanwhile still expire
+            if client.calls:
+                client.sweep()
+
+        if self.delayed:
+            now = _ticks_ms()
+            for client in [c for c in self.delayed if _ticks_diff(now, c.queuedAt) >= c.maxDelay]:
+                self._wantWrite(client)
+
+        if self.retries:
+            now = time.time()
+            for client in [c for c in self.retries if c.retryAt <= now]:
+                self.retries.remove(client)
+                client.log('re-connecting to OOCSI')
+                self.add(client)
+
+    def run(self):
+        while (self.clients or self.retries) and not self.stopping:
+            self.poll()
+        if self.stopping:
+            for client in list(self.clients.values()) + self.retries:
+                client.stop()
+
+    def stop(self):
+        self.stopping = True
+
+
+class LineReader:
+    # Splits the socket stream into lines. Data is received straight into a
+    # preallocated buffer, a line that straddles two reads is kept until it
+    # is complete, and readline() returns a memoryview into the buffer, valid
+    # until the next fill().
+
+    def __init__(self, sock, size=4096):
+        self.sock = sock
+        self.buf = bytearray(size)
+        self.mv = memoryview(self.buf)
+        self.start = 0
+        self.end = 0
+        self.scanned = 0
+        self.skipping = False
+        self._recv_into = getattr(sock, 'recv_into', None)
+        self._find = getattr(self.buf, 'find', None)
+
+    def fill(self):
+        # Receive more data, returns the number of bytes read (0 when closed)
+        if self.start == self.end:
+            self.start = self.end = self.scanned = 0
+        elif self.end == len(self.buf):
+            if self.start == 0:
+                # a line longer than the buffer, drop it
+                self.skipping = True
+                self.start = self.end = self.scanned = 0
+            else:
+                n = self.end - self.start
+                self.mv[:n] = self.mv[self.start:self.end]
+                self.scanned -= self.start
+                self.start, self.end = 0, n
+        if self._recv_into is not None:
+            n = self._recv_into(self.mv[self.end:])
+        else:
+            data = self.sock.recv(len(self.buf) - self.end)
+            n = len(data)
+            self.mv[self.end:self.end + n] = data
+        self.end += n
+        return n
+
+    def readline(self):
+        # Next complete line without the newline, or None
+        buf = self.buf
+        while True:
+            i = self.scanned
+            end = self.end
+            if self._find is not None:
+                i = self._find(b'\n', i, end)
+                if i < 0:
+                    i = end
+            else:
+                while i < end and buf[i] != 10:
+                    i += 1
+            if i == end:
+                self.scanned = end
+                return None
+            line = self.mv[self.start:i]
+            self.start = self.scanned = i + 1
+            if self.skipping:
+                # rest of an overlong line
+                self.skipping = False
+                continue
+            return line
+
+
 class OOCSICall:
-    def __init__(self, parent=None):
+    # A pending call. wait() blocks a thread and result() suspends an asyncio
+    # task until complete() is called with the response, or with None when
+    # the call expired. For compatibility with the old dict based calls,
+    # 'response' in call and call['response'] work as well.
+
+    def __init__(self, parent, callName, timeout=1):
         self.uuid = parent.uuid4()
-        self.expiration = time.time()
+        self.callName = callName
+        self.deadline = _ticks_add(_ticks_ms(), int(timeout * 1000))
+        self.response = None
+        self.done = False
+        self._lock = _thread.allocate_lock()
+        self._lock.acquire()
+        self._flag = None
+        self._future = None
+
+    def expired(self):
+        return _ticks_diff(_ticks_ms(), self.deadline) >= 0
+
+    def complete(self, response):
+        if self.done:
+            return
+        self.response = response
+        self.done = True
+        self._lock.release()
+        if self._flag is not None:
+            self._flag.set()
+        if self._future is not None:
+            self._loop.call_soon_threadsafe(self._resolve)
+
+    def _resolve(self):
+        if not self._future.done():
+            self._future.set_result(None)
+
+    def wait(self, timeout=None):
+        # MicroPython ignores the timeout, the sweep releases us instead
+        if not self.done:
+            if timeout is None:
+                self._lock.acquire()
+                self._lock.release()
+            elif self._lock.acquire(1, timeout):
+                self._lock.release()
+        return self.response
+
+    async def result(self):
+        try:
+            import asyncio
+        except ImportError:
+            import uasyncio as asyncio
+        if not self.done:
+            if hasattr(asyncio, 'ThreadSafeFlag'):
+                self._flag = asyncio.ThreadSafeFlag()
+                if not self.done:
+                    await self._flag.wait()
+            else:
+                self._loop = asyncio.get_running_loop()
+                self._future = self._loop.create_future()
+                if not self.done:
+                    await self._future
+        return self.response
+
+    def __contains__(self, key):
+        return key == 'response' and self.response is not None
+
+    def __getitem__(self, key):
+        if key == 'response' and self.response is not None:
+            return self.response
+        raise KeyError(key)
+
+
+class RingBuffer:
+    # Fixed-capacity window of floats in an array. The running sum and sum of
+    # squares make the mean and variance O(1) however long the window is;
+    # they are recomputed once per lap to cancel rounding drift.
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.data = array.array('f', [0.0] * capacity)
+        self.count = 0
+        self.index = 0
+        self.sum = 0.0
+        self.sumsq = 0.0
+
+    def append(self, value):
+        if self.count == self.capacity:
+            old = self.data[self.index]
+            self.sum -= old
+            self.sumsq -= old * old
+        else:
+            self.count += 1
+        self.data[self.index] = value
+        self.sum += value
+        self.sumsq += value * value
+        self.index += 1
+        if self.index == self.capacity:
+            self.index = 0
+            self.sum = sum(self.data)
+            self.sumsq = sum(v * v for v in self.data)
+
+    def mean(self):
+        return self.sum / self.count if self.count else None
+
+    def variance(self):
+        if self.count == 0:
+            return None
+        mean = self.sum / self.count
+        return max(0.0, self.sumsq / self.count - mean * mean)
+
+    def median(self):
+        if self.count == 0:
+            return None
+        values = sorted(self.data[:self.count])
+        middle = self.count // 2
+        if self.count % 2:
+            return values[middle]
+        return (values[middle - 1] + values[middle]) / 2
 
 
 class OOCSIVariable:
+    # A value shared over a channel. Without smoothing get() returns the last
+    # value; smooth() (moving mean), median() and ewma() filter it instead.
+    # The filtered value is updated once per incoming value, get() is O(1).
+
     def __init__(self, oocsi, channelName, key):
         self.key = key
         self.channel = channelName
         oocsi.subscribe(channelName, self.internalReceiveValue)
         self.oocsi = oocsi
         self.value = None
+        self.mode = None
         self.windowLength = 0
-        self.values = []
+        self.buffer = None
+        self.alpha = None
         self.minvalue = None
         self.maxvalue = None
         self.sigma = None
 
     def get(self):
-        if self.windowLength > 0 and len(self.values) > 0:
-            return fsum(self.values)/float(len(self.values))
-        else:
-            return self.value
+        return self.value
+
+    def variance(self):
+        return self.buffer.variance() if self.buffer is not None else None
 
     def set(self, value):
-        tempvalue = value
-        if self.minvalue is not None and tempvalue < self.minvalue:
-            tempvalue = self.minvalue
-        elif self.maxvalue is not None and tempvalue > self.maxvalue:
-            tempvalue = self.maxvalue
-        elif self.sigma is not None:
-            mean = self.get()
-            if mean is not None:
-                if abs(mean - tempvalue) > self.sigma:
-                    if mean - tempvalue > 0:
-                        tempvalue = mean - self.sigma/float(len(self.values))
-                    else:
-                        tempvalue = mean + self.sigma/float(len(self.values))
-
-        if self.windowLength > 0:
-            self.values.append(tempvalue)
-            self.values = self.values[-self.windowLength:]
-        else:
-            self.value = tempvalue
+        self.update(value)
         self.oocsi.send(self.channel, {self.key: value})
 
     def internalReceiveValue(self, sender, recipient, data):
         if self.key in data:
-            tempvalue = data[self.key]
-            if self.minvalue is not None and tempvalue < self.minvalue:
-                tempvalue = self.minvalue
-            elif self.maxvalue is not None and tempvalue > self.maxvalue:
-                tempvalue = self.maxvalue
-            elif self.sigma is not None:
-                mean = self.get()
-                if mean is not None:
-                    if abs(mean - tempvalue) > self.sigma:
-                        if mean - tempvalue > 0:
-                            tempvalue = mean - self.sigma/float(len(self.values))
-                        else:
-                            tempvalue = mean + self.sigma/float(len(self.values))
-
-            if self.windowLength > 0:
-                self.values.append(tempvalue)
-                self.values = self.values[-self.windowLength:]
+            self.update(data[self.key])
+
+    def update(self, value):
+        # Clamp to min/max, or pull outliers further than sigma from the
+        # current value towards it, then feed the filter
+        if self.minvalue is not None and value < self.minvalue:
+            value = self.minvalue
+        elif self.maxvalue is not None and value > self.maxvalue:
+            value = self.maxvalue
+        elif self.sigma is not None and self.value is not None:
+            mean = self.value
+            if abs(mean - value) > self.sigma:
+                count = self.buffer.count if self.buffer is not None else 1
+                if mean - value > 0:
+                    value = mean - self.sigma / float(count)
+                else:
+                    value = mean + self.sigma / float(count)
+
+        if self.mode == 'mean':
+            self.buffer.append(value)
+            self.value = self.buffer.mean()
+        elif self.mode == 'median':
+            self.buffer.append(value)
+            self.value = self.buffer.median()
+        elif self.mode == 'ewma':
+            self.buffer.append(value)
+            if self.value is None:
+                self.value = value
             else:
-                self.value = tempvalue
+                self.value += self.alpha * (value - self.value)
+        else:
+            self.value = value
 
     def min(self, minvalue):
         self.minvalue = minvalue
-        if self.value < self.minvalue:
+        if self.value is not None and self.value < self.minvalue:
             self.value = self.minvalue
         return self
 
     def max(self, maxvalue):
         self.maxvalue = maxvalue
-        if self.value > self.maxvalue:
+        if self.value is not None and self.value > self.maxvalue:
             self.value = self.maxvalue
         return self
 
-    def smooth(self, windowLength, sigma=None):
+    def _window(self, mode, windowLength, sigma):
+        self.mode = mode
         self.windowLength = windowLength
+        self.buffer = RingBuffer(windowLength)
         self.sigma = sigma
+        self.value = None
         return self
 
+    def smooth(self, windowLength, sigma=None):
+        return self._window('mean', windowLength, sigma)
+
+    def median(self, windowLength, sigma=None):
+        return self._window('median', windowLength, sigma)
+
+    def ewma(self, alpha, windowLength=16, sigma=None):
+        # windowLength only bounds the variance estimate
+        self.alpha = alpha
+        return self._window('ewma', windowLength, sigma)
+
 
 class OOCSIDevice:
     def __init__(self, OOCSI, device_name: str) -> None:
@@ -0,0 +1,96 @@
+# Windowed aggregation of samples before they are stored
+#---------------------------------------------------------------------------
+# Samples are folded into streaming min/max/mean/count statistics per time
+# window (aligned to multiples of the window length). A window produces one
+# row when the first sample of the next window arrives. Rows have the
+# columns
+#
+#   <field>_mean, <field>_min, <field>_max for every field, count, window
+#
+# where window is the window length in seconds. With a threshold for a
+# field, a sample that jumps more than that from the previous one is also
+# passed through as a row of its own with window 0 and count 1.
+#
+# scales holds the storage scale of every field (see sensors.Sensor), the
+# three columns of a field share it.
+#
+# A missing value (None) is left out of its field's statistics, count still
+# counts the samples. A field without any value in a window is None in all
+# three columns.
+
+
+class Aggregator:
+    def __init__(self, fields, windows=(60,), threshold=None, scales=None):
+        for window in windows:
+            if not 0 < window < 32768:
+                raise ValueError("window must be 1..32767 seconds")
+        self.fields = tuple(fields)
+        self.windows = tuple(windows)
+        self.threshold = threshold or {}
+        self.columns = []
+        for field in self.fields:
+            self.columns += [field + "_mean", field + "_min", field + "_max"]
+        self.columns += ["count", "window"]
+        # mean, min and max keep the scale of their field
+        self.scales = []
+        for scale in scales or (10,) * len(self.fields):
+            self.scales += [scale, scale, scale]
+        self.scales += [1, 1]
+        self._start = [None] * len(self.windows)
+        self._count = [0] * len(self.windows)
+        self._min = [[0] * len(self.fields) for _ in self.windows]
+        self._max = [[0] * len(self.fields) for _ in self.windows]
+        self._sum = [[0] * len(self.fields) for _ in self.windows]
+        self._n = [[0] * len(self.fields) for _ in self.windows]
+        self._last = None
+
+    def add(self, seconds, values):
+        # Fold in one sample, returns a list of (seconds, row) to store
+        rows = []
+        if self._last is not None and self.threshold:
+            for i, field in enumerate(self.fields):
+                if (field in self.threshold and values[i] is not None and self._last[i] is not None
+                        and abs(values[i] - self._last[i]) > self.threshold[field]):
+                    rows.append((seconds, self._raw(values)))
+                    break
+        self._last = values
+
+        for w, window in enumerate(self.windows):
+            start = seconds - seconds % window
+            if self._start[w] is not None and start != self._start[w]:
+                rows.append((self._start[w], self._row(w, window)))
+                self._count[w] = 0
+            n = self._n[w]
+            if self._count[w] == 0:
+                self._start[w] = start
+                for i in range(len(n)):
+                    n[i] = 0
+            for i, v in enumerate(values):
+                if v is None:
+                    continue
+                if n[i] == 0:
+                    self._min[w][i] = self._max[w][i] = self._sum[w][i] = v
+                else:
+                    if v < self._min[w][i]:
+                        self._min[w][i] = v
+                    elif v > self._max[w][i]:
+                        self._max[w][i] = v
+                    self._sum[w][i] += v
+                n[i] += 1
+            self._count[w] += 1
+        return rows
+
+    def _row(self, w, window):
+        row = []
+        for i, n in enumerate(self._n[w]):
+            if n:
+                row += [self._sum[w][i] / n, self._min[w][i], self._max[w][i]]
+            else:
+                row += [None, None, None]
+        return row + [self._count[w], window]
+
+    def _raw(self, values):
+        row = []
+        for v in values:
+            row += [v, v, v]
+        return row + [1, 0]
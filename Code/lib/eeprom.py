@@ -0,0 +1,214 @@
+import _thread
+import struct
+import utime
+import metrics
+from samplelog import Records, scaled
+
+_OVERWRITTEN = metrics.counter("eeprom_overwritten")
+
+
+class AT24C32:
+    # The 4 KiB EEPROM on DS3231 breakout boards, at 0x57 when A0-A2 are
+    # left open. Writes are split on page boundaries, a page write takes up
+    # to 10 ms during which the chip does not answer.
+    def __init__(self, i2c, address=0x57, size=4096, page=32):
+        self.i2c = i2c
+        self.address = address
+        self.size = size
+        self.page = page
+        self.page_writes = 0
+
+    def readinto(self, address, buf):
+        self.i2c.readfrom_mem_into(self.address, address, buf, addrsize=16)
+
+    def write(self, address, data):
+        mv = memoryview(data)
+        while len(mv):
+            n = min(len(mv), self.page - address % self.page)
+            self.i2c.writeto_mem(self.address, address, mv[:n], addrsize=16)
+            self.page_writes += 1
+            self._wait()
+            address += n
+            mv = mv[n:]
+
+    def _wait(self):
+        # Poll until the chip acknowledges again, the write cycle is done
+        for _ in range(20):
+            try:
+                self.i2c.writeto(self.address, b"")
+                return
+            except OSError:
+                utime.sleep_ms(1)
+        raise OSError("EEPROM write timed out")
+
+
+# Sample ring buffer in the EEPROM
+#---------------------------------------------------------------------------
+# The same fixed-width records as SampleLog, in a circular buffer. Pages 0
+# and 1 each hold a copy of the pointers, written in turn:
+#
+#   magic "ERB2", schema checksum (H), record size (H), head (I), tail (I),
+#   checksum (H)
+#
+# head counts the records written since the buffer was created, tail (kept
+# as `uploaded`, like in SampleLog) those drained or uploaded. The checksums
+# are CRC-16s; unlike a sum modulo 255 they tell 0x00 from 0xFF, what an
+# erased byte reads as. On start the valid copy with the most progress
+# wins, so a power loss while one is written falls back to the other. A
+# copy with more records waiting than the buffer holds is never valid. The records follow from page 2 on; when
+# the buffer is full the oldest are overwritten.
+#
+# Appends are kept in RAM and written together, after `buffer` records or
+# when the oldest waiting one is `max_age` seconds older than the newest.
+# The log can be uploaded directly (uploader.upload_log), or drain() moves
+# its records in bulk into a SampleLog on flash. Draining and appending may
+# run in different threads.
+
+_MAGIC = b"ERB2"
+_SLOT = "<4sHHIIH"
+_SLOT_SIZE = 18
+
+
+def _checksum(data):
+    # CRC-16/CCITT-FALSE
+    crc = 0xFFFF
+    for byte in data:
+        crc ^= byte << 8
+        for _ in range(8):
+            crc = (crc << 1) ^ 0x1021 if crc & 0x8000 else crc << 1
+        crc &= 0xFFFF
+    return crc
+
+
+class EEPROMLog(Records):
+    def __init__(self, eeprom, fields, scales=None, buffer=4, max_age=300):
+        self.eeprom = eeprom
+        self.fields = tuple(fields)
+        self.scales = tuple(scales) if scales else (1,) * len(self.fields)
+        self.record_size = 4 + 2 * len(self.fields)
+        self._format = "<I" + "h" * len(self.fields)
+        self._schema = _checksum(",".join("{}/{}".format(f, s) for f, s in zip(self.fields, self.scales)).encode())
+        self._data = 2 * eeprom.page
+        self.capacity = (eeprom.size - self._data) // self.record_size
+        self.max_age = max_age
+        self._buffer = bytearray(self.record_size * buffer)
+        self._buffered = 0
+        self._first = 0
+        self._slot = bytearray(_SLOT_SIZE)
+        self._next = 0
+        self._lock = _thread.allocate_lock()
+        self._draining = _thread.allocate_lock()
+        if not self._load():
+            print('*** EEPROM: starting a new sample buffer')
+            self.head = self.uploaded = 0
+            self._save()
+            self._save()
+
+    def _load(self):
+        best = None
+        for slot in range(2):
+            self.eeprom.readinto(slot * self.eeprom.page, self._slot)
+            magic, schema, record_size, head, tail, check = struct.unpack(_SLOT, self._slot)
+            if (magic != _MAGIC or check != _checksum(memoryview(self._slot)[:_SLOT_SIZE - 2])
+                    or schema != self._schema or record_size != self.record_size or tail > head
+                    or head - tail > self.capacity):
+                continue
+            if best is None or head + tail > best[0] + best[1]:
+                best = (head, tail, slot)
+        if best is None:
+            return False
+        self.head, self.uploaded, slot = best
+        self._next = 1 - slot
+        return True
+
+    def _save(self):
+        # Write the pointers into the older copy
+        struct.pack_into(_SLOT, self._slot, 0, _MAGIC, self._schema, self.record_size, self.head, self.uploaded, 0)
+        struct.pack_into("<H", self._slot, _SLOT_SIZE - 2, _checksum(memoryview(self._slot)[:_SLOT_SIZE - 2]))
+        self.eeprom.write(self._next * self.eeprom.page, self._slot)
+        self._next = 1 - self._next
+
+    def _address(self, index):
+        return self._data + (index % self.capacity) * self.record_size
+
+    def append(self, seconds, values):
+        with self._lock:
+            if self._buffered == 0:
+                self._first = seconds
+            args = [seconds]
+            for v, scale in zip(values, self.scales):
+                args.append(scaled(v, scale))
+            struct.pack_into(self._format, self._buffer, self._buffered * self.record_size, *args)
+            self._buffered += 1
+            if (self._buffered * self.record_size == len(self._buffer)
+                    or seconds - self._first >= self.max_age):
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        self.flush()
+
+    def _flush(self):
+        if self._buffered == 0:
+            return
+        mv = memoryview(self._buffer)
+        index = self.head
+        remaining = self._buffered
+        while remaining:
+            # up to the end of the ring in one write
+            n = min(remaining, self.capacity - index % self.capacity)
+            start = (index - self.head) * self.record_size
+            self.eeprom.write(self._address(index), mv[start:start + n * self.record_size])
+            index += n
+            remaining -= n
+        self.head = index
+        self._buffered = 0
+        if self.head - self.uploaded > self.capacity:
+            _OVERWRITTEN.add(self.head - self.uploaded - self.capacity)
+            self.uploaded = self.head - self.capacity
+        self._save()
+
+    def count(self):
+        return self.head + self._buffered
+
+    def pending(self):
+        return self.count() - self.uploaded
+
+    def acknowledge(self, index):
+        # Mark all records before index as uploaded or drained
+        with self._lock:
+            self.uploaded = max(self.uploaded, min(index, self.head))
+            self._save()
+
+    def compact(self):
+        pass
+
+    def drain(self, log):
+        # Move the waiting records into another log, e.g. the SampleLog on
+        # flash, in one go. Returns the number of records moved
+        with self._draining:
+            self.flush()
+            start, end = self.uploaded, self.head
+            if start == end:
+                return 0
+            for seconds, values in self.records(start, end):
+                log.append(seconds, values)
+            log.flush()
+            self.acknowledge(end)
+            return end - start
+
+    def _read(self, start, end, batch=8):
+        # Yield the raw record tuples start..end-1, read in batches that do
+        # not cross the end of the ring
+        self.flush()
+        buf = bytearray(self.record_size * batch)
+        mv = memoryview(buf)
+        while start < end:
+            n = min(batch, end - start, self.capacity - start % self.capacity)
+            self.eeprom.readinto(self._address(start), mv[:n * self.record_size])
+            for i in range(n):
+                yield struct.unpack_from(self._format, buf, i * self.record_size)
+            start += n
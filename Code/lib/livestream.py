@@ -0,0 +1,92 @@
+import utime
+import metrics
+
+_DROPPED = metrics.counter("live_dropped")
+_SENT = metrics.counter("live_sent")
+
+# Sensor types of the device description, matched in the field names
+SENSOR_TYPES = ("temperature", "humidity", "pressure", "illuminance", "co2")
+
+# Live samples over OOCSI
+#---------------------------------------------------------------------------
+# Every sample (or aggregate row) given to publish() goes out on `channel`
+# as one message:
+#
+#   {"ts": "2024-5-1T12:0:5", "humidity": 43, "temperature": 22, ...}
+#
+# with the time as in the uploaded CSV; OOCSI itself sets "timestamp" to
+# when the server passed the message on.
+# The fields are announced as sensors of an OOCSIDevice (heyOOCSI!) with
+# the channel, unit and, where the field name tells, a sensor type, so
+# dashboards can find them. That happens again on every new connection.
+#
+# Messages wait in a backlog of at most `backlog` entries and leave it in
+# order while the OOCSI client is connected; the client is set as `oocsi`
+# once there is one. While it is not connected the backlog keeps the newest
+# messages and drops the oldest, counted as live_dropped. Nothing is lost
+# for good that way, every sample is in the log on flash as well.
+
+
+class LiveStream:
+    def __init__(self, channel, fields, units, device_name, backlog=120):
+        self.channel = channel
+        self.fields = tuple(fields)
+        self.units = tuple(units)
+        self.device_name = device_name
+        self.oocsi = None
+        self._backlog = [None] * backlog
+        self._start = 0
+        self._count = 0
+        self._announced = None
+
+    def pending(self):
+        return self._count
+
+    def publish(self, seconds, values):
+        t = utime.localtime(seconds)
+        message = {"ts": "{}-{}-{}T{}:{}:{}".format(t[0], t[1], t[2], t[3], t[4], t[5])}
+        for field, value in zip(self.fields, values):
+            message[field] = value
+        size = len(self._backlog)
+        if self._count == size:
+            # full, make room by dropping the oldest
+            self._start = (self._start + 1) % size
+            self._count -= 1
+            _DROPPED.add()
+        self._backlog[(self._start + self._count) % size] = message
+        self._count += 1
+        return self.flush()
+
+    def flush(self):
+        # Send the waiting messages, oldest first, returns how many went out
+        oocsi = self.oocsi
+        if oocsi is None or not oocsi.connected:
+            return 0
+        if self._announced is not oocsi.sock:
+            self._announce()
+        size = len(self._backlog)
+        sent = 0
+        while self._count:
+            # a message stays until the client took it while connected, a
+            # send that broke the connection is repeated on the next one
+            if not oocsi.send(self.channel, self._backlog[self._start]) or not oocsi.connected:
+                break
+            self._backlog[self._start] = None
+            self._start = (self._start + 1) % size
+            self._count -= 1
+            sent += 1
+        _SENT.add(sent)
+        return sent
+
+    def _announce(self):
+        from oocsi import OOCSIDevice
+        device = OOCSIDevice(self.oocsi, self.device_name)
+        for field, unit in zip(self.fields, self.units):
+            kind = None
+            for name in SENSOR_TYPES:
+                if name in field:
+                    kind = name
+                    break
+            device.addSensor(field, self.channel, kind, unit, 0)
+        device.submit()
+        self._announced = self.oocsi.sock
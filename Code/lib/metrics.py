@@ -0,0 +1,143 @@
+import array
+import gc
+import utime
+
+# Instrumentation
+#---------------------------------------------------------------------------
+# Stage timers, error counters and the heap low-water mark. Stages and
+# counters are registered once by name and kept, timing a stage is
+#
+#   SAMPLE = metrics.stage("sample")
+#   ...
+#   t = SAMPLE.start()
+#   ...
+#   SAMPLE.stop(t)
+#
+# Every stage keeps its count, total and maximum time in microseconds and a
+# histogram with fixed buckets (bounds below). Nothing allocates in start(),
+# stop() or add(), and while disabled they return right away.
+#
+# The heap marks are only taken where heap() is called, once per sample and
+# after an upload in boot.py and in summary(), not on every stage stop.
+
+# Upper bounds of the histogram buckets in microseconds, the last bucket
+# holds everything slower
+BOUNDS = (100, 300, 1000, 3000, 10000, 30000, 100000, 300000, 1000000, 3000000)
+
+enabled = False
+_stages = {}
+_counters = {}
+_heap = [None, None]    # lowest gc.mem_free(), highest gc.mem_alloc()
+
+
+def enable(on=True):
+    global enabled
+    enabled = on
+
+
+class Stage:
+    def __init__(self, name):
+        self.name = name
+        self.buckets = array.array("L", [0] * (len(BOUNDS) + 1))
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        for i in range(len(self.buckets)):
+            self.buckets[i] = 0
+
+    def start(self):
+        if not enabled:
+            return 0
+        return utime.ticks_us()
+
+    def stop(self, start):
+        if not enabled:
+            return
+        self.record(utime.ticks_diff(utime.ticks_us(), start))
+
+    def record(self, us):
+        # Add a duration measured some other way
+        if not enabled:
+            return
+        self.count += 1
+        self.total += us
+        if us > self.max:
+            self.max = us
+        i = 0
+        while i < len(BOUNDS) and us > BOUNDS[i]:
+            i += 1
+        self.buckets[i] += 1
+
+
+class Counter:
+    def __init__(self, name):
+        self.name = name
+        self.value = 0
+
+    def add(self, n=1):
+        if enabled:
+            self.value += n
+
+
+def stage(name):
+    if name not in _stages:
+        _stages[name] = Stage(name)
+    return _stages[name]
+
+
+def counter(name):
+    if name not in _counters:
+        _counters[name] = Counter(name)
+    return _counters[name]
+
+
+def heap():
+    # Track the heap low-water mark, where gc can tell
+    if not enabled or not hasattr(gc, "mem_free"):
+        return
+    free = gc.mem_free()
+    used = gc.mem_alloc()
+    if _heap[0] is None or free < _heap[0]:
+        _heap[0] = free
+    if _heap[1] is None or used > _heap[1]:
+        _heap[1] = used
+
+
+def summary():
+    # Compact dict of everything measured since the last reset: per stage
+    # [count, mean us, max us, buckets], the counters that are not zero and
+    # the heap marks
+    heap()
+    stages = {}
+    for name, s in _stages.items():
+        if s.count:
+            stages[name] = [s.count, s.total // s.count, s.max, list(s.buckets)]
+    counters = {}
+    for name, c in _counters.items():
+        if c.value:
+            counters[name] = c.value
+    return {"stages": stages, "errors": counters, "heap_free_min": _heap[0], "heap_used_max": _heap[1]}
+
+
+def report():
+    # The summary as lines for the serial console
+    data = summary()
+    lines = []
+    for name, (count, mean, longest, _) in sorted(data["stages"].items()):
+        lines.append("*** METRICS: {} n={} mean={}us max={}us".format(name, count, mean, longest))
+    for name, value in sorted(data["errors"].items()):
+        lines.append("*** METRICS: {} {}".format(name, value))
+    if data["heap_free_min"] is not None:
+        lines.append("*** METRICS: heap free min {} used max {}".format(data["heap_free_min"], data["heap_used_max"]))
+    return "\n".join(lines)
+
+
+def reset():
+    for s in _stages.values():
+        s.reset()
+    for c in _counters.values():
+        c.value = 0
+    _heap[0] = _heap[1] = None
@@ -0,0 +1,188 @@
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
+import utime
+import metrics
+
+_FAILURES = metrics.counter("job_failures")
+_MISSED = metrics.counter("missed_slots")
+_LATE = metrics.stage("slot_late")
+
+# Cooperative runtime for the logger
+#---------------------------------------------------------------------------
+# All jobs share one asyncio event loop. A job is a plain function or an
+# async function; every() runs it periodically on fixed deadlines, so the
+# time a job takes does not shift the next run, and task() runs a coroutine
+# once. Jobs must not block: slow network I/O belongs in a coroutine that
+# awaits, or in a thread of its own.
+#
+# With a clock (uRTC.Clock), every(..., align=True) runs a job on wall-clock
+# multiples of its interval instead, e.g. at every whole minute for 60. The
+# slots are absolute, so they never drift. The second ticks of an
+# AlarmTicks source wake the scheduler when there is one; without it, or
+# once the ticks stop, it sleeps on the tick counter. A slot that passed
+# while the loop was blocked is logged as missed and the job runs once.
+# How late aligned jobs start is kept as the metrics stage "slot_late".
+
+
+class Runtime:
+    def __init__(self, clock=None, ticks=None):
+        self.clock = clock
+        self.ticks = ticks
+        self._jobs = []
+        self._tasks = []
+
+    def every(self, interval, job, delay=0, align=False):
+        # An aligned job without delay also runs once right away
+        self._jobs.append((interval, job, delay, align and self.clock is not None))
+        return job
+
+    def task(self, coro):
+        self._tasks.append(coro)
+        return coro
+
+    async def _run(self, job):
+        try:
+            result = job()
+            if hasattr(result, 'send'):
+                await result
+        except Exception as e:
+            _FAILURES.add()
+            print('*** Job {} failed: {}'.format(getattr(job, '__name__', job), e))
+
+    async def _periodic(self, interval, job, delay):
+        await asyncio.sleep(delay)
+        deadline = utime.ticks_ms()
+        while True:
+            await self._run(job)
+            deadline = utime.ticks_add(deadline, int(interval * 1000))
+            wait = utime.ticks_diff(deadline, utime.ticks_ms())
+            if wait < 0:
+                # running late, skip the missed runs instead of catching up
+                deadline = utime.ticks_ms()
+                wait = 0
+            await asyncio.sleep(wait / 1000)
+
+    async def _aligned(self, jobs):
+        # jobs: [interval, job, delay], the delay is replaced by the next
+        # slot in epoch seconds
+        clock = self.clock
+        for entry in jobs:
+            if not entry[2]:
+                await self._run(entry[1])
+            entry[2] = (clock.time() // entry[0] + 1) * entry[0]
+        if self.ticks is not None:
+            self.ticks.start()
+        while True:
+            if self.ticks is not None:
+                edge = await self.ticks.wait(1500)
+                if edge is None:
+                    print('*** Scheduler: no ticks from the RTC, using the tick counter')
+                    self.ticks.stop()
+                    self.ticks = None
+                    continue
+                clock.edge(edge)
+                # the edge is the start of a second, round off the error of the clock
+                since = utime.ticks_diff(utime.ticks_ms(), edge)
+                now = (clock.time_ms() - since + 500) // 1000
+                now_ms = now * 1000 + since
+            else:
+                wait = min(entry[2] for entry in jobs) * 1000 - clock.time_ms()
+                if wait > 0:
+                    await asyncio.sleep(wait / 1000)
+                now_ms = clock.time_ms()
+                now = now_ms // 1000
+            for entry in jobs:
+                interval, job, slot = entry
+                if now < slot:
+                    if slot - now > interval:
+                        # the clock was set back, continue from now
+                        entry[2] = (now // interval + 1) * interval
+                    continue
+                missed = (now - slot) // interval
+                if missed:
+                    _MISSED.add(missed)
+                    print('*** Scheduler: {} missed {} slot(s)'.format(getattr(job, '__name__', job), missed))
+                _LATE.record((now_ms - (slot + missed * interval) * 1000) * 1000)
+                entry[2] = (now // interval + 1) * interval
+                await self._run(job)
+
+    async def _main(self):
+        # keep references so the tasks are never garbage collected
+        self.running = []
+        aligned = []
+        for interval, job, delay, align in self._jobs:
+            if align:
+                aligned.append([interval, job, delay])
+            else:
+                self.running.append(asyncio.create_task(self._periodic(interval, job, delay)))
+        if aligned:
+            self.running.append(asyncio.create_task(self._aligned(aligned)))
+        self.running += [asyncio.create_task(coro) for coro in self._tasks]
+        while True:
+            await asyncio.sleep(3600)
+
+    def run(self):
+        asyncio.run(self._main())
+
+
+# Second ticks from a DS3231
+#---------------------------------------------------------------------------
+# Alarm 1 of the DS3231 is set to match every second. With its interrupt
+# enabled the chip pulls the INT/SQW pin low at the start of each second,
+# until the alarm flag is cleared. The pin interrupt only records the tick
+# count and wakes the scheduler, the flag is cleared from the event loop.
+
+try:
+    _Flag = asyncio.ThreadSafeFlag
+except AttributeError:
+    class _Flag:
+        # CPython stand-in, set() may come from another thread
+        def __init__(self):
+            self._event = asyncio.Event()
+            self._loop = None
+
+        def set(self):
+            if self._loop is None:
+                self._event.set()
+            else:
+                self._loop.call_soon_threadsafe(self._event.set)
+
+        async def wait(self):
+            self._loop = asyncio.get_running_loop()
+            await self._event.wait()
+            self._event.clear()
+
+
+class AlarmTicks:
+    def __init__(self, rtc, pin):
+        self.rtc = rtc
+        self.pin = pin
+        self.edge = None
+        self.count = 0
+        self._flag = _Flag()
+
+    def start(self):
+        self.rtc.alarm_time((None,) * 8, alarm=0)
+        self.rtc.alarm(False, alarm=0)
+        self.rtc.interrupt(alarm=0)
+        self.pin.irq(handler=self._irq, trigger=self.pin.IRQ_FALLING)
+
+    def stop(self):
+        self.pin.irq(handler=None)
+        self.rtc.no_interrupt()
+
+    def _irq(self, pin):
+        self.edge = utime.ticks_ms()
+        self.count += 1
+        self._flag.set()
+
+    async def wait(self, timeout_ms):
+        # Ticks at the next edge, None when none came within timeout_ms
+        try:
+            await asyncio.wait_for(self._flag.wait(), timeout_ms / 1000)
+        except asyncio.TimeoutError:
+            return None
+        self.rtc.alarm(False, alarm=0)
+        return self.edge
@@ -0,0 +1,677 @@
+import _thread
+import os
+import struct
+import time
+
+# Append-only binary sample log
+#---------------------------------------------------------------------------
+# The file starts with a small header followed by fixed-width records:
+#
+#   header:  magic "MSL1", record size (B), field count (B), header size (H),
+#            records already uploaded (I), then the schema as text, e.g.
+#            b"humidity/1,temperature/1\n" (field name / scale)
+#   record:  epoch seconds (I) + one int16 per field (value * scale)
+#
+# A missing value (None, e.g. a sensor that did not answer) is stored as
+# MISSING and comes back as None, in the CSV it is an empty field.
+#
+# Records are never rewritten, so the number of records is known from the
+# file size and the number waiting for upload is that minus the header count.
+#
+# Appends go into a preallocated RAM buffer and reach the file, which is kept
+# open, when `buffer` records are waiting or the oldest waiting one is
+# `max_age` seconds older than the newest. A power loss therefore costs at
+# most that window. A record torn by a power loss in the middle of a flush
+# is cut off the next time the log is opened.
+#
+# Appending and uploading may run in different threads; the lock keeps the
+# header, the open file and the buffer consistent between them. Reading
+# records for an upload only holds it while flushing.
+#
+# With readonly the log is only read: a missing file or one with another
+# schema raises instead of being moved aside, and nothing is written.
+
+_MAGIC = b"MSL1"
+_HEADER = "<4sBBHI"
+_HEADER_SIZE = 12
+_UPLOADED_OFFSET = 8
+MISSING = -32768
+
+
+def scaled(value, scale):
+    # A value as stored in a record
+    if value is None:
+        return MISSING
+    v = int(round(value * scale))
+    if not -32767 <= v <= 32767:
+        raise ValueError("{} is out of range for scale {}".format(value, scale))
+    return v
+
+
+class Records:
+    # Reading records back, for any log with fields, scales and a _read()
+    # that yields the raw record tuples
+
+    def records(self, start, end):
+        # Yield (seconds, values) for records start..end-1
+        scales = self.scales
+        for record in self._read(start, end):
+            yield record[0], [None if v == MISSING else v if s == 1 else v / s
+                              for v, s in zip(record[1:], scales)]
+
+    def batch(self, start, limit):
+        # End of an upload batch of at most limit records from start
+        return min(start + limit, self.count())
+
+    def csv(self, start, end, chunk_size=512, delta=False, plain=None):
+        # Render records start..end-1 in the Data Foundry CSV format while
+        # reading them, yielding chunks of roughly chunk_size bytes, so the
+        # text version of the log never has to exist in RAM or on flash.
+        #
+        # With delta, only the first row is absolute. Later rows hold
+        # "+seconds" since the previous row and the change of every value,
+        # left empty when it did not change. A row with a missing value, and
+        # the one after it, are absolute rows as well.
+        #
+        # plain, a one element list, gets the size of the same rows as plain
+        # CSV added to it, what a delta body is compared with.
+        scales = self.scales
+        previous = None
+        out = bytearray()
+        out.extend(b"ts," + ",".join(self.fields).encode() + b"\n")
+        if plain is not None:
+            plain[0] += len(out)
+        row = bytearray() if delta and plain is not None else None
+        for record in self._read(start, end):
+            if delta and previous is not None and MISSING not in record and MISSING not in previous:
+                out.extend(b"+" + str(record[0] - previous[0]).encode())
+                for i in range(1, len(record)):
+                    d = record[i] - previous[i]
+                    out.extend(b",")
+                    if d:
+                        s = scales[i - 1]
+                        out.extend(str(d if s == 1 else d / s).encode())
+                if row is not None:
+                    # rendered only to be counted
+                    self._absolute(record, row)
+                    plain[0] += len(row) + 1
+                    row[:] = b""
+            else:
+                n = len(out)
+                self._absolute(record, out)
+                if plain is not None:
+                    plain[0] += len(out) - n + 1
+            out.extend(b"\n")
+            previous = record
+            if len(out) >= chunk_size:
+                yield out
+                out = bytearray()
+        if out:
+            yield out
+
+    def _absolute(self, record, out):
+        # A record as an absolute row without the newline, added to out
+        scales = self.scales
+        t = time.localtime(record[0])
+        out.extend("{}-{}-{}T{}:{}:{}".format(t[0], t[1], t[2], t[3], t[4], t[5]).encode())
+        for i in range(1, len(record)):
+            s = scales[i - 1]
+            out.extend(b",")
+            if record[i] != MISSING:
+                out.extend(str(record[i] if s == 1 else record[i] / s).encode())
+
+
+class SampleLog(Records):
+    def __init__(self, filename, fields, scales=None, buffer=16, max_age=600, readonly=False):
+        self.filename = filename
+        self.fields = tuple(fields)
+        self.scales = tuple(scales) if scales else (1,) * len(self.fields)
+        self.record_size = 4 + 2 * len(self.fields)
+        self._format = "<I" + "h" * len(self.fields)
+        self._record = bytearray(self.record_size)
+        self._schema = ",".join("{}/{}".format(f, s) for f, s in zip(self.fields, self.scales)).encode() + b"\n"
+        self.header_size = _HEADER_SIZE + len(self._schema)
+        self.uploaded = 0
+        self.max_age = max_age
+        self._buffer = bytearray(self.record_size * buffer)
+        self._buffered = 0
+        self._first = 0
+        self._file = None
+        self._lock = _thread.allocate_lock()
+        self.readonly = readonly
+        if not self._load():
+            self._create()
+
+    def _load(self):
+        try:
+            with open(self.filename, "rb") as f:
+                header = f.read(self.header_size)
+        except OSError:
+            if self.readonly:
+                raise
+            return False
+        if self.readonly and (len(header) != self.header_size or header[_HEADER_SIZE:] != self._schema
+                              or struct.unpack_from(_HEADER, header)[:2] != (_MAGIC, self.record_size)):
+            raise ValueError(self.filename + " has another schema")
+        if len(header) != self.header_size or header[_HEADER_SIZE:] != self._schema:
+            if header:
+                # a log with a different layout, keep it aside and start over
+                print('*** LOG: schema changed, moving old log to', self.filename + ".old")
+                os.rename(self.filename, self.filename + ".old")
+            return False
+        magic, record_size, fields, header_size, uploaded = struct.unpack_from(_HEADER, header)
+        if magic != _MAGIC or record_size != self.record_size:
+            os.rename(self.filename, self.filename + ".old")
+            return False
+        self.uploaded = uploaded
+        self._size = os.stat(self.filename)[6]
+        if (self._size - self.header_size) % self.record_size:
+            if self.readonly:
+                # leave a torn record where it is, it is not counted
+                self._size -= (self._size - self.header_size) % self.record_size
+            else:
+                self._recover()
+        return True
+
+    def _recover(self):
+        # Copy the complete records to a new file, dropping a torn last one
+        size = self._size - (self._size - self.header_size) % self.record_size
+        print('*** LOG: dropping', self._size - size, 'bytes of a torn record')
+        buf = bytearray(512)
+        mv = memoryview(buf)
+        with open(self.filename, "rb") as src, open(self.filename + ".tmp", "wb") as dst:
+            remaining = size
+            while remaining > 0:
+                n = src.readinto(mv[:min(len(buf), remaining)])
+                dst.write(mv[:n])
+                remaining -= n
+        os.remove(self.filename)
+        os.rename(self.filename + ".tmp", self.filename)
+        self._size = size
+
+    def _create(self, uploaded=0):
+        self._close()
+        with open(self.filename, "wb") as f:
+            f.write(struct.pack(_HEADER, _MAGIC, self.record_size, len(self.fields),
+                                self.header_size, uploaded))
+            f.write(self._schema)
+        self.uploaded = uploaded
+        self._size = self.header_size
+
+    def append(self, seconds, values):
+        with self._lock:
+            self._append(seconds, values)
+
+    def _append(self, seconds, values):
+        if self._buffered == 0:
+            self._first = seconds
+        args = [seconds]
+        for v, scale in zip(values, self.scales):
+            args.append(scaled(v, scale))
+        struct.pack_into(self._format, self._buffer, self._buffered * self.record_size, *args)
+        self._buffered += 1
+        if (self._buffered * self.record_size == len(self._buffer)
+                or seconds - self._first >= self.max_age):
+            self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if self._buffered == 0:
+            return
+        if self._file is None:
+            self._file = open(self.filename, "ab")
+        n = self._buffered * self.record_size
+        self._file.write(memoryview(self._buffer)[:n])
+        self._file.flush()
+        self._size += n
+        self._buffered = 0
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    def _close(self):
+        # Flush and release the file, it is opened again on the next flush
+        self._flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def count(self):
+        return (self._size - self.header_size) // self.record_size + self._buffered
+
+    def pending(self):
+        return self.count() - self.uploaded
+
+    def acknowledge(self, index):
+        # Mark all records before index as uploaded
+        with self._lock:
+            self._close()
+            with open(self.filename, "r+b") as f:
+                f.seek(_UPLOADED_OFFSET)
+                f.write(struct.pack("<I", index))
+            self.uploaded = index
+
+    def compact(self):
+        # Drop records that have been uploaded, only when all of them are
+        with self._lock:
+            if self.uploaded and self.pending() == 0:
+                self._create()
+
+    def _read(self, start, end, batch=32):
+        # Yield the raw (scaled) record tuples start..end-1, read in batches
+        # through one reused buffer
+        self.flush()
+        buf = bytearray(self.record_size * batch)
+        mv = memoryview(buf)
+        with open(self.filename, "rb") as f:
+            f.seek(self.header_size + start * self.record_size)
+            while start < end:
+                n = min(batch, end - start)
+                if f.readinto(mv[:n * self.record_size]) != n * self.record_size:
+                    raise OSError("short read in " + self.filename)
+                for i in range(n):
+                    yield struct.unpack_from(self._format, buf, i * self.record_size)
+                start += n
+
+
+# Segmented sample log
+#---------------------------------------------------------------------------
+# The same records spread over SampleLog files, name.<seq>.bin, of at most
+# `segment_records` records each, one per day (UTC epoch days). Only the
+# newest segment is appended to; once it is full or a record of a later
+# day than any in it comes in it is sealed and the next one started. A
+# late row of the day before still goes into the open segment.
+# The manifest name.idx lists the sealed segments:
+#
+#   MSM1 <open seq> <open base> <number of sealed segments>
+#   <seq> <base> <count> <first> <last> <uploaded>      one line per segment
+#
+# base is the index of a segment's first record in the whole log, first and
+# last the earliest and latest time in it (aggregate rows come in stamped
+# with the start of their window, so not in order), uploaded how many of its
+# records have been acknowledged. The manifest is only rewritten (through
+# name.idx.tmp, which wins on start when complete) when a segment is sealed
+# or acknowledged, appends never touch it.
+#
+# Indices for records(), csv() and acknowledge() count over the whole log,
+# as in a SampleLog, so the uploader works with either. batch() ends an
+# upload batch at the end of its segment, and a sealed segment is deleted
+# as soon as all its records are acknowledged. The segment headers keep
+# their own upload count as well: without a manifest the segments are
+# found again by name, and an old single-file log becomes the first one.
+# Sealed segments are only opened read-only. One that was written with
+# another schema is moved aside to .old on start, like the open segment.
+
+_MANIFEST = "MSM1"
+_DAY = 86400
+
+
+def _mark(filename, uploaded):
+    # Set the upload count in the header of a sealed segment
+    with open(filename, "r+b") as f:
+        f.seek(_UPLOADED_OFFSET)
+        f.write(struct.pack("<I", uploaded))
+
+
+def _times(log):
+    # Earliest and latest time in a SampleLog
+    first = last = None
+    for record in log._read(0, log.count()):
+        if first is None or record[0] < first:
+            first = record[0]
+        if last is None or record[0] > last:
+            last = record[0]
+    return first, last
+
+
+class SegmentedLog(Records):
+    def __init__(self, name, fields, scales=None, buffer=16, max_age=600, segment_records=2048):
+        self.name = name
+        self.fields = tuple(fields)
+        self.scales = tuple(scales) if scales else (1,) * len(self.fields)
+        self.max_age = max_age
+        self.segment_records = segment_records
+        self.manifest = name + ".idx"
+        self.sealed = []
+        self._buffer_records = buffer
+        self._lock = _thread.allocate_lock()
+        if not self._load():
+            self._rebuild()
+        else:
+            self._orphans()
+            if self._check():
+                self._save()
+        self._open()
+
+    def _segment(self, seq):
+        return "{}.{}.bin".format(self.name, seq)
+
+    def _sealed(self, seq):
+        return SampleLog(self._segment(seq), self.fields, self.scales, buffer=1, readonly=True)
+
+    def _check(self):
+        # Drop the sealed segments that cannot be read with this schema,
+        # returns True when there were any
+        dropped = False
+        for entry in list(self.sealed):
+            filename = self._segment(entry[0])
+            try:
+                self._sealed(entry[0])
+                continue
+            except ValueError:
+                print('*** LOG: schema changed, moving old segment to', filename + ".old")
+                os.rename(filename, filename + ".old")
+            except OSError:
+                print('*** LOG: segment', filename, 'is missing')
+            self.sealed.remove(entry)
+            dropped = True
+        return dropped
+
+    def _open(self):
+        self.active = SampleLog(self._segment(self.seq), self.fields, self.scales,
+                                self._buffer_records, self.max_age)
+        self.record_size = self.active.record_size
+        self._first, self._last = _times(self.active)
+        self._uploaded()
+
+    def _load(self):
+        # The manifest, or the copy that was being written when it is complete
+        for filename in (self.manifest + ".tmp", self.manifest):
+            try:
+                with open(filename) as f:
+                    lines = f.read().split("\n")
+                head = lines[0].split()
+                sealed = [[int(v) for v in line.split()] for line in lines[1:] if line]
+                if (head[0] != _MANIFEST or len(sealed) != int(head[3])
+                        or any(len(entry) != 6 for entry in sealed)):
+                    continue
+            except (OSError, ValueError, IndexError):
+                continue
+            self.seq, self.base = int(head[1]), int(head[2])
+            self.sealed = sealed
+            return True
+        return False
+
+    def _seqs(self):
+        # The numbers of the segment files there are, in order
+        prefix = self.name + "."
+        return sorted(int(f[len(prefix):-4]) for f in os.listdir()
+                      if f.startswith(prefix) and f.endswith(".bin") and f[len(prefix):-4].isdigit())
+
+    def _orphans(self):
+        # acknowledge() and _seal() save the manifest before they delete the
+        # segments it no longer lists. Ones left by a power loss in between
+        # are removed, they were uploaded completely
+        listed = [entry[0] for entry in self.sealed]
+        for seq in self._seqs():
+            if seq < self.seq and seq not in listed:
+                print('*** LOG: removing uploaded segment', self._segment(seq))
+                os.remove(self._segment(seq))
+
+    def _rebuild(self):
+        seqs = self._seqs()
+        if not seqs:
+            try:
+                os.rename(self.name + ".bin", self._segment(0))
+                print('*** LOG: continuing', self.name + ".bin", 'as the first segment')
+                seqs = [0]
+            except OSError:
+                pass
+        else:
+            print('*** LOG: no manifest, rebuilding it from', len(seqs), 'segments')
+        self.sealed = []
+        base = 0
+        for seq in seqs[:-1]:
+            try:
+                log = self._sealed(seq)
+            except ValueError:
+                print('*** LOG: schema changed, moving old segment to', self._segment(seq) + ".old")
+                os.rename(self._segment(seq), self._segment(seq) + ".old")
+                continue
+            first, last = _times(log)
+            count = log.count()
+            if count > log.uploaded:
+                self.sealed.append([seq, base, count, first, last, log.uploaded])
+            else:
+                os.remove(self._segment(seq))
+            base += count
+        self.seq = seqs[-1] if seqs else 0
+        self.base = base
+        self._save()
+
+    def _save(self):
+        tmp = self.manifest + ".tmp"
+        with open(tmp, "w") as f:
+            f.write("{} {} {} {}\n".format(_MANIFEST, self.seq, self.base, len(self.sealed)))
+            for entry in self.sealed:
+                f.write("{} {} {} {} {} {}\n".format(*entry))
+        try:
+            os.remove(self.manifest)
+        except OSError:
+            pass
+        os.rename(tmp, self.manifest)
+
+    def _uploaded(self):
+        # The first record not acknowledged yet
+        if self.sealed:
+            self.uploaded = self.sealed[0][1] + self.sealed[0][5]
+        else:
+            self.uploaded = self.base + self.active.uploaded
+
+    def append(self, seconds, values):
+        with self._lock:
+            count = self.active.count()
+            if count and (count >= self.segment_records or seconds // _DAY > self._last // _DAY):
+                self._seal()
+            self.active.append(seconds, values)
+            if self._first is None or seconds < self._first:
+                self._first = seconds
+            if self._last is None or seconds > self._last:
+                self._last = seconds
+
+    def _seal(self):
+        # Close the open segment, list it and start the next one. A segment
+        # that is already uploaded completely is dropped right away
+        active = self.active
+        active.close()
+        count = active.count()
+        done = active.uploaded >= count
+        if not done:
+            self.sealed.append([self.seq, self.base, count, self._first, self._last, active.uploaded])
+        self.seq += 1
+        self.base += count
+        self._save()
+        if done:
+            os.remove(active.filename)
+        self._open()
+
+    def flush(self):
+        self.active.flush()
+
+    def close(self):
+        self.active.close()
+
+    def count(self):
+        # base and active change together when a segment is sealed
+        with self._lock:
+            return self.base + self.active.count()
+
+    def pending(self):
+        with self._lock:
+            return self.base + self.active.count() - self.uploaded
+
+    def segments(self):
+        # (seq, first, last, count, uploaded) of every segment, the open one last
+        info = [(s[0], s[3], s[4], s[2], s[5]) for s in self.sealed]
+        info.append((self.seq, self._first, self._last, self.active.count(), self.active.uploaded))
+        return info
+
+    def batch(self, start, limit):
+        with self._lock:
+            end = min(start + limit, self.base + self.active.count())
+            for entry in self.sealed:
+                if entry[1] <= start < entry[1] + entry[2]:
+                    return min(end, entry[1] + entry[2])
+            return end
+
+    def acknowledge(self, index):
+        # Mark all records before index as uploaded, the sealed segments
+        # that are done are deleted
+        with self._lock:
+            done = []
+            changed = False
+            for entry in self.sealed:
+                uploaded = min(max(index - entry[1], 0), entry[2])
+                if uploaded > entry[5]:
+                    entry[5] = uploaded
+                    changed = True
+                    if uploaded < entry[2]:
+                        _mark(self._segment(entry[0]), uploaded)
+                if entry[5] == entry[2]:
+                    done.append(entry)
+            for entry in done:
+                self.sealed.remove(entry)
+            if changed:
+                self._save()
+            for entry in done:
+                os.remove(self._segment(entry[0]))
+            if index > self.base:
+                self.active.acknowledge(min(index - self.base, self.active.count()))
+            self._uploaded()
+
+    def compact(self):
+        # Acknowledged segments are already gone, the open one stays until
+        # it is sealed
+        pass
+
+    def _read(self, start, end, batch=32):
+        # The segments as they are now, a seal meanwhile does not move the
+        # records that are being read
+        with self._lock:
+            sealed = [entry[:3] for entry in self.sealed]
+            active, active_base = self.active, self.base
+        for seq, base, count in sealed:
+            if start < base + count and end > base:
+                log = self._sealed(seq)
+                for record in log._read(max(start, base) - base, min(end, base + count) - base, batch):
+                    yield record
+        if end > active_base:
+            for record in active._read(max(start - active_base, 0), end - active_base, batch):
+                yield record
+
+
+# CSV log of older versions
+#---------------------------------------------------------------------------
+# Before the binary log, samples were appended as CSV rows to a text file
+# (sensor_data.csv) behind a header line, and "<file>.ofs" held the byte
+# offset up to which the server had acknowledged them. CSVLog uploads the
+# rows that were still waiting there: indices are byte offsets into the
+# file, so it offers the same upload interface as the logs above. Once all
+# rows are acknowledged, compact() deletes the file and its checkpoint.
+# Nothing is appended to it any more.
+
+class CSVLog:
+    def __init__(self, filename):
+        self.filename = filename
+        self.checkpoint = filename + ".ofs"
+        try:
+            with open(filename, "rb") as f:
+                self.header = f.readline()
+            size = os.stat(filename)[6]
+        except OSError:
+            self.header = b""
+            size = 0
+        if not self.header.endswith(b"\n"):
+            size = 0
+        # rows end at a newline, a row torn by a power loss is left out
+        self._size = self._line_end(len(self.header), size) if size else 0
+        try:
+            with open(self.checkpoint) as f:
+                self.uploaded = int(f.read())
+        except (OSError, ValueError):
+            self.uploaded = 0
+        if not len(self.header) <= self.uploaded <= self._size:
+            # missing, torn or stale checkpoint, start after the header
+            self.uploaded = min(len(self.header), self._size)
+        # a log that was uploaded completely, or never had a row, is not
+        # uploaded again and would stay forever
+        self.compact()
+
+    def _line_end(self, start, end):
+        # Just after the last newline in start..end, start if there is none
+        buf = bytearray(128)
+        mv = memoryview(buf)
+        with open(self.filename, "rb") as f:
+            pos = end
+            while pos > start:
+                n = min(len(buf), pos - start)
+                f.seek(pos - n)
+                f.readinto(mv[:n])
+                for i in range(n - 1, -1, -1):
+                    if buf[i] == 10:
+                        return pos - n + i + 1
+                pos -= n
+        return start
+
+    def count(self):
+        return self._size
+
+    def pending(self):
+        return self._size - self.uploaded
+
+    def batch(self, start, limit):
+        # End of the row limit rows after start, or of the last one
+        buf = bytearray(128)
+        mv = memoryview(buf)
+        with open(self.filename, "rb") as f:
+            f.seek(start)
+            pos = start
+            while pos < self._size:
+                n = f.readinto(mv[:min(len(buf), self._size - pos)])
+                if not n:
+                    break
+                for i in range(n):
+                    if buf[i] == 10:
+                        limit -= 1
+                        if not limit:
+                            return pos + i + 1
+                pos += n
+        return self._size
+
+    def csv(self, start, end, chunk_size=512, delta=False, plain=None):
+        # The header, then the rows in start..end as they are in the file.
+        # They are absolute rows, which the delta format takes as well
+        if plain is not None:
+            plain[0] += len(self.header) + end - start
+        yield self.header
+        buf = bytearray(chunk_size)
+        mv = memoryview(buf)
+        with open(self.filename, "rb") as f:
+            f.seek(start)
+            while start < end:
+                n = f.readinto(mv[:min(chunk_size, end - start)])
+                if not n:
+                    raise OSError("short read in " + self.filename)
+                yield bytes(mv[:n])
+                start += n
+
+    def acknowledge(self, index):
+        with open(self.checkpoint, "w") as f:
+            f.write(str(index))
+        self.uploaded = index
+
+    def compact(self):
+        # Everything acknowledged: the old log is not needed any more
+        if self.header and self.pending() == 0:
+            os.remove(self.filename)
+            try:
+                os.remove(self.checkpoint)
+            except OSError:
+                pass
+            print('*** LOG: all rows of', self.filename, 'uploaded, removed it')
+            self.header = b""
+            self._size = self.uploaded = 0
@@ -0,0 +1,142 @@
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
+import time
+import metrics
+
+# Sensor registry
+#---------------------------------------------------------------------------
+# Every sensor is a small driver that declares
+#
+#   fields    names of the values read() returns, they become log columns
+#   units     the unit of every field
+#   scales    of every field, values are stored as int16 value * scale, so
+#             a field holds +-32767 / scale (10: 0.1 steps up to 3276.7,
+#             1 for lux or CO2 ppm up to 32767)
+#   interval  minimum seconds between two reads, the limit of the sensor
+#   duration  milliseconds a conversion takes between start() and read()
+#
+# The registry reads each sensor in a job of its own at its own interval and
+# keeps the latest value of every field, the sample job takes a snapshot of
+# all of them. A field is None until its sensor answered for the first time,
+# and after a reading outside the range of its scale, which raises. For a
+# sensor with a conversion time the job starts it and awaits the duration
+# before reading, so other jobs keep running meanwhile.
+# The time read() takes is measured as the metrics stage "read_<driver>".
+
+DEGREES = chr(176) + "C"
+
+_ERRORS = metrics.counter("sensor_errors")
+
+
+class Sensor:
+    fields = ()
+    units = ()
+    scales = None       # 10 for every field
+    interval = 1
+    duration = 0
+
+    def start(self):
+        pass
+
+    def read(self):
+        raise NotImplementedError
+
+
+class DHT(Sensor):
+    # DHT11 or DHT22 from the dht module, one conversion per second at most
+    fields = ("humidity", "temperature")
+    units = ("%", DEGREES)
+
+    def __init__(self, sensor, interval=1):
+        self.sensor = sensor
+        self.interval = interval
+
+    def read(self):
+        self.sensor.measure()
+        return (self.sensor.humidity(), self.sensor.temperature())
+
+
+class DS3231Temperature(Sensor):
+    # Die temperature of the DS3231, it converts on its own every 64 seconds
+    fields = ("rtc_temperature",)
+    units = (DEGREES,)
+    interval = 64
+
+    def __init__(self, rtc):
+        self.rtc = rtc
+
+    def read(self):
+        return (self.rtc.temperature(),)
+
+
+class Registry:
+    def __init__(self):
+        self.sensors = []
+        self.fields = []
+        self.units = []
+        self.scales = []
+        self.values = []
+
+    def add(self, sensor, interval=None):
+        # Registers the declared fields of the sensor, then reads it once and
+        # raises when it doesnt answer. It stays registered either way, the
+        # columns of the log do not depend on the first read. The interval
+        # never goes below the minimum of the sensor
+        if interval is not None and interval > sensor.interval:
+            sensor.interval = interval
+        sensor.offset = len(self.values)
+        sensor.stage = metrics.stage("read_" + type(sensor).__name__)
+        self.sensors.append(sensor)
+        self.fields += sensor.fields
+        self.units += sensor.units
+        self.scales += sensor.scales or (10,) * len(sensor.fields)
+        self.values += [None] * len(sensor.fields)
+        sensor.start()
+        if sensor.duration:
+            time.sleep(sensor.duration / 1000)
+        try:
+            values = sensor.read()
+        except Exception:
+            _ERRORS.add()
+            raise
+        self._store(sensor, values)
+        return sensor
+
+    def schedule(self, jobs):
+        # Add a read job per sensor to a runtime.Runtime
+        for sensor in self.sensors:
+            jobs.every(sensor.interval, self._reader(sensor), delay=sensor.interval)
+
+    def snapshot(self):
+        return tuple(self.values)
+
+    def _reader(self, sensor):
+        async def read():
+            sensor.start()
+            if sensor.duration:
+                await asyncio.sleep(sensor.duration / 1000)
+            t = sensor.stage.start()
+            try:
+                values = sensor.read()
+            except Exception:
+                _ERRORS.add()
+                raise
+            sensor.stage.stop(t)
+            self._store(sensor, values)
+        return read
+
+    def _store(self, sensor, values):
+        # Keep the values, a value the log cannot hold becomes missing
+        error = None
+        for i, value in enumerate(values):
+            n = sensor.offset + i
+            if value is not None and abs(value) * self.scales[n] > 32767:
+                error = "{} = {} is out of range for scale {} (at most {})".format(
+                    self.fields[n], value, self.scales[n], 32767 / self.scales[n])
+                value = None
+            self.values[n] = value
+        if error is not None:
+            _ERRORS.add()
+            raise ValueError(error)
@@ -0,0 +1,236 @@
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
+import socket
+import struct
+import utime
+import metrics
+import urtc as uRTC
+
+_RTT = metrics.stage("timesync_rtt")
+_LOST = metrics.counter("timesync_lost")
+
+# One-shot clock sync over SNTP
+#---------------------------------------------------------------------------
+# query() sends `exchanges` SNTP requests (RFC 4330) one after the other
+# over a UDP socket and times every round trip with utime.ticks_ms. The
+# server's transmit time plus half of the round trip, less the time the
+# server held the request, is the time at the moment the reply came in. The
+# exchange with the shortest round trip wins, its error is at most half of
+# that. The socket is closed before query() returns, nothing keeps running.
+#
+# The request carries the tick count as its transmit time, a reply has to
+# echo it, so a late reply to an earlier exchange is never taken for the
+# current one.
+#
+# query() takes an address from resolve(): the name lookup blocks, so it is
+# not done in the event loop.
+
+_PORT = 123
+_PACKET_SIZE = 48
+# seconds from 1900 (NTP) to the epoch of utime, 1970 or 2000
+NTP_DELTA = 2208988800 if utime.gmtime(0)[0] == 1970 else 3155673600
+
+
+def _ms(packet, offset):
+    # An NTP timestamp in the packet as epoch milliseconds
+    seconds, fraction = struct.unpack_from("!II", packet, offset)
+    return (seconds - NTP_DELTA) * 1000 + (fraction * 1000 >> 32)
+
+
+async def _exchange(sock, packet, timeout_ms):
+    # One request, (time_ms, ticks, delay_ms) or None without a valid reply
+    nonce = utime.ticks_us()
+    struct.pack_into("!I", packet, 44, nonce)
+    sent = utime.ticks_ms()
+    sock.send(packet)
+    while utime.ticks_diff(utime.ticks_ms(), sent) < timeout_ms:
+        try:
+            reply = sock.recv(_PACKET_SIZE)
+        except OSError:
+            # nothing yet, let the other jobs run
+            await asyncio.sleep(0.001)
+            continue
+        ticks = utime.ticks_ms()
+        if (len(reply) < _PACKET_SIZE or reply[0] & 7 != 4 or reply[1] == 0
+                or struct.unpack_from("!I", reply, 28)[0] != nonce):
+            # not an answer to this request, or a kiss-of-death (stratum 0)
+            continue
+        received = _ms(reply, 32)
+        transmitted = _ms(reply, 40)
+        delay = max(0, utime.ticks_diff(ticks, sent) - (transmitted - received))
+        return transmitted + delay // 2, ticks, delay
+    return None
+
+
+def resolve(host, port=_PORT):
+    # The address of the server, blocks while the name is looked up
+    return socket.getaddrinfo(host, port, 0, socket.SOCK_DGRAM)[0][-1]
+
+
+async def query(address, exchanges=4, timeout_ms=1000):
+    # Best (time_ms, ticks, delay_ms) of the exchanges: the time when the
+    # tick counter was at ticks, and the round trip it is based on. None
+    # when no exchange got an answer
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    best = None
+    try:
+        sock.connect(address)
+        sock.setblocking(False)
+        packet = bytearray(_PACKET_SIZE)
+        packet[0] = 0b00100011     # version 4, client
+        for _ in range(exchanges):
+            result = await _exchange(sock, packet, timeout_ms)
+            if result is None:
+                _LOST.add()
+                continue
+            _RTT.record(result[2] * 1000)
+            if best is None or result[2] < best[2]:
+                best = result
+    finally:
+        sock.close()
+    return best
+
+
+# Local time
+#---------------------------------------------------------------------------
+# The RTC keeps local time, UTC plus a fixed offset, plus an hour in summer
+# with the EU rule: from 01:00 UTC on the last Sunday of March to 01:00 UTC
+# on the last Sunday of October.
+
+_RULES = (None, "EU")
+
+
+def _last_sunday(year, month):
+    # 01:00 UTC on the last Sunday of a month of 31 days, in epoch seconds
+    t = utime.mktime((year, month, 31, 1, 0, 0, 0, 0))
+    return t - (utime.gmtime(t)[6] + 1) % 7 * 86400
+
+
+def summer_time(seconds):
+    # True when EU summer time is in effect at UTC epoch seconds
+    year = utime.gmtime(seconds)[0]
+    return _last_sunday(year, 3) <= seconds < _last_sunday(year, 10)
+
+
+def next_change(seconds):
+    # UTC epoch seconds of the first EU summer time change after seconds
+    year = utime.gmtime(seconds)[0]
+    for t in (_last_sunday(year, 3), _last_sunday(year, 10), _last_sunday(year + 1, 3)):
+        if t > seconds:
+            return t
+
+
+# Setting the RTC
+#---------------------------------------------------------------------------
+# TimeSync.sync() queries the server and writes the RTC at the start of the
+# next second. Writing the seconds register restarts the countdown chain of
+# the DS3231, so the RTC then ticks in phase with the server as well, and
+# uRTC.Clock is anchored on that moment.
+#
+# Before setting it, the offset of the local clock (local minus server) is
+# kept. The offset found at the next sync, divided by the time in between,
+# is the drift of the RTC in ppm. next_sync() turns that into the number of
+# seconds after which the RTC is expected to be tolerance_ms off, so syncs
+# can be spaced out on a good crystal and come often on a poor one.
+#
+# The RTC is set to local time (see offset()). The offset it was set with is
+# kept, the clock error and drift are measured against that one, and with
+# dst the sync after a change of the offset is due right after it.
+#
+# sync() only runs once resolve() has found the server, from a thread that
+# may block (the upload worker in boot.py). After a sync without an answer
+# the name is looked up again.
+
+class TimeSync:
+    def __init__(self, host, port=_PORT, exchanges=4, utc_offset=0, dst=None, tolerance_ms=500,
+                 min_interval=3600, max_interval=7 * 86400):
+        if dst not in _RULES:
+            raise ValueError("dst must be one of {}".format(_RULES))
+        self.host = host
+        self.port = port
+        self.exchanges = exchanges
+        self.utc_offset = utc_offset
+        self.dst = dst
+        self.applied = None         # offset the RTC was last set with
+        self.tolerance_ms = tolerance_ms
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.address = None
+        self.synced = None          # UTC of the last sync in ms
+        self.offset_ms = None       # local minus server time found then
+        self.delay_ms = None
+        self.drift_ppm = None
+
+    def offset(self, seconds):
+        # Seconds local time is ahead of UTC at UTC epoch seconds
+        if self.dst == "EU" and summer_time(seconds):
+            return self.utc_offset + 3600
+        return self.utc_offset
+
+    def resolve(self):
+        # Look the server up, blocks. Returns True when it was found
+        try:
+            self.address = resolve(self.host, self.port)
+        except OSError as e:
+            print('*** TIMESYNC: Cannot resolve', self.host, e)
+            return False
+        return True
+
+    async def sync(self, rtc, clock):
+        # Returns True once the RTC has been set
+        address = self.address
+        if address is None:
+            return False
+        result = await query(address, self.exchanges)
+        if result is None:
+            print('*** TIMESYNC: No answer from', self.host)
+            self.address = None
+            return False
+        utc_ms, ticks, self.delay_ms = result
+        offset = self.offset(utc_ms // 1000)
+        applied = offset if self.applied is None else self.applied
+        # the local clock at the moment the reply came in, against the
+        # offset it was set with
+        self.offset_ms = clock.time_ms() - utime.ticks_diff(utime.ticks_ms(), ticks) - utc_ms - applied * 1000
+        if self.synced is not None and utc_ms > self.synced:
+            self.drift_ppm = self.offset_ms * 1000000 / (utc_ms - self.synced)
+        print('*** TIMESYNC: Clock was {} ms off, round trip {} ms, drift {}'.format(
+            self.offset_ms, self.delay_ms,
+            'unknown' if self.drift_ppm is None else '{:.1f} ppm'.format(self.drift_ppm)))
+        if offset != applied:
+            print('*** TIMESYNC: Local time is now UTC{:+} s'.format(offset))
+        server_ms = utc_ms + offset * 1000
+
+        while True:
+            now = server_ms + utime.ticks_diff(utime.ticks_ms(), ticks)
+            second = now // 1000 + 1
+            wait = second * 1000 - now
+            if wait > 20:
+                # most of the wait in the event loop, the last bit blocking
+                await asyncio.sleep((wait - 20) / 1000)
+                now = server_ms + utime.ticks_diff(utime.ticks_ms(), ticks)
+                wait = second * 1000 - now
+            if wait >= 0:
+                break
+        utime.sleep_ms(wait)
+        rtc.datetime(uRTC.seconds2tuple(second))
+        edge = utime.ticks_add(ticks, second * 1000 - server_ms)
+        clock.sync(reset=True, ticks=edge)
+        self.synced = (second - offset) * 1000
+        self.applied = offset
+        return True
+
+    def next_sync(self):
+        # Seconds until the next sync is due
+        if not self.drift_ppm:
+            interval = self.min_interval
+        else:
+            interval = self.tolerance_ms * 1000 / abs(self.drift_ppm)
+            interval = int(min(self.max_interval, max(self.min_interval, interval)))
+        if self.dst is not None and self.synced is not None:
+            # the RTC follows a change of the offset at the sync after it
+            now = self.synced // 1000
+            interval = min(interval, next_change(now) - now + 1)
+        return interval
@@ -33,15 +33,37 @@ def seconds2tuple(seconds):
 
 class _BaseRTC:
     _SWAP_DAY_WEEKDAY = False
+    # Registers kept in a shadow copy once read, so that flag changes only
+    # cost a write. invalidate() drops the copy, e.g. after something else
+    # on the bus changed the chip
+    _SHADOWED = ()
 
     def __init__(self, i2c, address=0x68):
         self.i2c = i2c
         self.address = address
+        self._shadow = {}
+
+    def invalidate(self, register=None):
+        if register is None:
+            self._shadow.clear()
+        else:
+            self._shadow.pop(register, None)
 
     def _register(self, register, buffer=None):
         if buffer is None:
-            return self.i2c.readfrom_mem(self.address, register, 1)[0]
+            if register in self._shadow:
+                return self._shadow[register]
+            value = self.i2c.readfrom_mem(self.address, register, 1)[0]
+            if register in self._SHADOWED:
+                self._shadow[register] = value
+            return value
         self.i2c.writeto_mem(self.address, register, buffer)
+        self._update_shadow(register, buffer)
+
+    def _update_shadow(self, register, buffer):
+        for i in range(len(buffer)):
+            if register + i in self._SHADOWED:
+                self._shadow[register + i] = buffer[i]
 
     def _flag(self, register, mask, value=None):
         data = self._register(register)
@@ -56,23 +78,28 @@ class _BaseRTC:
 
     def datetime(self, datetime=None):
         if datetime is None:
-            buffer = self.i2c.readfrom_mem(self.address,
-                                           self._DATETIME_REGISTER, 7)
-            if self._SWAP_DAY_WEEKDAY:
-                day = buffer[3]
-                weekday = buffer[4]
-            else:
-                day = buffer[4]
-                weekday = buffer[3]
-            return datetime_tuple(
-                year=_bcd2bin(buffer[6]) + 2000,
-                month=_bcd2bin(buffer[5]),
-                day=_bcd2bin(day),
-                weekday=_bcd2bin(weekday),
-                hour=_bcd2bin(buffer[2]),
-                minute=_bcd2bin(buffer[1]),
-                second=_bcd2bin(buffer[0]),
-            )
+            return self._datetime(self.i2c.readfrom_mem(self.address,
+                                                        self._DATETIME_REGISTER, 7))
+        self._register(self._DATETIME_REGISTER, self._datetime_buffer(datetime))
+
+    def _datetime(self, buffer):
+        if self._SWAP_DAY_WEEKDAY:
+            day = buffer[3]
+            weekday = buffer[4]
+        else:
+            day = buffer[4]
+            weekday = buffer[3]
+        return datetime_tuple(
+            year=_bcd2bin(buffer[6]) + 2000,
+            month=_bcd2bin(buffer[5]),
+            day=_bcd2bin(day),
+            weekday=_bcd2bin(weekday),
+            hour=_bcd2bin(buffer[2]),
+            minute=_bcd2bin(buffer[1]),
+            second=_bcd2bin(buffer[0]),
+        )
+
+    def _datetime_buffer(self, datetime):
         datetime = datetime_tuple(*datetime)
         buffer = bytearray(7)
         buffer[0] = _bin2bcd(datetime.second)
@@ -86,7 +113,7 @@ class _BaseRTC:
             buffer[4] = _bin2bcd(datetime.day)
         buffer[5] = _bin2bcd(datetime.month)
         buffer[6] = _bin2bcd(datetime.year - 2000)
-        self._register(self._DATETIME_REGISTER, buffer)
+        return buffer
 
 
 class DS1307(_BaseRTC):
@@ -107,15 +134,20 @@ class DS3231(_BaseRTC):
     _CONTROL_REGISTER = 0x0e
     _STATUS_REGISTER = 0x0f
     _DATETIME_REGISTER = 0x00
-    _ALARM_REGISTERS = (0x08, 0x0b)
+    _ALARM_REGISTERS = (0x07, 0x0b)
     _SQUARE_WAVE_REGISTER = 0x0e
+    _TEMPERATURE_REGISTER = 0x11
+    _SHADOWED = (_CONTROL_REGISTER, _STATUS_REGISTER)
+    # OSF, A2F and A1F are set by the chip and only cleared by writing a 0,
+    # writing a 1 leaves them as they are. They are always read from the
+    # chip, the shadow only serves the other status bits
+    _STATUS_FLAGS = 0b10000011
 
     def lost_power(self):
-        return self._flag(self._STATUS_REGISTER, 0b10000000)
+        return self._status(0b10000000)
 
     def alarm(self, value=None, alarm=0):
-        return self._flag(self._STATUS_REGISTER,
-                          0b00000011 & (1 << alarm), value)
+        return self._status(0b00000011 & (1 << alarm), value)
 
     def interrupt(self, alarm=0):
         return self._flag(self._CONTROL_REGISTER,
@@ -127,33 +159,61 @@ class DS3231(_BaseRTC):
     def stop(self, value=None):
         return self._flag(self._CONTROL_REGISTER, 0b10000000, value)
 
+    def _status(self, mask, value=None):
+        if value is None:
+            self.invalidate(self._STATUS_REGISTER)
+            return bool(self._register(self._STATUS_REGISTER) & mask)
+        data = self._register(self._STATUS_REGISTER) | self._STATUS_FLAGS
+        if value:
+            data |= mask & ~self._STATUS_FLAGS
+        else:
+            data &= ~mask
+        self._register(self._STATUS_REGISTER, bytearray((data,)))
+
     def datetime(self, datetime=None):
         if datetime is not None:
-            status = self._register(self._STATUS_REGISTER) & 0b01111111
-            self._register(self._STATUS_REGISTER, bytearray((status,)))
+            # setting the time clears the oscillator stop flag
+            self._status(0b10000000, False)
         return super().datetime(datetime)
 
+    def read(self):
+        # One burst read of all registers, returns the datetime, the status
+        # register and the temperature, and refreshes the shadow
+        buffer = self.i2c.readfrom_mem(self.address, self._DATETIME_REGISTER, 0x13)
+        self._update_shadow(0, buffer)
+        return (self._datetime(buffer), buffer[self._STATUS_REGISTER],
+                self._temperature(buffer, self._TEMPERATURE_REGISTER))
+
+    def temperature(self):
+        # Die temperature in 0.25 degree steps, converted every 64 seconds
+        return self._temperature(self.i2c.readfrom_mem(self.address,
+                                                       self._TEMPERATURE_REGISTER, 2), 0)
+
+    def _temperature(self, buffer, i):
+        msb = buffer[i] - 256 if buffer[i] & 0x80 else buffer[i]
+        return msb + (buffer[i + 1] >> 6) * 0.25
+
     def alarm_time(self, datetime=None, alarm=0):
+        # Alarm 0 has a seconds register in front of minutes, hours and day,
+        # both are read and written in one go
+        register = self._ALARM_REGISTERS[alarm]
+        seconds = 1 if alarm == 0 else 0
         if datetime is None:
-            buffer = self.i2c.readfrom_mem(self.address,
-                                           self._ALARM_REGISTERS[alarm], 3)
+            buffer = self.i2c.readfrom_mem(self.address, register, 3 + seconds)
             day = None
             weekday = None
             second = None
-            if buffer[2] & 0b10000000:
+            if buffer[seconds + 2] & 0b10000000:
                 pass
-            elif buffer[2] & 0b01000000:
-                day = _bcd2bin(buffer[2] & 0x3f)
+            elif buffer[seconds + 2] & 0b01000000:
+                day = _bcd2bin(buffer[seconds + 2] & 0x3f)
             else:
-                weekday = _bcd2bin(buffer[2] & 0x3f)
-            minute = (_bcd2bin(buffer[0] & 0x7f)
-                      if not buffer[0] & 0x80 else None)
-            hour = (_bcd2bin(buffer[1] & 0x7f)
-                    if not buffer[1] & 0x80 else None)
-            if alarm == 0:
-                # handle seconds
-                buffer = self.i2c.readfrom_mem(
-                    self.address, self._ALARM_REGISTERS[alarm] - 1, 1)
+                weekday = _bcd2bin(buffer[seconds + 2] & 0x3f)
+            minute = (_bcd2bin(buffer[seconds] & 0x7f)
+                      if not buffer[seconds] & 0x80 else None)
+            hour = (_bcd2bin(buffer[seconds + 1] & 0x7f)
+                    if not buffer[seconds + 1] & 0x80 else None)
+            if seconds:
                 second = (_bcd2bin(buffer[0] & 0x7f)
                           if not buffer[0] & 0x80 else None)
             return datetime_tuple(
@@ -164,26 +224,23 @@ class DS3231(_BaseRTC):
                 second=second,
             )
         datetime = datetime_tuple(*datetime)
-        buffer = bytearray(3)
-        buffer[0] = (_bin2bcd(datetime.minute)
-                     if datetime.minute is not None else 0x80)
-        buffer[1] = (_bin2bcd(datetime.hour)
-                     if datetime.hour is not None else 0x80)
+        buffer = bytearray(3 + seconds)
+        if seconds:
+            buffer[0] = (_bin2bcd(datetime.second)
+                         if datetime.second is not None else 0x80)
+        buffer[seconds] = (_bin2bcd(datetime.minute)
+                           if datetime.minute is not None else 0x80)
+        buffer[seconds + 1] = (_bin2bcd(datetime.hour)
+                               if datetime.hour is not None else 0x80)
         if datetime.day is not None:
             if datetime.weekday is not None:
                 raise ValueError("can't specify both day and weekday")
-            buffer[2] = _bin2bcd(datetime.day)
+            buffer[seconds + 2] = _bin2bcd(datetime.day)
         elif datetime.weekday is not None:
-            buffer[2] = _bin2bcd(datetime.weekday) | 0b01000000
+            buffer[seconds + 2] = _bin2bcd(datetime.weekday) | 0b01000000
         else:
-            buffer[2] = 0x80
-        self._register(self._ALARM_REGISTERS[alarm], buffer)
-        if alarm == 0:
-            # handle seconds
-            buffer = bytearray([_bin2bcd(datetime.second)
-                                if datetime.second is not None else 0x80])
-            self._register(self._ALARM_REGISTERS[alarm] - 1, buffer)
-
+            buffer[seconds + 2] = 0x80
+        self._register(register, buffer)
 
 
 class PCF8523(_BaseRTC):
@@ -248,4 +305,70 @@ class PCF8523(_BaseRTC):
                      if datetime.day is not None else 0x80)
         buffer[3] = (_bin2bcd(datetime.weekday) | 0b01000000
                      if datetime.weekday is not None else 0x80)
-        self._register(self._ALARM_REGISTER, buffer)
\ No newline at end of file
+        self._register(self._ALARM_REGISTER, buffer)
+
+class Clock:
+    # Serves epoch seconds from utime.ticks_ms(), anchored to one RTC read.
+    # The RTC is only read again every `resync` seconds, and the measured
+    # rate of the tick counter against the RTC corrects drift in between.
+    #
+    # A plain read only tells the second, so the anchor can be up to a second
+    # behind. edge() anchors on the moment a second of the RTC started (its
+    # alarm interrupt), after which time_ms() is exact to a few ms.
+    _MIN_RATE_MS = 600000
+
+    def __init__(self, rtc, resync=3600):
+        self.rtc = rtc
+        self.resync_ms = resync * 1000
+        self.rate = 1.0
+        self.phased = False
+        self._seconds = None
+        self.sync()
+
+    def sync(self, reset=False, ticks=None):
+        # ticks: when the current second of the RTC started, if known
+        seconds = tuple2seconds(self.rtc.datetime())
+        now = utime.ticks_ms()
+        if ticks is None or not 0 <= utime.ticks_diff(now, ticks) < 1000:
+            ticks = now
+            self.phased = False
+        else:
+            self.phased = True
+        if reset or self._seconds is None:
+            self._total_ms = 0
+            self._total_s = 0
+            self.rate = 1.0
+        else:
+            # accumulate over all syncs, the 1 s resolution of the RTC
+            # matters less the longer we measure
+            self._total_ms += utime.ticks_diff(ticks, self._ticks)
+            self._total_s += seconds - self._seconds
+            if self._total_ms >= self._MIN_RATE_MS:
+                rate = self._total_s * 1000 / self._total_ms
+                if 0.99 < rate < 1.01:
+                    self.rate = rate
+                else:
+                    # the RTC was set in between, start measuring again
+                    self._total_ms = 0
+                    self._total_s = 0
+        self._seconds = seconds
+        self._ticks = ticks
+
+    def edge(self, ticks):
+        # A second of the RTC started at ticks. Resync on it when the anchor
+        # has no phase yet or a resync is almost due
+        if not self.phased or utime.ticks_diff(ticks, self._ticks) >= self.resync_ms - 5000:
+            self.sync(ticks=ticks)
+
+    def time_ms(self):
+        elapsed = utime.ticks_diff(utime.ticks_ms(), self._ticks)
+        if elapsed >= self.resync_ms or elapsed < 0:
+            self.sync()
+            elapsed = utime.ticks_diff(utime.ticks_ms(), self._ticks)
+        return self._seconds * 1000 + int(elapsed * self.rate)
+
+    def time(self):
+        return self.time_ms() // 1000
+
+    def datetime(self):
+        return seconds2tuple(self.time())
@@ -0,0 +1,443 @@
+import _thread
+import random
+import socket
+import time
+import metrics
+
+MAX_RESPONSE = 256
+# Request data is written in pieces of at least a full TCP segment
+SEGMENT = 1460
+
+_ATTEMPT = metrics.stage("upload_attempt")
+_RETRIES = metrics.counter("upload_retries")
+_CONNECTS = metrics.counter("http_connects")
+
+
+class Response:
+    def __init__(self, status_code, text, keep_alive=False):
+        self.status_code = status_code
+        self.text = text
+        self.keep_alive = keep_alive
+
+
+def _split_url(url):
+    try:
+        proto, _, host, path = url.split("/", 3)
+    except ValueError:
+        proto, _, host = url.split("/", 2)
+        path = ""
+    port = 443 if proto == "https:" else 80
+    if ":" in host:
+        host, port = host.split(":", 1)
+        port = int(port)
+    return proto, host, port, path
+
+
+def _write(s, data):
+    data = memoryview(data)
+    while len(data):
+        n = s.write(data)
+        if n is None:
+            n = len(data)
+        data = data[n:]
+
+
+def _drain(s, n, keep):
+    # Read n bytes of body (up to the end of the stream for None), the
+    # first MAX_RESPONSE of them go into keep
+    while n is None or n > 0:
+        data = s.read(256 if n is None else min(256, n))
+        if not data:
+            if n is None:
+                return
+            raise OSError("connection closed in the response body")
+        if len(keep) < MAX_RESPONSE:
+            keep.extend(data[:MAX_RESPONSE - len(keep)])
+        if n is not None:
+            n -= len(data)
+
+
+def _read_response(s):
+    # Read a whole response, so the connection is free for the next request
+    line = s.readline()
+    if not line:
+        raise OSError("connection closed before the response")
+    version, status = line.split(None, 2)[:2]
+    keep_alive = version == b"HTTP/1.1"
+    length = None
+    chunked = False
+    while True:
+        line = s.readline()
+        if not line or line == b"\r\n":
+            break
+        name, _, value = line.partition(b":")
+        name = name.strip().lower()
+        value = value.strip().lower()
+        if name == b"content-length":
+            length = int(value)
+        elif name == b"transfer-encoding":
+            chunked = value == b"chunked"
+        elif name == b"connection":
+            keep_alive = value == b"keep-alive" or (keep_alive and value != b"close")
+    text = bytearray()
+    if chunked:
+        while True:
+            size = int(s.readline().split(b";")[0], 16)
+            if size == 0:
+                while s.readline() not in (b"\r\n", b""):
+                    pass
+                break
+            _drain(s, size, text)
+            s.readline()
+    elif length is not None:
+        _drain(s, length, text)
+    else:
+        # the body ends where the server closes the connection
+        _drain(s, None, text)
+        keep_alive = False
+    return Response(int(status), text.decode(), keep_alive)
+
+
+class Client:
+    # An HTTP/1.1 connection to one server that stays open between
+    # requests, so the batches of an upload pay the TCP and TLS handshake
+    # once. Every response is read to its end, which leaves the connection
+    # ready for the next request. When the server closes it (Connection:
+    # close, HTTP/1.0 or a body without a length) the next request simply
+    # connects again. `reused` tells whether the last request went over a
+    # connection that was already open, a failure there usually only means
+    # the server dropped it while idle.
+    def __init__(self, url, timeout=10):
+        self.proto, self.host, self.port, self.path = _split_url(url)
+        self.timeout = timeout
+        self.sock = None
+        self._raw = None
+        self.reused = False
+        self.connects = 0
+
+    def _connect(self):
+        ai = socket.getaddrinfo(self.host, self.port, 0, socket.SOCK_STREAM)[0]
+        s = self._raw = socket.socket(ai[0], ai[1], ai[2])
+        try:
+            s.settimeout(self.timeout)
+            s.connect(ai[-1])
+            try:
+                # the request is written in full segments already, the last,
+                # partial one must not wait for the ACK of the one before
+                s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            except (AttributeError, OSError):
+                pass
+            if self.proto == "https:":
+                try:
+                    import ssl
+                except ImportError:
+                    import ussl as ssl
+                s = ssl.wrap_socket(s, server_hostname=self.host)
+            if not hasattr(s, "write"):
+                # CPython sockets only offer read/write through a file object
+                s = s.makefile("rwb", 0)
+        except:
+            self._raw.close()
+            self._raw = None
+            raise
+        self.sock = s
+        self.connects += 1
+        _CONNECTS.add()
+
+    def post(self, headers, body, path=None):
+        # POST an iterable of byte chunks with chunked transfer encoding. The
+        # body is produced while it is sent, so neither its full size nor its
+        # contents ever have to be known or held in RAM.
+        #
+        # The request head and the framed chunks (size line, data, CRLF) are
+        # gathered and written once SEGMENT bytes are waiting, the rest with
+        # the closing chunk, so the request leaves in few, full packets.
+        self.reused = self.sock is not None
+        if not self.reused:
+            self._connect()
+        s = self.sock
+        try:
+            out = bytearray(b"POST /%s HTTP/1.1\r\nHost: %s\r\n" % (
+                (self.path if path is None else path).encode(), self.host.encode()))
+            for k in headers:
+                out.extend(b"%s: %s\r\n" % (k.encode(), str(headers[k]).encode()))
+            out.extend(b"Transfer-Encoding: chunked\r\n\r\n")
+            for chunk in body:
+                if len(chunk):
+                    out.extend(b"%x\r\n" % len(chunk))
+                    out.extend(chunk)
+                    out.extend(b"\r\n")
+                    if len(out) >= SEGMENT:
+                        _write(s, out)
+                        out = bytearray()
+            out.extend(b"0\r\n\r\n")
+            _write(s, out)
+            response = _read_response(s)
+        except:
+            self.close()
+            raise
+        if not response.keep_alive:
+            self.close()
+        return response
+
+    def close(self):
+        for s in (self.sock, self._raw):
+            if s is not None:
+                try:
+                    s.close()
+                except OSError:
+                    pass
+        self.sock = self._raw = None
+
+
+def post(url, headers, body):
+    # A single POST on a connection of its own
+    client = Client(url)
+    try:
+        return client.post(headers, body)
+    finally:
+        client.close()
+
+
+class _Compressor:
+    # zlib stream compression on top of whatever the port offers: the
+    # deflate module on MicroPython (1.21+), zlib on CPython
+    def __init__(self):
+        try:
+            import zlib
+            self._z = zlib.compressobj(9, zlib.DEFLATED, 15)
+            self._d = None
+        except (ImportError, AttributeError):
+            import deflate
+            import io
+
+            class Sink(io.IOBase):
+                def __init__(self):
+                    self.data = bytearray()
+
+                def write(self, data):
+                    self.data.extend(data)
+                    return len(data)
+
+            self._z = None
+            self._sink = Sink()
+            self._d = deflate.DeflateIO(self._sink, deflate.ZLIB, 10)
+
+    def _take(self):
+        data = self._sink.data
+        self._sink.data = bytearray()
+        return data
+
+    def compress(self, data):
+        if self._z is not None:
+            return self._z.compress(data)
+        self._d.write(data)
+        return self._take()
+
+    def finish(self):
+        if self._z is not None:
+            return self._z.flush()
+        self._d.close()
+        return self._take()
+
+
+def can_compress():
+    try:
+        _Compressor()
+        return True
+    except (ImportError, AttributeError, ValueError):
+        return False
+
+
+class _Counted:
+    # Wraps a chunk iterator, counting bytes before and after encoding. With
+    # plain (see SampleLog.csv) raw is the size as plain CSV instead
+    def __init__(self, chunks, compress=False, plain=None):
+        self.chunks = chunks
+        self.compressor = _Compressor() if compress else None
+        self.plain = plain
+        self.raw = 0
+        self.sent = 0
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            if self.plain is None:
+                self.raw += len(chunk)
+            else:
+                self.raw = self.plain[0]
+            if self.compressor is not None:
+                chunk = self.compressor.compress(chunk)
+            self.sent += len(chunk)
+            yield chunk
+        if self.compressor is not None:
+            chunk = self.compressor.finish()
+            self.sent += len(chunk)
+            yield chunk
+
+
+# Encodings to try for each url and requested encoding, best first. An encoding the endpoint
+# rejects with 415 Unsupported Media Type is dropped for the rest of the run.
+_encodings = {}
+
+
+def retryable(status):
+    # Server trouble and throttling pass, other 4xx answers would not change
+    return status >= 500 or status in (408, 429)
+
+
+def _backoff(attempt, base, limit=60):
+    # Exponential backoff with jitter: base * 2^(attempt-1) seconds, give or
+    # take half, so loggers that failed together do not retry together
+    return min(limit, base * (1 << (attempt - 1))) * (0.5 + random.random())
+
+
+def upload_log(url, headers, log, batch_records=512, encoding=None, retries=3, backoff=1.0):
+    # Upload the records of a SampleLog that have not been acknowledged yet,
+    # as CSV in batches of at most batch_records (log.batch() may end one
+    # earlier, at the end of a segment), all over one kept-alive connection.
+    # The upload checkpoint in the log header moves after each accepted
+    # batch, so an interrupted upload resumes from there instead of sending
+    # everything again.
+    #
+    # A batch can be sent again safely, so a timeout, a dropped connection
+    # or a 5xx is retried up to `retries` times with exponential backoff
+    # (see _backoff). A 4xx ends the upload right away, the next one starts
+    # over from the same batch. Every attempt is timed as the metrics stage
+    # "upload_attempt".
+    #
+    # encoding "deflate" compresses the CSV while it is sent, falling back to
+    # "delta" rows (see SampleLog.csv) where compression is not available or
+    # the endpoint refuses it, and finally to plain CSV. The response gets
+    # raw_bytes (the batches as plain CSV), sent_bytes, connects and retries
+    # attributes for the whole upload.
+    # Returns the response of the last batch, or None if there was nothing to
+    # send. The last error is raised when a batch failed on every attempt.
+    key = (url, encoding)
+    if key not in _encodings:
+        options = []
+        if encoding == "deflate" and can_compress():
+            options.append("deflate")
+        if encoding in ("deflate", "delta"):
+            options.append("delta")
+        _encodings[key] = options + [None]
+    raw = sent = 0
+    attempt = failures = 0
+    client = Client(url)
+
+    response = None
+    try:
+        while log.pending() > 0:
+            start = log.uploaded
+            end = log.batch(start, batch_records)
+            current = _encodings[key][0]
+            # a delta body is measured against the same rows as plain CSV
+            plain = [0] if current == "delta" else None
+            body = _Counted(log.csv(start, end, delta=current == "delta", plain=plain), current == "deflate", plain)
+            batch_headers = headers
+            if current is not None:
+                batch_headers = dict(headers)
+                batch_headers["Content-Encoding"] = "deflate" if current == "deflate" else "x-delta-csv"
+            t = _ATTEMPT.start()
+            try:
+                response = client.post(batch_headers, body)
+            except OSError as e:
+                _ATTEMPT.stop(t)
+                if client.reused:
+                    # the server dropped the idle connection, send again on a new one
+                    continue
+                if attempt == retries:
+                    raise
+                attempt += 1
+                failures += 1
+                _RETRIES.add()
+                delay = _backoff(attempt, backoff)
+                print('*** Upload: attempt {} failed ({}), retrying in {:.1f} s'.format(attempt, e, delay))
+                time.sleep(delay)
+                continue
+            _ATTEMPT.stop(t)
+            if response.status_code == 415 and current is not None:
+                # not understood, try the next encoding on the same batch
+                print('*** Upload: endpoint refused', current, 'encoding')
+                _encodings[key].pop(0)
+                continue
+            raw += body.raw
+            sent += body.sent
+            if response.status_code in (200, 201, 202):
+                log.acknowledge(end)
+                attempt = 0
+                continue
+            if retryable(response.status_code) and attempt < retries:
+                attempt += 1
+                failures += 1
+                _RETRIES.add()
+                delay = _backoff(attempt, backoff)
+                print('*** Upload: attempt {} got {}, retrying in {:.1f} s'.format(
+                    attempt, response.status_code, delay))
+                time.sleep(delay)
+                continue
+            # keep the checkpoint, the next upload retries this batch
+            break
+        else:
+            # all acknowledged: drop the uploaded records
+            log.compact()
+    finally:
+        client.close()
+
+    if response is not None:
+        response.raw_bytes = raw
+        response.sent_bytes = sent
+        response.connects = client.connects
+        response.retries = failures
+    return response
+
+
+class UploadWorker:
+    # Runs uploads in a thread of its own so that sampling never waits for
+    # the network. request() (a button press) and schedule() (a periodic
+    # upload) only set a flag, so they are safe to call from an interrupt
+    # handler or the event loop; requests that come in while an upload is
+    # running are merged into a single follow-up upload.
+    #
+    # upload(manual) does the actual work, manual is False for scheduled runs.
+    # background(task) has the thread run task() as well, for other work
+    # that may block, such as a DNS lookup.
+
+    def __init__(self, upload):
+        self.upload = upload
+        self.requested = False
+        self.scheduled = False
+        self.busy = False
+        self.tasks = []
+
+    def request(self, *args):
+        self.requested = True
+
+    def schedule(self):
+        self.scheduled = True
+
+    def background(self, task):
+        self.tasks.append(task)
+
+    def start(self):
+        _thread.start_new_thread(self._run, ())
+
+    def _run(self):
+        while True:
+            while self.tasks:
+                task = self.tasks.pop(0)
+                try:
+                    task()
+                except Exception as e:
+                    print('*** Upload worker error:', e)
+            if self.requested or self.scheduled:
+                manual = self.requested
+                self.requested = False
+                self.scheduled = False
+                self.busy = True
+                try:
+                    self.upload(manual)
+                except Exception as e:
+                    print('*** Upload worker error:', e)
+                finally:
+                    self.busy = False
+            time.sleep(0.2)
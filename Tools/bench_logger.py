@@ -0,0 +1,148 @@
+# Benchmark the logger pipeline in the hardware simulation (Tools/sim.py):
+# Code/boot.py runs with simulated sensors, RTC, Wi-Fi and flash, its jobs
+# are stepped through hours of virtual time, then the log is uploaded to the
+# local Data Foundry stand-in once per encoding. Run with CPython:
+#
+#   python Tools/bench_logger.py --hours 24 --flash-write-ms 2
+#   python Tools/bench_logger.py --hours 24 --json > bench.json
+#   python Tools/bench_logger.py --batch-records 64 --handshake-ms 1500 --fail 0.2
+#
+# Reports the time from boot to the first sample, the cost of a sample (sensor reads, aggregation and log writes),
+# I2C traffic, EEPROM page writes, bytes written to flash, peak Python memory while sampling,
+# and upload throughput with the connections and retries it took.
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from sim import Sim  # noqa: E402
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def sampling_jobs(ns):
+    # Everything but the network, telemetry and LED jobs
+    skip = (ns['connectWifi'], ns['syncClock'], ns['showStatus'], ns['publishTelemetry'], ns['uploads'].schedule)
+    return lambda job: job not in skip
+
+
+def bench_sampling(sim, ns, hours):
+    interval = ns['sample_interval']
+    only = sampling_jobs(ns)
+    sim.i2c.reset()
+    sim.flash.reset()
+    page_writes = sim.eeprom.page_writes
+    costs = []
+    with sim.output(True):
+        for _ in range(int(hours * 3600 / interval)):
+            costs.append(sim.step(interval, only))
+        ns['drain']()
+        ns['log'].flush()
+    samples = len(costs)
+    return {
+        'samples': samples,
+        'records': ns['log'].count(),
+        'boot_to_sample_ms': ns['boot_to_sample_ms'],
+        'sample_ms_mean': sum(costs) / samples * 1000,
+        'sample_ms_p95': percentile(costs, 95) * 1000,
+        'sample_ms_max': max(costs) * 1000,
+        'i2c_transactions_per_sample': sim.i2c.transactions / samples,
+        'i2c_bus_us_per_sample': sim.i2c.bus_us / samples,
+        'eeprom_page_writes': sim.eeprom.page_writes - page_writes,
+        'flash_writes': sim.flash.writes,
+        'flash_bytes': sim.flash.bytes,
+        'flash_bytes_per_hour': sim.flash.bytes / hours,
+    }
+
+
+def bench_memory(sim, ns, hours):
+    only = sampling_jobs(ns)
+    tracemalloc.start()
+    with sim.output(True):
+        sim.step(hours * 3600, only)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'peak_kb': peak / 1024}
+
+
+def bench_upload(sim, ns, encoding, batch_records):
+    # Upload a copy of the log, so every encoding sends the same records
+    import samplelog
+    import uploader
+    log = ns['log']
+    log.flush()
+    name = 'bench_{}'.format(encoding)
+    for filename in os.listdir():
+        if filename.startswith(log.name + '.'):
+            shutil.copy(filename, name + filename[len(log.name):])
+    copy = samplelog.SegmentedLog(name, log.fields, log.scales, segment_records=log.segment_records)
+    records = copy.pending()
+    connections = sim.df.connections
+    start = time.perf_counter()
+    with sim.output(True):
+        response = uploader.upload_log(sim.upload_url, ns['headers'], copy, batch_records, encoding=encoding)
+    elapsed = time.perf_counter() - start
+    copy.close()
+    return {
+        'encoding': encoding or 'plain',
+        'status': response.status_code,
+        'records': records,
+        'raw_bytes': response.raw_bytes,
+        'sent_bytes': response.sent_bytes,
+        'connections': sim.df.connections - connections,
+        'retries': response.retries,
+        'seconds': elapsed,
+        'records_per_s': records / elapsed,
+        'kb_per_s': response.sent_bytes / 1024 / elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Logger pipeline benchmark')
+    parser.add_argument('--hours', type=float, default=24, help='virtual hours to sample')
+    parser.add_argument('--flash-write-ms', type=float, default=0)
+    parser.add_argument('--flash-byte-us', type=float, default=0)
+    parser.add_argument('--batch-records', type=int, default=512, help='records per upload batch')
+    parser.add_argument('--handshake-ms', type=float, default=0, help='delay of every new upload connection')
+    parser.add_argument('--fail', type=float, default=0, help='fraction of upload batches answered with 503')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+
+    sim = Sim(flash_write_ms=args.flash_write_ms, flash_byte_us=args.flash_byte_us)
+    sim.start_servers(handshake_ms=args.handshake_ms, fail=args.fail)
+    ns = sim.boot(quiet=True)
+    results = {
+        'sampling': bench_sampling(sim, ns, args.hours),
+        'memory': bench_memory(sim, ns, 1),
+        'upload': [bench_upload(sim, ns, encoding, args.batch_records) for encoding in (None, 'delta', 'deflate')],
+    }
+    sim.stop()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    s = results['sampling']
+    print('boot: first sample after {boot_to_sample_ms} ms'.format(**s))
+    print('sampling: {samples} samples, {records} records'.format(**s))
+    print('  per sample {sample_ms_mean:.3f} ms mean, {sample_ms_p95:.3f} ms p95, {sample_ms_max:.3f} ms max'.format(**s))
+    print('  i2c {i2c_transactions_per_sample:.2f} transactions, {i2c_bus_us_per_sample:.0f} us bus time per sample'.format(**s))
+    print('  eeprom {eeprom_page_writes} page writes'.format(**s))
+    print('  flash {flash_writes} writes, {flash_bytes} bytes ({flash_bytes_per_hour:.0f} bytes/hour)'.format(**s))
+    print('  peak memory {peak_kb:.1f} kB'.format(**results['memory']))
+    for u in results['upload']:
+        print('upload {encoding}: {status}, {records} records, {raw_bytes} -> {sent_bytes} bytes in {seconds:.3f}s '
+              '({records_per_s:.0f} records/s, {kb_per_s:.1f} kB/s), {connections} connection(s), '
+              '{retries} retries'.format(**u))
+
+
+if __name__ == '__main__':
+    main()
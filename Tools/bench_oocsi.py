@@ -0,0 +1,90 @@
+# Benchmark the OOCSI client against the local stand-in server: N clients
+# subscribe to one channel, a publisher sends M timestamped messages and every
+# client records when each one arrives. Run with CPython:
+#
+#   python Tools/bench_oocsi.py --clients 200 --messages 200 --mode engine
+#   python Tools/bench_oocsi.py --clients 200 --messages 200 --mode thread
+#
+# "engine" drives all clients from one OOCSIEngine loop, "thread" uses the
+# classic thread per client.
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'Code', 'lib'))
+
+import OOCSI as oocsi  # noqa: E402
+from oocsi_server import OOCSIServer  # noqa: E402
+
+# keep the clients quiet, hundreds of them log a lot
+oocsi.OOCSI.log = lambda self, message: None
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def bench(clients, messages, mode, port=0):
+    server = OOCSIServer(port).start()
+    latencies = []
+    lock = threading.Lock()
+
+    def received(sender, recipient, event):
+        now = time.perf_counter()
+        with lock:
+            latencies.append(now - event['t'])
+
+    engine = oocsi.OOCSIEngine() if mode == 'engine' else None
+    connections = []
+    for i in range(clients):
+        o = oocsi.OOCSI('bench_client_{0}'.format(i), 'localhost', server.port, wait=False, engine=engine)
+        o.subscribe('bench', received)
+        connections.append(o)
+    if engine is not None:
+        runner = threading.Thread(target=engine.run, daemon=True)
+        runner.start()
+
+    deadline = time.time() + 30
+    while not all(o.connected for o in connections) and time.time() < deadline:
+        time.sleep(0.05)
+    time.sleep(0.5)  # let the subscriptions land
+
+    publisher = oocsi.OOCSI('bench_publisher', 'localhost', server.port)
+    expected = clients * messages
+    start = time.perf_counter()
+    for i in range(messages):
+        publisher.send('bench', {'i': i, 't': time.perf_counter()})
+    while len(latencies) < expected and time.perf_counter() - start < 60:
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - start
+
+    publisher.stop()
+    if engine is not None:
+        # the engine is not thread safe, its own thread stops the clients
+        engine.stop()
+        runner.join()
+    else:
+        for o in connections:
+            o.stop()
+    server.stop()
+
+    received_count = len(latencies)
+    print('{0}: {1} clients x {2} messages, {3}/{4} delivered in {5:.2f}s'.format(
+        mode, clients, messages, received_count, expected, elapsed))
+    print('  throughput {0:.0f} messages/s'.format(received_count / elapsed))
+    if latencies:
+        print('  latency p50 {0:.1f} ms, p95 {1:.1f} ms, p99 {2:.1f} ms'.format(
+            *(percentile(latencies, p) * 1000 for p in (50, 95, 99))))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='OOCSI client benchmark')
+    parser.add_argument('--clients', type=int, default=100)
+    parser.add_argument('--messages', type=int, default=100)
+    parser.add_argument('--mode', choices=('engine', 'thread'), default='engine')
+    args = parser.parse_args()
+    bench(args.clients, args.messages, args.mode)
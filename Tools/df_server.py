@@ -0,0 +1,130 @@
+# Local stand-in for the Data Foundry logFile endpoint, for trying uploads
+# off-device. Run with CPython:
+#
+#   python Tools/df_server.py --port 8080 --out received.csv
+#
+# and point the uploader at http://<this-machine>:8080/datasets/ts/logFile/<id>.
+#
+# Bodies sent with Content-Encoding deflate or x-delta-csv are decoded back
+# to plain CSV before they are checked and stored. --accept limits which
+# encodings are taken, others are answered with 415.
+#
+# Connections are kept alive between requests. --handshake-ms delays every
+# new connection, like a TLS handshake would, and --fail answers that
+# fraction of the uploads with 503 to try the retries.
+
+import argparse
+import random
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class DataFoundryHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+        time.sleep(self.server.handshake_ms / 1000)
+
+    def read_body(self):
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            body = bytearray()
+            while True:
+                size = int(self.rfile.readline().split(b";")[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return bytes(body)
+                body += self.rfile.read(size)
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def decode_delta(self, body):
+        # Undo SampleLog.csv(delta=True): rows after the first hold "+seconds"
+        # and value changes, empty when unchanged
+        lines = body.decode().split("\n")
+        out = [lines[0]]
+        previous = None
+        for line in lines[1:]:
+            if not line:
+                continue
+            fields = line.split(",")
+            if previous is None or not fields[0].startswith("+"):
+                # absolute, an empty value is missing
+                previous = [self.parse_ts(fields[0])] + [float(v) if v else None for v in fields[1:]]
+            else:
+                previous = [previous[0] + int(fields[0][1:])] + [
+                    p + float(d) if d else p for p, d in zip(previous[1:], fields[1:])]
+            t = time.localtime(previous[0])
+            out.append(",".join(["{}-{}-{}T{}:{}:{}".format(*t[:6])] + [
+                "" if v is None else "{:g}".format(round(v, 6)) for v in previous[1:]]))
+        return ("\n".join(out) + "\n").encode()
+
+    def parse_ts(self, ts):
+        date, clock = ts.split("T")
+        return int(time.mktime(tuple(int(v) for v in date.split("-") + clock.split(":")) + (0, 0, -1)))
+
+    def do_POST(self):
+        start = time.time()
+        body = self.read_body()
+        if "/datasets/ts/logFile/" not in self.path:
+            return self.reply(404, "not found")
+        if not self.headers.get("api_token"):
+            return self.reply(401, "missing api_token")
+        if random.random() < self.server.fail:
+            return self.reply(503, "try again later")
+
+        sent = len(body)
+        encoding = self.headers.get("Content-Encoding", "identity")
+        if encoding != "identity" and encoding not in self.server.accept:
+            return self.reply(415, "unsupported encoding " + encoding)
+        if encoding == "deflate":
+            body = zlib.decompress(body)
+        elif encoding == "x-delta-csv":
+            body = self.decode_delta(body)
+        rows = body.count(b"\n")
+        if not body.startswith(b"ts,"):
+            return self.reply(400, "missing header")
+
+        with open(self.server.out, "ab") as f:
+            f.write(body)
+        elapsed = time.time() - start
+        print("received {} bytes ({}, {:.1f}x), {} rows in {:.3f}s ({:.0f} kB/s)".format(
+            sent, encoding, len(body) / max(sent, 1), rows - 1, elapsed, sent / 1024 / max(elapsed, 1e-6)))
+        self.reply(200, "ok {} rows".format(rows - 1))
+
+    def reply(self, code, text):
+        data = text.encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port=8080, out="received.csv", accept=("deflate", "x-delta-csv"), handshake_ms=0, fail=0.0):
+    server = ThreadingHTTPServer(("", port), DataFoundryHandler)
+    server.out = out
+    server.accept = accept
+    server.handshake_ms = handshake_ms
+    server.fail = fail
+    server.connections = 0
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--out", default="received.csv")
+    parser.add_argument("--accept", default="deflate,x-delta-csv",
+                        help="comma separated content encodings to accept besides plain")
+    parser.add_argument("--handshake-ms", type=float, default=0, help="delay of every new connection")
+    parser.add_argument("--fail", type=float, default=0, help="fraction of uploads answered with 503")
+    args = parser.parse_args()
+    print("Data Foundry stand-in listening on port", args.port)
+    serve(args.port, args.out, args.accept.split(","), args.handshake_ms, args.fail).serve_forever()
@@ -0,0 +1,150 @@
+# Minimal local stand-in for an OOCSI server, enough for the MicroPython
+# client in Code/lib/OOCSI.py: the JSON handshake, subscribe, unsubscribe,
+# sendraw to channels and handles, pings and quit. Run with CPython:
+#
+#   python Tools/oocsi_server.py --port 4444
+
+import argparse
+import json
+import selectors
+import socket
+import threading
+import time
+
+
+class Connection:
+    def __init__(self, sock):
+        self.sock = sock
+        self.handle = None
+        self.inbox = bytearray()
+        self.outbox = bytearray()
+        self.channels = set()
+
+
+class OOCSIServer:
+    def __init__(self, port=4444, host=''):
+        self.selector = selectors.DefaultSelector()
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen(1024)
+        self.listener.setblocking(False)
+        self.port = self.listener.getsockname()[1]
+        self.selector.register(self.listener, selectors.EVENT_READ)
+        self.channels = {}
+        self.handles = {}
+        self.running = True
+
+    def start(self):
+        # Serve from a daemon thread, returns self
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def serve_forever(self):
+        while self.running:
+            for key, events in self.selector.select(0.5):
+                if key.fileobj is self.listener:
+                    self.accept()
+                    continue
+                conn = key.data
+                if events & selectors.EVENT_READ:
+                    self.read(conn)
+                if events & selectors.EVENT_WRITE and conn.sock.fileno() >= 0:
+                    self.flush(conn)
+
+    def stop(self):
+        self.running = False
+
+    def accept(self):
+        sock, _ = self.listener.accept()
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.selector.register(sock, selectors.EVENT_READ, Connection(sock))
+
+    def read(self, conn):
+        try:
+            data = conn.sock.recv(65536)
+        except BlockingIOError:
+            return
+        except ConnectionError:
+            data = b''
+        if not data:
+            return self.close(conn)
+        conn.inbox += data
+        while True:
+            i = conn.inbox.find(b'\n')
+            if i < 0:
+                break
+            line = conn.inbox[:i].decode()
+            del conn.inbox[:i + 1]
+            self.command(conn, line)
+
+    def command(self, conn, line):
+        if conn.handle is None:
+            if line.endswith('(JSON)'):
+                conn.handle = line[:-6]
+                self.handles[conn.handle] = conn
+                self.write(conn, json.dumps({'message': 'welcome ' + conn.handle}))
+            else:
+                self.write(conn, 'error (only JSON clients supported)')
+                self.close(conn)
+        elif line.startswith('subscribe '):
+            channel = line[10:].strip()
+            conn.channels.add(channel)
+            self.channels.setdefault(channel, set()).add(conn)
+        elif line.startswith('unsubscribe '):
+            channel = line[12:].strip()
+            conn.channels.discard(channel)
+            self.channels.get(channel, set()).discard(conn)
+        elif line.startswith('sendraw '):
+            _, recipient, data = line.split(' ', 2)
+            self.publish(conn.handle, recipient, json.loads(data))
+        elif line == 'quit':
+            self.close(conn)
+
+    def publish(self, sender, recipient, data):
+        data['sender'] = sender
+        data['recipient'] = recipient
+        data['timestamp'] = int(time.time() * 1000)
+        line = json.dumps(data)
+        targets = set(self.channels.get(recipient, ()))
+        if recipient in self.handles:
+            targets.add(self.handles[recipient])
+        for conn in targets:
+            self.write(conn, line)
+
+    def write(self, conn, line):
+        was_empty = not conn.outbox
+        conn.outbox += (line + '\n').encode()
+        if was_empty:
+            self.flush(conn)
+
+    def flush(self, conn):
+        if conn.outbox:
+            try:
+                n = conn.sock.send(conn.outbox)
+            except BlockingIOError:
+                n = 0
+            except OSError:
+                return self.close(conn)
+            del conn.outbox[:n]
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if conn.outbox else 0)
+        self.selector.modify(conn.sock, events, conn)
+
+    def close(self, conn):
+        if conn.sock.fileno() < 0:
+            return
+        self.selector.unregister(conn.sock)
+        conn.sock.close()
+        for channel in conn.channels:
+            self.channels.get(channel, set()).discard(conn)
+        if self.handles.get(conn.handle) is conn:
+            del self.handles[conn.handle]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local stand-in OOCSI server')
+    parser.add_argument('--port', type=int, default=4444)
+    args = parser.parse_args()
+    print('OOCSI stand-in listening on port', args.port)
+    OOCSIServer(args.port).serve_forever()
@@ -0,0 +1,673 @@
+# Hardware simulation for running the logger off-device with CPython. It
+# installs fake versions of the MicroPython modules Code/boot.py and
+# Code/lib use (machine, network, dht, neopixel, utime, ucollections and
+# secrets), backed by models that can be scripted:
+#
+#   SimClock   virtual time, runs along with real time and can be advanced
+#   DS3231     register level model on the fake I2C bus: BCD datetime with
+#              drift, control/status flags, both alarms and the temperature
+#   AT24C32    the EEPROM next to it: page writes and the write cycle
+#   DHTModel   scripted humidity/temperature, timeouts when read too often
+#   WifiModel  connects after a delay, can be taken away
+#   FlashFS    file access of the sample log with a write latency
+#
+# plus the local Data Foundry and OOCSI stand-ins. Sim.boot() runs the real
+# Code/boot.py, then either Sim.run() drives its jobs in real time or
+# Sim.step() in virtual time. Tools/bench_logger.py uses it:
+#
+#   sim = Sim(flash_write_ms=2)
+#   sim.start_servers()
+#   ns = sim.boot()                  # the globals of boot.py
+#   sim.step(3600)                   # an hour of jobs in virtual time
+#   sim.press()                      # the upload button
+#   sim.stop()
+
+import asyncio
+import calendar
+import collections
+import contextlib
+import io
+import math
+import os
+import sys
+import tempfile
+import threading
+import time
+import types
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CODE = os.path.join(HERE, '..', 'Code')
+sys.path.insert(0, os.path.join(CODE, 'lib'))
+sys.path.insert(0, HERE)
+
+_TICKS_PERIOD = 1 << 30
+_ETIMEDOUT = 110
+_ENODEV = 19
+
+
+class SimClock:
+    # Epoch seconds and a monotonic counter that follow real time, plus
+    # whatever advance() added on top
+    def __init__(self, start=None):
+        self.start = time.time() if start is None else start
+        self._t0 = time.monotonic()
+        self.offset = 0.0
+
+    def monotonic(self):
+        return time.monotonic() - self._t0 + self.offset
+
+    def now(self):
+        return self.start + self.monotonic()
+
+    def advance(self, seconds):
+        if seconds > 0:
+            self.offset += seconds
+
+
+# I2C devices
+#---------------------------------------------------------------------------
+
+def _bcd(value):
+    return value + 6 * (value // 10)
+
+
+def _unbcd(value):
+    return value - 6 * (value >> 4)
+
+
+class DS3231:
+    # Registers 0x00-0x12 of the DS3231. The time keeping registers are
+    # computed from the clock on every access, writes to them set the time.
+    # drift_ppm makes the chip run fast (or slow when negative).
+    address = 0x68
+
+    def __init__(self, clock, now=None, drift_ppm=0, temperature=24.0, lost_power=True):
+        self.clock = clock
+        self.drift_ppm = drift_ppm
+        self.temperature = temperature
+        self.regs = bytearray(0x13)
+        self.regs[0x0e] = 0x1c
+        self.regs[0x0f] = 0x80 if lost_power else 0
+        self.on_interrupt = None
+        self.lock = threading.RLock()
+        self._set(clock.now() if now is None else now)
+        self._checked = int(self.now())
+        self._converted = None
+        self._update()
+
+    def _set(self, seconds):
+        self._base = seconds
+        self._at = self.clock.monotonic()
+
+    def now(self):
+        return self._base + (self.clock.monotonic() - self._at) * (1 + self.drift_ppm / 1e6)
+
+    def _time_registers(self, seconds):
+        t = time.gmtime(int(seconds))
+        return bytes((_bcd(t.tm_sec), _bcd(t.tm_min), _bcd(t.tm_hour), t.tm_wday + 1,
+                      _bcd(t.tm_mday), _bcd(t.tm_mon), _bcd(t.tm_year - 2000)))
+
+    def _update(self):
+        # Latch the time, run the alarms for every second since the last
+        # access and convert the temperature every 64 seconds
+        now = self.now()
+        self.regs[0:7] = self._time_registers(now)
+        second = int(now)
+        self._checked = max(self._checked, second - 8 * 86400)
+        while self._checked < second:
+            self._checked += 1
+            self._alarms(self._checked)
+        if self._converted != second // 64:
+            self._converted = second // 64
+            value = self.temperature(now) if callable(self.temperature) else self.temperature
+            quarters = int(math.floor(value * 4))
+            self.regs[0x11] = (quarters >> 2) & 0xff
+            self.regs[0x12] = (quarters & 3) << 6
+
+    def _alarms(self, second):
+        t = self._time_registers(second)
+        # alarm 1: seconds, minutes, hours, day/date with A1M1-A1M4 masks
+        if self._match(self.regs[0x07:0x0b], t, seconds=True):
+            self._flag(0)
+        # alarm 2: minutes, hours, day/date, on the start of a minute
+        if t[0] == 0 and self._match(self.regs[0x0b:0x0e], t, seconds=False):
+            self._flag(1)
+
+    def _match(self, alarm, t, seconds):
+        fields = (t[0], t[1], t[2]) if seconds else (t[1], t[2])
+        for value, actual in zip(alarm, fields):
+            if not value & 0x80 and value & 0x7f != actual:
+                return False
+        day = alarm[-1]
+        if day & 0x80:
+            return True
+        if day & 0x40:
+            return day & 0x0f == t[3]
+        return day & 0x3f == t[4]
+
+    def _flag(self, alarm):
+        self.regs[0x0f] |= 1 << alarm
+        control = self.regs[0x0e]
+        if control & 0x04 and control & (1 << alarm) and self.on_interrupt:
+            self.on_interrupt()
+
+    def poll(self):
+        # Let time pass on the chip without a bus access, for the alarms
+        with self.lock:
+            self._update()
+
+    def read(self, register, n):
+        with self.lock:
+            self._update()
+            return bytes(self.regs[(register + i) % 0x13] for i in range(n))
+
+    def write(self, register, data):
+        with self.lock:
+            self._write(register, data)
+
+    def _write(self, register, data):
+        self._update()
+        time_written = False
+        for i, value in enumerate(data):
+            r = (register + i) % 0x13
+            if r == 0x0f:
+                # flags can only be cleared, BSY is read only
+                value = (self.regs[r] & value & 0x83) | (value & 0x08)
+            elif r in (0x11, 0x12):
+                continue
+            self.regs[r] = value
+            time_written |= r < 7
+        if time_written:
+            r = self.regs
+            self._set(calendar.timegm((2000 + _unbcd(r[6]), _unbcd(r[5] & 0x1f), _unbcd(r[4]),
+                                       _unbcd(r[2] & 0x3f), _unbcd(r[1]), _unbcd(r[0] & 0x7f))))
+            self._checked = int(self.now())
+
+
+class AT24C32:
+    # 4 KiB with 32 byte pages and 16 bit addresses. A write wraps within
+    # its page like on the chip, and for write_ms afterwards the chip does
+    # not acknowledge. The contents live in `memory`, across Sim restarts
+    # when the same object is passed in
+    address = 0x57
+
+    def __init__(self, size=4096, page=32, write_ms=5, memory=None):
+        self.size = size
+        self.page = page
+        self.write_ms = write_ms
+        self.memory = memory if memory is not None else bytearray(b'\xff' * size)
+        self.page_writes = 0
+        self._busy_until = 0
+
+    def _check(self):
+        if time.monotonic() < self._busy_until:
+            raise OSError(_ENODEV)
+
+    def ack(self):
+        self._check()
+
+    def read(self, address, n):
+        self._check()
+        return bytes(self.memory[(address + i) % self.size] for i in range(n))
+
+    def write(self, address, data):
+        self._check()
+        base = address - address % self.page
+        for i, value in enumerate(data):
+            self.memory[(base + (address - base + i) % self.page) % self.size] = value
+        self.page_writes += 1
+        self._busy_until = time.monotonic() + self.write_ms / 1000
+
+
+class I2CBus:
+    # The devices behind every fake machine.I2C, with transaction counters
+    def __init__(self):
+        self.devices = {}
+        self.reset()
+
+    def reset(self):
+        self.transactions = 0
+        self.bytes = 0
+        self.bus_us = 0.0
+
+    def attach(self, device):
+        self.devices[device.address] = device
+        return device
+
+    def device(self, address, freq, n, overhead=3):
+        if address not in self.devices:
+            raise OSError(_ENODEV)
+        # address, register, repeated start and the data, 9 clocks a byte
+        self.transactions += 1
+        self.bytes += n
+        self.bus_us += (overhead + n) * 9 * 1e6 / freq
+        return self.devices[address]
+
+
+# Other hardware
+#---------------------------------------------------------------------------
+
+class DHTModel:
+    # values is a function of epoch seconds returning (humidity, temperature),
+    # or a list of such tuples read in turn. failures makes that many of the
+    # next reads time out.
+    def __init__(self, clock, values=None, min_interval=1.0, measure_ms=0, resolution=1):
+        self.clock = clock
+        self.values = values or (lambda t: (50 + 10 * math.sin(t / 3600), 21 + 3 * math.sin(t / 7200)))
+        self.min_interval = min_interval
+        self.measure_ms = measure_ms
+        self.resolution = resolution
+        self.failures = 0
+        self.reads = 0
+        self.last = None
+        self.humidity = self.temperature = None
+
+    def measure(self):
+        now = self.clock.monotonic()
+        if self.measure_ms:
+            time.sleep(self.measure_ms / 1000)
+        too_soon = self.last is not None and now - self.last < self.min_interval
+        self.last = now
+        if self.failures or too_soon:
+            self.failures = max(0, self.failures - 1)
+            raise OSError(_ETIMEDOUT)
+        if callable(self.values):
+            values = self.values(self.clock.now())
+        else:
+            values = self.values[min(self.reads, len(self.values) - 1)]
+        self.reads += 1
+        r = self.resolution
+        self.humidity, self.temperature = (round(v / r) * r if r != 1 else int(round(v)) for v in values)
+
+
+class WifiModel:
+    # Connects connect_delay seconds after connect() while available
+    def __init__(self, clock, connect_delay=1.0, available=True):
+        self.clock = clock
+        self.connect_delay = connect_delay
+        self.available = available
+        self.connecting = None
+        self.connects = 0
+
+    def isconnected(self):
+        if not self.available:
+            self.connecting = None
+            return False
+        return self.connecting is not None and self.clock.monotonic() - self.connecting >= self.connect_delay
+
+
+class FlashFS:
+    # open() for the sample log and its manifest, counting writes and sleeping write_ms per
+    # write plus byte_us per byte written
+    def __init__(self, write_ms=0, byte_us=0):
+        self.write_ms = write_ms
+        self.byte_us = byte_us
+        self.reset()
+
+    def reset(self):
+        self.writes = 0
+        self.bytes = 0
+
+    def open(self, path, mode='r', *args, **kwargs):
+        f = open(path, mode, *args, **kwargs)
+        if 'w' in mode or 'a' in mode or '+' in mode:
+            return _FlashFile(self, f)
+        return f
+
+
+class _FlashFile:
+    def __init__(self, fs, f):
+        self._fs = fs
+        self._f = f
+
+    def write(self, data):
+        fs = self._fs
+        fs.writes += 1
+        fs.bytes += len(data)
+        latency = fs.write_ms / 1000 + len(data) * fs.byte_us / 1e6
+        if latency:
+            time.sleep(latency)
+        return self._f.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self._f, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._f.close()
+
+
+# Fake MicroPython modules
+#---------------------------------------------------------------------------
+
+def _module(name, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    return module
+
+
+def _utime(clock):
+    def ticks_ms():
+        return int(clock.monotonic() * 1000) % _TICKS_PERIOD
+
+    def ticks_us():
+        return int(clock.monotonic() * 1000000) % _TICKS_PERIOD
+
+    def ticks_add(ticks, delta):
+        return (ticks + delta) % _TICKS_PERIOD
+
+    def ticks_diff(a, b):
+        return (a - b + _TICKS_PERIOD // 2) % _TICKS_PERIOD - _TICKS_PERIOD // 2
+
+    def localtime(seconds=None):
+        return tuple(time.gmtime(clock.now() if seconds is None else seconds))[:8]
+
+    def mktime(t):
+        return calendar.timegm(tuple(t[:6]))
+
+    return _module('utime', ticks_ms=ticks_ms, ticks_us=ticks_us, ticks_cpu=ticks_us,
+                   ticks_add=ticks_add, ticks_diff=ticks_diff, localtime=localtime,
+                   gmtime=localtime, mktime=mktime, time=lambda: int(clock.now()),
+                   sleep=time.sleep, sleep_ms=lambda ms: time.sleep(ms / 1000),
+                   sleep_us=lambda us: time.sleep(us / 1000000))
+
+
+def _machine(sim):
+    class Pin:
+        IN, OUT, OPEN_DRAIN = 1, 3, 7
+        PULL_UP, PULL_DOWN = 1, 2
+        IRQ_RISING, IRQ_FALLING = 1, 2
+
+        def __init__(self, id, mode=-1, pull=-1, value=None):
+            self.id = id
+            self._value = 1 if pull == Pin.PULL_UP else 0 if value is None else value
+            self.handler = None
+            sim.pins[id] = self
+
+        def value(self, value=None):
+            if value is None:
+                return self._value
+            self._value = value
+
+        __call__ = value
+
+        def irq(self, handler=None, trigger=IRQ_RISING | IRQ_FALLING):
+            self.handler = handler
+
+    class I2C:
+        def __init__(self, id=-1, scl=None, sda=None, freq=400000):
+            self.freq = freq
+
+        def scan(self):
+            return sorted(sim.i2c.devices)
+
+        def readfrom_mem(self, address, register, n, addrsize=8):
+            return sim.i2c.device(address, self.freq, n, 2 + addrsize // 8).read(register, n)
+
+        def readfrom_mem_into(self, address, register, buf, addrsize=8):
+            buf[:] = sim.i2c.device(address, self.freq, len(buf), 2 + addrsize // 8).read(register, len(buf))
+
+        def writeto_mem(self, address, register, buf, addrsize=8):
+            sim.i2c.device(address, self.freq, len(buf), 1 + addrsize // 8).write(register, bytes(buf))
+
+        def writeto(self, address, buf, stop=True):
+            device = sim.i2c.device(address, self.freq, len(buf), 1)
+            if hasattr(device, 'ack'):
+                device.ack()
+            return len(buf) + 1
+
+    return _module('machine', Pin=Pin, I2C=I2C, SoftI2C=I2C, freq=lambda *a: 240000000,
+                   unique_id=lambda: b'\xa0\xb1\xc2\xd3\xe4\xf5', reset=sim.reset_requested)
+
+
+def _network(sim):
+    class WLAN:
+        def __init__(self, interface=0):
+            self._active = False
+
+        def active(self, value=None):
+            if value is None:
+                return self._active
+            self._active = bool(value)
+
+        def connect(self, ssid=None, key=None):
+            sim.wifi.connects += 1
+            if sim.wifi.available and sim.wifi.connecting is None:
+                sim.wifi.connecting = sim.clock.monotonic()
+
+        def disconnect(self):
+            sim.wifi.connecting = None
+
+        def isconnected(self):
+            return self._active and sim.wifi.isconnected()
+
+        def status(self, *args):
+            return 1010 if self.isconnected() else 1000
+
+        def config(self, name):
+            if name == 'mac':
+                return b'\xa0\xb1\xc2\xd3\xe4\xf5'
+            raise ValueError(name)
+
+        def ifconfig(self):
+            return ('127.0.0.1', '255.0.0.0', '127.0.0.1', '127.0.0.1')
+
+    return _module('network', STA_IF=0, AP_IF=1, WLAN=WLAN)
+
+
+def _dht(sim):
+    class DHT11:
+        def __init__(self, pin):
+            self.model = sim.dht
+
+        def measure(self):
+            self.model.measure()
+
+        def humidity(self):
+            return self.model.humidity
+
+        def temperature(self):
+            return self.model.temperature
+
+    return _module('dht', DHT11=DHT11, DHT22=DHT11)
+
+
+def _neopixel(sim):
+    class NeoPixel:
+        def __init__(self, pin, n):
+            self.pixels = [(0, 0, 0)] * n
+            self.writes = 0
+            sim.leds = self
+
+        def __setitem__(self, i, color):
+            self.pixels[i] = tuple(color)
+
+        def __getitem__(self, i):
+            return self.pixels[i]
+
+        def __len__(self):
+            return len(self.pixels)
+
+        def fill(self, color):
+            self.pixels = [tuple(color)] * len(self.pixels)
+
+        def write(self):
+            self.writes += 1
+
+    return _module('neopixel', NeoPixel=NeoPixel)
+
+
+# Harness
+#---------------------------------------------------------------------------
+
+class Sim:
+    def __init__(self, workdir=None, start=None, flash_write_ms=0, flash_byte_us=0,
+                 rtc_drift_ppm=0, wifi_delay=1.0, eeprom=None):
+        self.workdir = workdir or tempfile.mkdtemp(prefix='sim_')
+        self.clock = SimClock(start)
+        self.i2c = I2CBus()
+        self.rtc = self.i2c.attach(DS3231(self.clock, drift_ppm=rtc_drift_ppm))
+        self.rtc.on_interrupt = self._rtc_interrupt
+        self.eeprom = self.i2c.attach(eeprom or AT24C32())
+        self.dht = DHTModel(self.clock)
+        self.wifi = WifiModel(self.clock, wifi_delay)
+        self.flash = FlashFS(flash_write_ms, flash_byte_us)
+        self.pins = {}
+        self.leds = None
+        self.resets = 0
+        self.upload_url = 'http://127.0.0.1:1/datasets/ts/logFile/1'
+        self.oocsi_port = self.time_port = 1
+        self.df = self.oocsi = self.ntp = None
+        self.ns = None
+        self._schedule = None
+        self._loop = None
+
+    def _rtc_interrupt(self):
+        # The DS3231 pulls INT/SQW low, the pin that boot.py has on it fires
+        pin = self.pins.get(self.ns.get('rtc_int_pin')) if self.ns else None
+        if pin is not None and pin.handler:
+            pin.handler(pin)
+
+    def reset_requested(self):
+        self.resets += 1
+
+    def install(self):
+        # Put the fake modules in place of the MicroPython ones
+        os.environ['TZ'] = 'UTC'
+        time.tzset()
+        os.chdir(self.workdir)
+        sys.modules['utime'] = _utime(self.clock)
+        sys.modules['ucollections'] = collections
+        import OOCSI
+        import uRTC
+        sys.modules.update({
+            'machine': _machine(self),
+            'network': _network(self),
+            'dht': _dht(self),
+            'neopixel': _neopixel(self),
+            'urtc': uRTC,
+            'oocsi': OOCSI,
+        })
+        # a uRTC imported before uses the utime of an earlier Sim
+        uRTC.utime = sys.modules['utime']
+        for name in ('runtime', 'samplelog', 'sensors', 'uploader', 'aggregate', 'eeprom', 'timesync', 'livestream'):
+            sys.modules.pop(name, None)
+        import samplelog
+        samplelog.open = self.flash.open
+        sys.modules['secrets'] = _module(
+            'secrets', ssid='sim', wifipass='sim', api_token='sim-token', device_id='sim-device',
+            dataset_id=1, upload_url=self.upload_url, oocsi_host='127.0.0.1', oocsi_port=self.oocsi_port,
+            time_host='127.0.0.1', time_port=self.time_port)
+
+    def start_servers(self, accept=('deflate', 'x-delta-csv'), handshake_ms=0, fail=0.0):
+        # The Data Foundry, OOCSI and time server stand-ins on free local
+        # ports. The time server serves the true time of the simulation
+        import df_server
+        from oocsi_server import OOCSIServer
+        from time_server import TimeServer
+        self.df = df_server.serve(0, os.path.join(self.workdir, 'received.csv'), accept, handshake_ms, fail)
+        threading.Thread(target=self.df.serve_forever, daemon=True).start()
+        self.upload_url = 'http://127.0.0.1:{}/datasets/ts/logFile/1'.format(self.df.server_address[1])
+        self.oocsi = OOCSIServer(0).start()
+        self.oocsi_port = self.oocsi.port
+        self.ntp = TimeServer(0, clock=self.clock.now).start()
+        self.time_port = self.ntp.port
+
+    def boot(self, quiet=False, **settings):
+        # Run Code/boot.py up to jobs.run(), returns its globals. The jobs are
+        # then driven by run() or step(). Keyword arguments override the
+        # settings at the top of boot.py
+        self.install()
+        import runtime
+        sim = self
+
+        def run(jobs):
+            sim.jobs = jobs
+
+        runtime.Runtime.run = run
+        path = os.path.join(CODE, 'boot.py')
+        with open(path) as f:
+            source = f.read()
+        if settings:
+            # right after the settings, before the first section
+            at = source.index('\n# Metrics\n')
+            source = source[:at] + ''.join('\n{} = {!r}'.format(*item) for item in settings.items()) + source[at:]
+        code = compile(source, path, 'exec')
+        self.ns = {'__name__': 'boot'}
+        with self.output(quiet):
+            exec(code, self.ns)
+        now = self.clock.monotonic()
+        self._schedule = [[now + delay, interval, job, align] for interval, job, delay, align in self.jobs._jobs]
+        self._loop = asyncio.new_event_loop()
+        return self.ns
+
+    def output(self, quiet):
+        return contextlib.redirect_stdout(io.StringIO()) if quiet else contextlib.nullcontext()
+
+    def step(self, seconds, only=None):
+        # Advance virtual time by seconds, running every job when it is due.
+        # only(job) can limit the jobs that run. Returns the real seconds
+        # spent in the jobs.
+        end = self.clock.monotonic() + seconds
+        spent = 0.0
+        while True:
+            entry = min(self._schedule, key=lambda e: e[0])
+            if entry[0] > end:
+                break
+            self.clock.advance(entry[0] - self.clock.monotonic())
+            if entry[3]:
+                # next wall-clock multiple of the interval
+                rtc = self.rtc.now()
+                entry[0] = self.clock.monotonic() + (rtc // entry[1] + 1) * entry[1] - rtc
+            else:
+                entry[0] += entry[1]
+            job = entry[2]
+            if only is not None and not only(job):
+                continue
+            start = time.perf_counter()
+            try:
+                result = job()
+                if hasattr(result, 'send'):
+                    self._loop.run_until_complete(result)
+            except Exception as e:
+                print('*** Job {} failed: {}'.format(getattr(job, '__name__', job), e))
+            spent += time.perf_counter() - start
+        self.clock.advance(end - self.clock.monotonic())
+        return spent
+
+    def run(self, seconds):
+        # Run the jobs on their own event loop in real time, the RTC is
+        # polled meanwhile so its alarms fire on time
+        running = [True]
+
+        def poll():
+            while running[0]:
+                self.rtc.poll()
+                time.sleep(0.001)
+
+        async def main():
+            try:
+                await asyncio.wait_for(self.jobs._main(), seconds)
+            except asyncio.TimeoutError:
+                pass
+        threading.Thread(target=poll, daemon=True).start()
+        try:
+            asyncio.run(main())
+        finally:
+            running[0] = False
+
+    def press(self, pin=0):
+        # Press a button, calls its interrupt handler
+        handler = self.pins[pin].handler
+        if handler:
+            handler(self.pins[pin])
+
+    def stop(self):
+        if self.df is not None:
+            self.df.shutdown()
+        if self.oocsi is not None:
+            self.oocsi.stop()
+        if self.ntp is not None:
+            self.ntp.stop()
@@ -0,0 +1,62 @@
+# Checks of the windowed aggregation (Code/lib/aggregate.py). Run with
+# CPython:
+#
+#   python Tools/test_aggregate.py
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Code', 'lib'))
+
+from aggregate import Aggregator  # noqa: E402
+
+
+def feed(aggregator, samples):
+    rows = []
+    for seconds, values in samples:
+        rows += aggregator.add(seconds, values)
+    return rows
+
+
+class AggregatorTest(unittest.TestCase):
+    def test_columns_and_scales(self):
+        a = Aggregator(['t', 'lux'], (60,), None, [10, 1])
+        self.assertEqual(a.columns, ['t_mean', 't_min', 't_max', 'lux_mean', 'lux_min', 'lux_max', 'count', 'window'])
+        self.assertEqual(a.scales, [10, 10, 10, 1, 1, 1, 1, 1])
+        self.assertEqual(Aggregator(['t'], (60,)).scales, [10, 10, 10, 1, 1])
+
+    def test_window_row(self):
+        # A window produces its row when the next one starts, at its start
+        a = Aggregator(['t'], (60,))
+        rows = feed(a, [(120 + 5 * i, [v]) for i, v in enumerate([20, 22, 18, 24])])
+        self.assertEqual(rows, [])
+        self.assertEqual(a.add(180, [30]), [(120, [21.0, 18, 24, 4, 60])])
+
+    def test_windows_are_aligned(self):
+        a = Aggregator(['t'], (60, 900))
+        rows = feed(a, [(s, [1]) for s in range(890, 1805, 5)])
+        minutes = [seconds for seconds, row in rows if row[-1] == 60]
+        quarters = [(seconds, row[3]) for seconds, row in rows if row[-1] == 900]
+        self.assertEqual(minutes, list(range(840, 1800, 60)))
+        self.assertEqual(quarters, [(0, 2), (900, 180)])
+
+    def test_missing_values(self):
+        # None is left out of the statistics, count still counts the sample
+        a = Aggregator(['a', 'b'], (60,))
+        feed(a, [(0, [1, None]), (10, [None, None]), (20, [3, None])])
+        self.assertEqual(a.add(60, [0, 0]), [(0, [2.0, 1, 3, None, None, None, 3, 60])])
+
+    def test_threshold_passes_jumps(self):
+        a = Aggregator(['t', 'h'], (60,), {'t': 2})
+        rows = feed(a, [(0, [20, 50]), (5, [21, 90]), (10, [24, 90]), (15, [None, 90]), (20, [30, 90])])
+        self.assertEqual(rows, [(10, [24, 24, 24, 90, 90, 90, 1, 0])])
+
+    def test_window_range(self):
+        for window in (0, 32768):
+            with self.assertRaises(ValueError):
+                Aggregator(['t'], (window,))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+# Checks of the sample ring in the EEPROM (Code/lib/eeprom.py) on the
+# simulated AT24C32 of Tools/sim.py. Run with CPython:
+#
+#   python Tools/test_eeprom.py
+
+import os
+import shutil
+import struct
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import sim  # noqa: E402
+
+FIELDS = ('humidity', 'temperature')
+
+
+class EEPROMLogTest(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.sim = sim.Sim(eeprom=sim.AT24C32(write_ms=0))
+        self.sim.install()
+        import machine
+        import eeprom
+        self.module = eeprom
+        self.chip = eeprom.AT24C32(machine.I2C())
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.sim.workdir, ignore_errors=True)
+
+    def open(self):
+        return self.module.EEPROMLog(self.chip, FIELDS, buffer=1)
+
+    def slot(self, n):
+        # (head, tail) of a pointer copy as stored
+        memory = self.sim.eeprom.memory
+        return struct.unpack_from('<II', memory, n * self.chip.page + 8)
+
+    def fill(self, records):
+        log = self.open()
+        for i in range(records):
+            log.append(i, (40 + i % 10, 20))
+        log.drain(_Sink())
+        log.append(records, (50, 21))
+        return log
+
+    def test_reopen(self):
+        log = self.fill(20)
+        reopened = self.open()
+        self.assertEqual((reopened.head, reopened.uploaded), (log.head, log.uploaded))
+        self.assertEqual(list(reopened.records(20, 21)), [(20, [50, 21])])
+
+    def test_corrupt_slots(self):
+        # Any damage to one pointer copy falls back to the other, never to
+        # a state with more records waiting than the ring holds
+        for slot in range(2):
+            for offset in range(4, 18):
+                for value in (0x00, 0xFF):
+                    self.sim.eeprom.memory[:] = b'\xff' * self.chip.size
+                    log = self.fill(20)
+                    states = {self.slot(0), self.slot(1)}
+                    address = slot * self.chip.page + offset
+                    if self.sim.eeprom.memory[address] == value:
+                        continue
+                    self.sim.eeprom.memory[address] = value
+                    reopened = self.open()
+                    state = (reopened.head, reopened.uploaded)
+                    self.assertTrue(state in states or state == (0, 0), (slot, offset, value, state))
+                    self.assertLessEqual(reopened.pending(), log.capacity)
+
+    def test_erased_slots(self):
+        self.fill(20)
+        self.sim.eeprom.memory[:2 * self.chip.page] = b'\xff' * (2 * self.chip.page)
+        log = self.open()
+        self.assertEqual((log.head, log.uploaded), (0, 0))
+
+    def test_more_waiting_than_capacity(self):
+        # A copy that passes the checksum but cannot be a real state
+        log = self.fill(20)
+        log.head = log.uploaded + log.capacity + 1
+        log._save()
+        log._save()
+        reopened = self.open()
+        self.assertEqual((reopened.head, reopened.uploaded), (0, 0))
+
+
+class _Sink:
+    def append(self, seconds, values):
+        pass
+
+    def flush(self):
+        pass
+
+
+if __name__ == '__main__':
+    unittest.main()
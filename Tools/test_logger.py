@@ -0,0 +1,272 @@
+# End to end checks of the logger on the hardware simulation (Tools/sim.py)
+# with the local Data Foundry stand-in. Run with CPython:
+#
+#   python Tools/test_logger.py
+#
+# Every test boots Code/boot.py in a fresh Sim in a temporary directory and
+# drives its jobs in virtual time, or runs them on the real scheduler of
+# Code/lib/runtime.py in real time.
+
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from sim import Sim  # noqa: E402
+
+
+def rows(chunks):
+    # The data rows of CSV text, without the header lines in front of every batch
+    return [line for line in b''.join(chunks).decode().split('\n') if line and not line.startswith('ts,')]
+
+
+def values(lines):
+    # Rows as (timestamp, numbers), the delta decoder writes 21 for 21.0
+    return [(line.split(',')[0], [float(v) if v else None for v in line.split(',')[1:]]) for line in lines]
+
+
+class LoggerTest(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.sims = []
+
+    def tearDown(self):
+        for sim in self.sims:
+            sim.stop()
+        os.chdir(self.cwd)
+        for sim in self.sims:
+            shutil.rmtree(sim.workdir, ignore_errors=True)
+
+    def boot(self, workdir=None, accept=('deflate', 'x-delta-csv'), **settings):
+        # A booted Sim with its servers, returns (sim, globals of boot.py)
+        sim = Sim(workdir)
+        if workdir is None:
+            self.sims.append(sim)
+        sim.start_servers(accept)
+        settings.setdefault('use_eeprom', False)
+        # uploads only when a test asks for one
+        settings.setdefault('upload_interval', 10 ** 9)
+        ns = sim.boot(quiet=True, **settings)
+        return sim, ns
+
+    def step(self, sim, seconds):
+        with contextlib.redirect_stdout(io.StringIO()):
+            sim.step(seconds)
+
+    def upload(self, ns):
+        with contextlib.redirect_stdout(io.StringIO()):
+            ns['upload'](True)
+
+    def received(self, sim):
+        try:
+            with open(os.path.join(sim.workdir, 'received.csv'), 'rb') as f:
+                return rows([f.read()])
+        except FileNotFoundError:
+            return []
+
+    def run_jobs(self, sim, ns, seconds, block=0):
+        # Run the real scheduler for seconds of real time, returns the RTC
+        # time of every sample. block stalls the event loop in the second one
+        seen = []
+        sample = ns['sample']
+
+        def timed():
+            seen.append(sim.rtc.now())
+            if len(seen) == 2:
+                time.sleep(block)
+            return sample()
+        sim.jobs._jobs = [(interval, timed if job is sample else job, delay, align)
+                          for interval, job, delay, align in sim.jobs._jobs]
+        with contextlib.redirect_stdout(io.StringIO()):
+            sim.run(seconds)
+        return seen
+
+    def test_run_on_rtc_ticks(self):
+        # The runtime of boot.py, woken by the second ticks of the RTC
+        sim, ns = self.boot(sample_interval=1, dht_interval=1, aggregate_windows=(2,), raw_threshold=None)
+        missed = ns['runtime']._MISSED.value
+        seen = self.run_jobs(sim, ns, 5.5)
+        self.assertIsNotNone(ns['ticks'])
+        self.assertGreaterEqual(ns['ticks'].count, 4)
+        # one sample right away, then one at the start of every second
+        slots = [round(t) for t in seen[1:]]
+        self.assertGreaterEqual(len(slots), 4)
+        self.assertEqual(slots, list(range(slots[0], slots[0] + len(slots))))
+        for t in seen[1:]:
+            self.assertLess(abs(t - round(t)), 0.1)
+        self.assertEqual(ns['runtime']._MISSED.value, missed)
+        self.assertGreaterEqual(ns['log'].count(), 2)
+
+    def test_run_missed_slots(self):
+        # A stalled loop is reported as missed slots and sampling continues
+        # on the slots after it, it does not catch up
+        sim, ns = self.boot(sample_interval=1, dht_interval=1)
+        missed = ns['runtime']._MISSED.value
+        seen = self.run_jobs(sim, ns, 6, block=2.5)
+        self.assertGreaterEqual(ns['runtime']._MISSED.value - missed, 1)
+        slots = [int(t) for t in seen[1:]]
+        self.assertEqual(len(slots), len(set(slots)))
+        self.assertGreaterEqual(slots[1] - slots[0], 2)
+        # back on the whole seconds after the late run
+        for t in seen[3:]:
+            self.assertLess(t - int(t), 0.1)
+
+    def test_upload_reproduces_the_log(self):
+        sim, ns = self.boot()
+        self.step(sim, 3 * 3600)
+        log = ns['log']
+        expected = rows(log.csv(log.uploaded, log.count()))
+        self.assertGreater(len(expected), 100)
+
+        self.upload(ns)
+        self.assertEqual(self.received(sim), expected)
+        self.assertEqual(log.pending(), 0)
+
+    def test_upload_resumes_after_503(self):
+        sim, ns = self.boot(upload_retries=0)
+        self.step(sim, 3600)
+        log = ns['log']
+        expected = rows(log.csv(log.uploaded, log.count()))
+
+        sim.df.fail = 1.0
+        self.upload(ns)
+        self.assertEqual(self.received(sim), [])
+        self.assertEqual(log.uploaded, 0)
+
+        # nothing was acknowledged, the next upload sends every row once
+        sim.df.fail = 0.0
+        self.step(sim, 600)
+        expected += rows(log.csv(len(expected), log.count()))
+        self.upload(ns)
+        self.assertEqual(self.received(sim), expected)
+        self.assertEqual(log.pending(), 0)
+
+    def test_upload_encodings(self):
+        # What the stand-in decodes is the log, and the ratio is against the
+        # size of the same batches as plain CSV
+        for encoding, accept in (('deflate', ('deflate',)), ('delta', ('x-delta-csv',))):
+            with self.subTest(encoding=encoding):
+                sim, ns = self.boot(accept=accept, upload_encoding=encoding)
+                self.step(sim, 6 * 3600)
+                log = ns['log']
+                expected = rows(log.csv(log.uploaded, log.count()))
+                plain = 0
+                start = log.uploaded
+                while start < log.count():
+                    end = log.batch(start, 512)
+                    plain += sum(len(chunk) for chunk in log.csv(start, end))
+                    start = end
+
+                with contextlib.redirect_stdout(io.StringIO()):
+                    response = ns['uploader'].upload_log(ns['url'], ns['headers'], log, encoding=encoding)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(values(self.received(sim)), values(expected))
+                self.assertEqual(response.raw_bytes, plain)
+                self.assertLess(response.sent_bytes, plain / 2)
+
+    def test_segments_after_restart(self):
+        sim, ns = self.boot(segment_records=8)
+        self.step(sim, 2 * 3600)
+        log = ns['log']
+        self.assertGreater(len(log.sealed), 4)
+        log.acknowledge(20)
+        segments = log.segments()
+        pending = log.pending()
+        expected = rows(log.csv(log.uploaded, log.count()))
+        log.close()
+
+        # the manifest lists the sealed segments that are not uploaded yet
+        with open(os.path.join(sim.workdir, 'sensor_data.idx')) as f:
+            lines = f.read().split('\n')
+        head = lines[0].split()
+        self.assertEqual(head[0], 'MSM1')
+        self.assertEqual(int(head[3]), len(log.sealed))
+        for entry, line in zip(log.sealed, lines[1:]):
+            self.assertEqual([int(v) for v in line.split()], entry)
+            self.assertLessEqual(entry[3], entry[4])
+        self.assertNotIn('sensor_data.0.bin', os.listdir(sim.workdir))
+
+        # a restart finds the same segments and continues from the checkpoint
+        sim.stop()
+        restarted, ns = self.boot(sim.workdir, segment_records=8)
+        log = ns['log']
+        self.assertEqual(log.segments(), segments)
+        self.assertEqual(log.uploaded, 20)
+        self.assertEqual(rows(log.csv(log.uploaded, log.count())), expected)
+        log.close()
+        restarted.stop()
+
+        # without the manifest the segments are found again by name
+        os.remove(os.path.join(sim.workdir, 'sensor_data.idx'))
+        restarted, ns = self.boot(sim.workdir, segment_records=8)
+        log = ns['log']
+        self.assertEqual(log.segments(), segments)
+        self.assertEqual(log.pending(), pending)
+        self.assertEqual(rows(log.csv(log.uploaded, log.count())), expected)
+        log.close()
+        restarted.stop()
+
+    def test_orphan_segments_removed(self):
+        # A power loss between saving the manifest and deleting the
+        # acknowledged segments leaves their files, the next start removes
+        # them and nothing is uploaded twice
+        sim, ns = self.boot(segment_records=8)
+        self.step(sim, 2 * 3600)
+        log = ns['log']
+        self.assertGreater(len(log.sealed), 4)
+        seqs = [entry[0] for entry in log.sealed]
+        saved = {}
+        for seq in seqs[:3]:
+            with open(os.path.join(sim.workdir, 'sensor_data.{}.bin'.format(seq)), 'rb') as f:
+                saved[seq] = f.read()
+        log.acknowledge(log.sealed[2][1] + log.sealed[2][2])
+        pending = log.pending()
+        expected = rows(log.csv(log.uploaded, log.count()))
+        log.close()
+        for seq, data in saved.items():
+            with open(os.path.join(sim.workdir, 'sensor_data.{}.bin'.format(seq)), 'wb') as f:
+                f.write(data)
+
+        sim.stop()
+        restarted, ns = self.boot(sim.workdir, segment_records=8)
+        log = ns['log']
+        for seq in saved:
+            self.assertNotIn('sensor_data.{}.bin'.format(seq), os.listdir(sim.workdir))
+        self.assertEqual(log.pending(), pending)
+        self.assertEqual(rows(log.csv(log.uploaded, log.count())), expected)
+        self.assertIn('sensor_data.{}.bin'.format(seqs[3]), os.listdir(sim.workdir))
+        log.close()
+        restarted.stop()
+
+    def test_legacy_csv_removed_when_uploaded(self):
+        # Only a header, or every row acknowledged: removed on boot. A log
+        # with rows waiting is kept until they are uploaded
+        header = b'ts,humidity,temperature\n'
+        row = b'2024-1-1T0:0:0,50,20\n'
+        for data, checkpoint, kept in ((header, None, False), (header + row, len(header + row), False),
+                                       (header + row, len(header), True)):
+            with self.subTest(data=data, checkpoint=checkpoint):
+                workdir = tempfile.mkdtemp(prefix='sim_')
+                self.addCleanup(shutil.rmtree, workdir, True)
+                with open(os.path.join(workdir, 'sensor_data.csv'), 'wb') as f:
+                    f.write(data)
+                if checkpoint is not None:
+                    with open(os.path.join(workdir, 'sensor_data.csv.ofs'), 'w') as f:
+                        f.write(str(checkpoint))
+                sim, ns = self.boot(workdir)
+                names = os.listdir(workdir)
+                self.assertEqual('sensor_data.csv' in names, kept)
+                self.assertEqual('sensor_data.csv.ofs' in names, kept and checkpoint is not None)
+                self.assertEqual(ns['legacy'].pending(), len(row) if kept else 0)
+                ns['log'].close()
+                sim.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
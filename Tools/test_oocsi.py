@@ -0,0 +1,268 @@
+# Checks of the OOCSI client (Code/lib/OOCSI.py) against the local stand-in
+# server (Tools/oocsi_server.py). Run with CPython:
+#
+#   python Tools/test_oocsi.py
+
+import os
+import socket
+import statistics
+import sys
+import threading
+import time
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'Code', 'lib'))
+sys.path.insert(0, HERE)
+
+import OOCSI as oocsi  # noqa: E402
+from oocsi_server import OOCSIServer  # noqa: E402
+
+
+def until(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.02)
+    return condition()
+
+
+class Quiet(oocsi.OOCSI):
+    def log(self, message):
+        pass
+
+
+class ClientTest(unittest.TestCase):
+    def setUp(self):
+        self.server = OOCSIServer(0).start()
+        self.clients = []
+        self.received = []
+        self.receiver = self.client('receiver')
+        self.receiver.subscribe('test', lambda sender, recipient, event: self.received.append(event['i']))
+        time.sleep(0.2)
+
+    def tearDown(self):
+        for client in self.clients:
+            client.reconnect = False
+            client.stop()
+        self.server.stop()
+
+    def client(self, handle, **kwargs):
+        client = Quiet(handle, 'localhost', self.server.port, **kwargs)
+        self.clients.append(client)
+        return client
+
+    def drop(self, handle):
+        # The server side of the connection goes away
+        for conn in list(self.server.handles.values()):
+            if conn.handle == handle:
+                conn.sock.shutdown(socket.SHUT_RDWR)
+
+    def test_queued_before_connected(self):
+        sender = self.client('sender', wait=False)
+        self.assertTrue(sender.send('test', {'i': 0}))
+        self.assertTrue(until(lambda: self.received == [0]))
+
+    def test_queued_while_reconnecting(self):
+        sender = self.client('sender')
+        self.drop('sender')
+        self.assertTrue(until(lambda: not sender.connected))
+        self.assertTrue(sender.send('test', {'i': 1}))
+        self.assertTrue(sender.send('test', {'i': 2}))
+        self.assertTrue(until(lambda: self.received == [1, 2], 10))
+
+    def test_full_queue_refuses(self):
+        # nothing listens on the port, the client stays disconnected
+        free = socket.socket()
+        free.bind(('localhost', 0))
+        port = free.getsockname()[1]
+        free.close()
+        sender = Quiet('sender', 'localhost', port, wait=False, maxQueue=64)
+        self.clients.append(sender)
+        self.assertTrue(sender.send('test', {'i': 0}))
+        self.assertFalse(sender.send('test', {'i': 1, 'padding': 'x' * 64}))
+
+    def test_stalled_server_never_blocks_sends(self):
+        # A server that takes the handshake and then stops reading: with
+        # maxDelay the sender only queues, until the queue is full
+        listener = socket.socket()
+        listener.bind(('localhost', 0))
+        listener.listen(1)
+        accepted = []
+
+        def serve():
+            conn, _ = listener.accept()
+            conn.recv(64)
+            conn.sendall(b'{"message": "welcome"}\n')
+            accepted.append(conn)
+        threading.Thread(target=serve, daemon=True).start()
+        sender = Quiet('sender', 'localhost', listener.getsockname()[1], maxDelay=20, maxQueue=16384)
+        self.clients.append(sender)
+        refused = False
+        slowest = 0
+        payload = 'x' * 1000
+        for i in range(5000):
+            start = time.perf_counter()
+            if not sender.send('test', {'i': i, 'payload': payload}):
+                refused = True
+                break
+            slowest = max(slowest, time.perf_counter() - start)
+        self.assertTrue(refused)
+        self.assertLess(slowest, 0.05)
+        for conn in accepted:
+            conn.close()
+        listener.close()
+
+    def test_call_response(self):
+        responder = self.client('responder')
+        responder.register('service', 'double', lambda event: event.update(result=event['i'] * 2))
+        time.sleep(0.2)
+        call = self.client('caller').call('service', 'double', {'i': 21}, timeout=5)
+        self.assertEqual(call.wait(5)['result'], 42)
+        self.assertTrue('response' in call)
+
+    def test_call_expires(self):
+        # No responder: the sweep completes the call without a response
+        caller = self.client('caller')
+        start = time.time()
+        call = caller.call('nobody', 'double', {'i': 1}, timeout=0.3)
+        self.assertIsNone(call.wait(5))
+        self.assertTrue(call.done)
+        self.assertLess(time.time() - start, 2)
+        self.assertNotIn(call.uuid, caller.calls)
+        self.assertFalse('response' in call)
+
+    def test_late_response_is_dropped(self):
+        responder = self.client('responder')
+        responder.register('service', 'slow', lambda event: time.sleep(0.6))
+        time.sleep(0.2)
+        call = self.client('caller').call('service', 'slow', {}, timeout=0.3)
+        self.assertIsNone(call.wait(5))
+        time.sleep(0.6)
+        self.assertIsNone(call.response)
+
+    def test_calls_dropped_on_disconnect(self):
+        caller = self.client('caller')
+        call = caller.call('nobody', 'double', {'i': 1}, timeout=60)
+        self.drop('caller')
+        self.assertIsNone(call.wait(5))
+        self.assertTrue(call.done)
+
+
+class LineReaderTest(unittest.TestCase):
+    def lines(self, pieces, size=16, recv_into=True):
+        # Every line the reader finds in the pieces, received one per fill()
+        sock = _Pieces(pieces) if recv_into else _RecvOnly(pieces)
+        reader = oocsi.LineReader(sock, size)
+        lines = []
+        while True:
+            line = reader.readline()
+            if line is not None:
+                lines.append(bytes(line))
+            elif reader.fill() == 0:
+                return lines
+
+    def test_split_lines(self):
+        for recv_into in (True, False):
+            pieces = [b'ab', b'c\nde', b'f\n\ngh', b'\n']
+            self.assertEqual(self.lines(pieces, recv_into=recv_into), [b'abc', b'def', b'', b'gh'])
+
+    def test_line_moved_to_the_front(self):
+        # a partial line at the end of a full buffer is kept
+        pieces = [b'0123456789\nabcde', b'fghij\n']
+        self.assertEqual(self.lines(pieces), [b'0123456789', b'abcdefghij'])
+
+    def test_overlong_line_dropped(self):
+        pieces = [b'ok\n', b'x' * 14, b'x' * 16, b'xx\nnext\n']
+        self.assertEqual(self.lines(pieces), [b'ok', b'next'])
+
+    def test_every_split(self):
+        data = b'{"a": 1}\n{"b": 22}\n\n{"c": 333}\n'
+        expected = data.split(b'\n')[:-1]
+        for cut in range(1, len(data)):
+            self.assertEqual(self.lines([data[:cut], data[cut:]], size=32), expected, cut)
+
+
+class CallTest(unittest.TestCase):
+    def test_complete_once(self):
+        call = oocsi.OOCSICall(_Parent(), 'name', timeout=60)
+        self.assertFalse(call.expired())
+        call.complete({'x': 1})
+        call.complete(None)
+        self.assertEqual(call.wait(), {'x': 1})
+        self.assertEqual(call['response'], {'x': 1})
+
+    def test_expired(self):
+        call = oocsi.OOCSICall(_Parent(), 'name', timeout=0.05)
+        self.assertFalse(call.expired())
+        time.sleep(0.1)
+        self.assertTrue(call.expired())
+        with self.assertRaises(KeyError):
+            call['response']
+
+    def test_sweep(self):
+        parent = _Parent()
+        parent.calls = {}
+        for timeout in (0.05, 60):
+            call = oocsi.OOCSICall(parent, 'name', timeout)
+            parent.calls[call.uuid] = call
+        time.sleep(0.1)
+        oocsi.OOCSI.sweep(parent)
+        self.assertEqual([call.done for call in parent.calls.values()], [False])
+
+
+class RingBufferTest(unittest.TestCase):
+    def test_window(self):
+        # Against the statistics of the last capacity values, over several laps
+        ring = oocsi.RingBuffer(7)
+        values = []
+        for i in range(40):
+            value = float((i * 37) % 11) - 3.5
+            ring.append(value)
+            values.append(value)
+            window = values[-7:]
+            mean = sum(window) / len(window)
+            self.assertAlmostEqual(ring.mean(), mean, places=4)
+            self.assertAlmostEqual(ring.variance(), sum((v - mean) ** 2 for v in window) / len(window), places=4)
+            self.assertEqual(ring.median(), statistics.median(window))
+
+    def test_empty_and_constant(self):
+        ring = oocsi.RingBuffer(4)
+        self.assertIsNone(ring.mean())
+        self.assertIsNone(ring.variance())
+        self.assertIsNone(ring.median())
+        for _ in range(10):
+            ring.append(0.1)
+        self.assertGreaterEqual(ring.variance(), 0.0)
+        self.assertAlmostEqual(ring.mean(), 0.1, places=6)
+
+
+class _Parent:
+    uuid4 = oocsi.OOCSI.uuid4
+
+
+class _Pieces:
+    def __init__(self, pieces):
+        self.pieces = list(pieces)
+
+    def recv_into(self, mv):
+        if not self.pieces:
+            return 0
+        piece = self.pieces.pop(0)
+        n = min(len(piece), len(mv))
+        mv[:n] = piece[:n]
+        if n < len(piece):
+            self.pieces.insert(0, piece[n:])
+        return n
+
+
+class _RecvOnly:
+    def __init__(self, pieces):
+        self.pieces = _Pieces(pieces)
+
+    def recv(self, n):
+        buf = bytearray(n)
+        return bytes(buf[:self.pieces.recv_into(memoryview(buf))])
+
+
+if __name__ == '__main__':
+    unittest.main()
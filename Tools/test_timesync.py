@@ -0,0 +1,65 @@
+# Checks of the local time rules of the clock sync (Code/lib/timesync.py).
+# Run with CPython:
+#
+#   python Tools/test_timesync.py
+
+import calendar
+import os
+import shutil
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import sim  # noqa: E402
+
+
+def utc(*t):
+    return calendar.timegm(t + (0,) * (6 - len(t)))
+
+
+class LocalTimeTest(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.sim = sim.Sim()
+        self.sim.install()
+        import timesync
+        self.timesync = timesync
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.sim.workdir, ignore_errors=True)
+
+    def test_changes(self):
+        # 01:00 UTC on the last Sunday of March and October
+        changes = {2024: (31, 27), 2025: (30, 26), 2026: (29, 25), 2027: (28, 31)}
+        for year, (march, october) in changes.items():
+            self.assertEqual(self.timesync._last_sunday(year, 3), utc(year, 3, march, 1))
+            self.assertEqual(self.timesync._last_sunday(year, 10), utc(year, 10, october, 1))
+
+    def test_offset(self):
+        sync = self.timesync.TimeSync('localhost', utc_offset=3600, dst='EU')
+        self.assertEqual(sync.offset(utc(2026, 1, 15)), 3600)
+        self.assertEqual(sync.offset(utc(2026, 3, 29, 0, 59, 59)), 3600)
+        self.assertEqual(sync.offset(utc(2026, 3, 29, 1)), 7200)
+        self.assertEqual(sync.offset(utc(2026, 10, 25, 0, 59, 59)), 7200)
+        self.assertEqual(sync.offset(utc(2026, 10, 25, 1)), 3600)
+        plain = self.timesync.TimeSync('localhost', utc_offset=-18000)
+        self.assertEqual(plain.offset(utc(2026, 7, 1)), -18000)
+        with self.assertRaises(ValueError):
+            self.timesync.TimeSync('localhost', dst='US')
+
+    def test_sync_due_after_a_change(self):
+        sync = self.timesync.TimeSync('localhost', utc_offset=3600, dst='EU')
+        sync.synced = utc(2026, 10, 25, 0, 30) * 1000
+        self.assertEqual(sync.next_sync(), 1801)
+        sync.synced = utc(2026, 11, 1) * 1000
+        sync.drift_ppm = 0.5
+        self.assertEqual(sync.next_sync(), sync.max_interval)
+        sync.dst = None
+        sync.synced = utc(2026, 10, 25, 0, 30) * 1000
+        self.assertEqual(sync.next_sync(), sync.max_interval)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,201 @@
+# Checks of the streaming upload (Code/lib/uploader.py) against the local
+# Data Foundry stand-in (Tools/df_server.py). Run with CPython:
+#
+#   python Tools/test_upload.py
+#
+# For the memory checks the stand-in runs in a process of its own, so only
+# the memory of the uploading side is traced.
+
+import contextlib
+import io
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+import sim  # noqa: E402
+
+# Peak Python memory a plain upload may take, whatever the size of the log,
+# and how much more a log ten times as big may take with any encoding
+BOUND = 64 * 1024
+GROWTH = 16 * 1024
+START = 1700000000
+FIELDS = ['f{}'.format(i) for i in range(8)]
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+class UploadTest(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.sim = sim.Sim()
+        self.sim.install()
+        import samplelog
+        import uploader
+        self.samplelog = samplelog
+        self.uploader = uploader
+        self.out = os.path.join(self.sim.workdir, 'received.csv')
+        port = free_port()
+        self.server = subprocess.Popen(
+            [sys.executable, os.path.join(HERE, 'df_server.py'), '--port', str(port), '--out', self.out],
+            stdout=subprocess.DEVNULL)
+        self.url = 'http://127.0.0.1:{}/datasets/ts/logFile/1'.format(port)
+        self.headers = {'Content-Type': 'text/plain', 'api_token': 'test', 'device_id': 'test'}
+        deadline = time.time() + 10
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port)).close()
+                break
+            except OSError:
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.05)
+
+    def tearDown(self):
+        self.server.terminate()
+        self.server.wait()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.sim.workdir, ignore_errors=True)
+
+    def upload(self, log, encoding=None):
+        # Upload everything, returns the peak traced memory
+        tracemalloc.start()
+        try:
+            response = self.uploader.upload_log(self.url, self.headers, log, encoding=encoding)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(log.pending(), 0)
+        return peak
+
+    def received(self):
+        rows = 0
+        with open(self.out, 'rb') as f:
+            for line in f:
+                if not line.startswith(b'ts,'):
+                    rows += 1
+        return rows
+
+    def legacy(self, rows):
+        with open('sensor_data.csv', 'w') as f:
+            f.write('ts,humidity,temperature\n')
+            for i in range(rows):
+                t = time.gmtime(START + 60 * i)
+                f.write('{}-{}-{}T{}:{}:{},{},{}\n'.format(*t[:6], 40 + i % 30, 15 + i % 10))
+        return self.samplelog.CSVLog('sensor_data.csv')
+
+    def sample_log(self, name, rows):
+        log = self.samplelog.SampleLog(name, FIELDS, [10] * len(FIELDS), buffer=64)
+        for i in range(rows):
+            log.append(START + 60 * i, [(i + j) % 500 / 10 for j in range(len(FIELDS))])
+        log.close()
+        return log
+
+    def copy(self, log, name):
+        # A full upload compacts the log, every upload gets a copy
+        shutil.copy(log.filename, name)
+        return self.samplelog.SampleLog(name, FIELDS, [10] * len(FIELDS), buffer=64)
+
+    def test_legacy_csv(self):
+        base = self.upload(self.legacy(9000))
+        log = self.legacy(90000)
+        self.assertGreater(os.path.getsize('sensor_data.csv'), 2 * 1024 * 1024)
+        open(self.out, 'wb').close()
+        peak = self.upload(log)
+        self.assertEqual(self.received(), 90000)
+        self.assertLess(peak, BOUND)
+        self.assertLess(peak, base + GROWTH)
+
+    def test_sample_log(self):
+        small = self.sample_log('small.bin', 4000)
+        big = self.sample_log('big.bin', 40000)
+        self.assertGreater(sum(len(chunk) for chunk in big.csv(0, big.count(), 4096)), 2 * 1024 * 1024)
+        for encoding in (None, 'deflate', 'delta'):
+            with self.subTest(encoding=encoding):
+                base = self.upload(self.copy(small, 'upload.bin'), encoding)
+                open(self.out, 'wb').close()
+                peak = self.upload(self.copy(big, 'upload.bin'), encoding)
+                self.assertEqual(self.received(), 40000)
+                self.assertLess(peak, base + GROWTH)
+                if encoding != 'deflate':
+                    # zlib on CPython keeps a 32 kB window at level 9, the
+                    # deflate module on the device one of 1 kB
+                    self.assertLess(peak, BOUND)
+
+
+class RetryTest(unittest.TestCase):
+    # Which answers are retried, and how long the uploader waits
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.sim = sim.Sim()
+        self.sim.install()
+        import df_server
+        import samplelog
+        import uploader
+        self.uploader = uploader
+        self.df = df_server.serve(0, os.path.join(self.sim.workdir, 'received.csv'))
+        threading.Thread(target=self.df.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:{}/datasets/ts/logFile/1'.format(self.df.server_address[1])
+        self.log = samplelog.SampleLog('sensor_data.bin', FIELDS, [10] * len(FIELDS))
+        for i in range(10):
+            self.log.append(START + 60 * i, [1.0] * len(FIELDS))
+
+    def tearDown(self):
+        self.df.shutdown()
+        self.df.server_close()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.sim.workdir, ignore_errors=True)
+
+    def upload(self, headers):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return self.uploader.upload_log(self.url, headers, self.log, retries=3, backoff=0.01)
+
+    def test_retryable(self):
+        for status in (500, 502, 503, 504, 408, 429):
+            self.assertTrue(self.uploader.retryable(status), status)
+        for status in (400, 401, 403, 404, 413, 415):
+            self.assertFalse(self.uploader.retryable(status), status)
+
+    def test_backoff(self):
+        for attempt in range(1, 10):
+            delay = min(60, 2 ** (attempt - 1))
+            waits = [self.uploader._backoff(attempt, 1.0) for _ in range(200)]
+            self.assertGreaterEqual(min(waits), 0.5 * delay)
+            self.assertLessEqual(max(waits), 1.5 * delay)
+            # jittered, loggers that failed together spread out
+            self.assertGreater(max(waits) - min(waits), 0.5 * delay)
+
+    def test_4xx_is_not_retried(self):
+        response = self.upload({'device_id': 'test'})
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.retries, 0)
+        self.assertEqual(self.log.uploaded, 0)
+
+    def test_5xx_is_retried(self):
+        self.df.fail = 1.0
+        response = self.upload({'api_token': 'test'})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.retries, 3)
+        self.assertEqual(self.log.uploaded, 0)
+        self.df.fail = 0.0
+        self.assertEqual(self.upload({'api_token': 'test'}).status_code, 200)
+        self.assertEqual(self.log.pending(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
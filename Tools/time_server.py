@@ -0,0 +1,92 @@
+# Local stand-in for an SNTP server (RFC 4330), enough for the clock sync in
+# Code/lib/timesync.py. Run with CPython:
+#
+#   python Tools/time_server.py --port 1123 --delay-ms 40 --offset 2.5
+#
+# and set time_host/time_port in secrets.py to this machine. --delay-ms
+# holds every request and every reply back for that long, like a slow
+# network, and --jitter-ms adds a random extra on top of each. --offset
+# serves a time that many seconds off the system clock.
+
+import argparse
+import random
+import socket
+import struct
+import threading
+import time
+
+NTP_DELTA = 2208988800
+_PACKET = "!BBbbII4sQQQQ"
+
+
+def ntp_timestamp(seconds):
+    return (int(seconds) + NTP_DELTA) << 32 | int((seconds % 1) * (1 << 32))
+
+
+class TimeServer:
+    def __init__(self, port=123, host='', clock=time.time, offset=0.0, delay_ms=0, jitter_ms=0):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host, port))
+        self.sock.settimeout(0.5)
+        self.port = self.sock.getsockname()[1]
+        self.clock = clock
+        self.offset = offset
+        self.delay_ms = delay_ms
+        self.jitter_ms = jitter_ms
+        self.requests = 0
+        self.running = True
+
+    def start(self):
+        # Serve from a daemon thread, returns self
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def now(self):
+        return self.clock() + self.offset
+
+    def delay(self):
+        return (self.delay_ms + random.uniform(0, self.jitter_ms)) / 1000
+
+    def serve_forever(self):
+        while self.running:
+            try:
+                request, address = self.sock.recvfrom(512)
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            if len(request) < 48 or request[0] & 7 != 3:
+                continue
+            self.requests += 1
+            # every exchange in a thread of its own, so delays overlap
+            threading.Thread(target=self.answer, args=(request, address), daemon=True).start()
+
+    def answer(self, request, address):
+        time.sleep(self.delay())
+        received = self.now()
+        version = request[0] >> 3 & 7
+        originate = struct.unpack_from('!Q', request, 40)[0]
+        reply = struct.pack(_PACKET, version << 3 | 4, 1, 6, -20, 0, 0, b'LOCL', ntp_timestamp(received),
+                            originate, ntp_timestamp(received), ntp_timestamp(self.now()))
+        threading.Timer(self.delay(), self.send, (reply, address)).start()
+
+    def send(self, reply, address):
+        try:
+            self.sock.sendto(reply, address)
+        except OSError:
+            pass
+
+    def stop(self):
+        self.running = False
+        self.sock.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local stand-in SNTP server')
+    parser.add_argument('--port', type=int, default=123)
+    parser.add_argument('--delay-ms', type=float, default=0, help='one-way delay of requests and replies')
+    parser.add_argument('--jitter-ms', type=float, default=0, help='random extra delay, up to this much')
+    parser.add_argument('--offset', type=float, default=0, help='seconds to add to the system clock')
+    args = parser.parse_args()
+    print('SNTP stand-in listening on port', args.port)
+    TimeServer(args.port, offset=args.offset, delay_ms=args.delay_ms, jitter_ms=args.jitter_ms).serve_forever()